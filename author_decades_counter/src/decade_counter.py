@@ -1,13 +1,16 @@
 import logging
 from common.authors import Authors
 from common.book import Book
-from common.middleware import Middleware
+from common.middleware import Middleware, split_processed_records
 from common.eof_packet import EOFPacket
-from common.persistence_manager import PersistenceManager
+from common.persistence_manager import PersistenceBackend, PersistenceManager
 import json
 
 REQUIRED_DECADES = 10
-AUTHOR_PREFIX = "author_"
+# Decades are counted from this year, so masks only grow with the decades an
+# author spans. Books published before it are not counted.
+BASE_YEAR = 1500
+AUTHORS_KEY = "author_decades"
 
 
 class DecadeCounter:
@@ -16,19 +19,25 @@ class DecadeCounter:
                  output_queues: list,
                  instance_id: int,
                  cluster_size: int):
-        self.authors: dict[int, dict[str, list]] = {}
+        # Decades of each author as a bitmask, where bit n is set if they
+        # published a book in the n-th decade since BASE_YEAR
+        self.authors: dict[int, dict[str, int]] = {}
+        self.updated_authors: dict[int, set[str]] = {}
         self.instance_id = instance_id
         self.cluster_size = cluster_size
-        self.persistence_manager = PersistenceManager(
-            f'../storage/decade_counter_{instance_id}')
-        self._init_state()
+        self.persistence_manager = PersistenceManager.from_backend(
+            f'../storage/decade_counter_{instance_id}', PersistenceBackend.WAL)
+        self.persistence_manager.register_compactor(AUTHORS_KEY, self._compact_authors)
         self.middleware = Middleware(
             input_queues=input_queues,
             callback=self.add_decade,
             eof_callback=self.handle_eof,
+            commit_callback=self._checkpoint,
             output_queues=output_queues,
             instance_id=instance_id,
-            persistence_manager=self.persistence_manager)
+            persistence_manager=self.persistence_manager,
+            checkpoint_processed=True)
+        self._init_state()
 
     def start(self):
         self.middleware.start()
@@ -41,8 +50,9 @@ class DecadeCounter:
         logging.debug(f" [x] Received EOF: {eof_packet}")
         if self.instance_id not in eof_packet.ack_instances:
             eof_packet.ack_instances.append(self.instance_id)
-            self.persistence_manager.delete_keys(f"{AUTHOR_PREFIX}{eof_packet.client_id}_", secondary_key=str(eof_packet.client_id))
             self.authors.pop(eof_packet.client_id, None)
+            self.persistence_manager.delete_keys(AUTHORS_KEY, secondary_key=str(eof_packet.client_id))
+            self.updated_authors.pop(eof_packet.client_id, None)
 
         if len(eof_packet.ack_instances) == self.cluster_size:
             self.middleware.send(
@@ -55,23 +65,20 @@ class DecadeCounter:
 
     def add_decade(self, book: Book):
         author = book.authors if book.authors else None
-        if not author or not book.year:
+        if not author or not book.year or book.year < BASE_YEAR:
             return
 
         client_id = book.client_id
-        decade = (book.year // 10) * 10
-        self.authors[client_id] = self.authors.get(client_id, {})
-        self.authors[client_id][author] = self.authors[client_id].get(author, [])
-
-        if decade in self.authors[client_id][author]:
+        decade = 1 << ((book.year - BASE_YEAR) // 10)
+        decades = self.authors.setdefault(client_id, {}).get(author, 0)
+        if decades & decade:
             return
 
-        self.authors[client_id][author].append(decade)
-        key = f'{AUTHOR_PREFIX}{client_id}_{author}'
-        self.persistence_manager.put(
-            key, json.dumps(self.authors[client_id][author]), secondary_key=str(client_id))
+        decades |= decade
+        self.authors[client_id][author] = decades
+        self.updated_authors.setdefault(client_id, set()).add(author)
 
-        if len(self.authors[client_id][author]) == REQUIRED_DECADES:
+        if bin(decades).count('1') == REQUIRED_DECADES:
             authors_packet = Authors(
                 client_id=client_id,
                 packet_id=book.packet_id,
@@ -80,12 +87,38 @@ class DecadeCounter:
             logging.info(f"Author {author} has published books in {REQUIRED_DECADES} different decades. Client id: {client_id}")
             self.middleware.send(authors_packet.encode())
 
+    def _checkpoint(self):
+        # Authors with new decades since the last commit are appended once
+        # each, right before their deliveries are acknowledged and in the same
+        # record as their ids
+        processed = self.middleware.take_processed()
+        for client_id in set(self.updated_authors) | set(processed):
+            authors = self.updated_authors.get(client_id, ())
+            records = [json.dumps([author, self.authors[client_id][author]]) for author in authors]
+            if client_id in processed:
+                records.append(processed[client_id])
+            self.persistence_manager.append(AUTHORS_KEY, '\n'.join(records), secondary_key=str(client_id))
+        self.updated_authors = {}
+
+    @staticmethod
+    def _compact_authors(records: list[str]) -> list[str]:
+        # Decades are only added, so the last record of an author wins
+        (processed_ids, records) = split_processed_records(records)
+        latest = {}
+        for record in records:
+            [author, decades] = json.loads(record)
+            latest[author] = decades
+        return [json.dumps([author, decades]) for author, decades in latest.items()] + [processed_ids.to_str()]
+
     def _init_state(self):
         self.authors = {}
-        for (key, secondary_key) in self.persistence_manager.get_keys(AUTHOR_PREFIX):
-            [client_id, author] = key.removeprefix(AUTHOR_PREFIX).split('_', maxsplit=1)
-            client_id = int(client_id)
-            if client_id not in self.authors:
-                self.authors[client_id] = {}
-            self.authors[client_id][author] = json.loads(self.persistence_manager.get(key, secondary_key) or '[]')
-        logging.info(f"State initialized with {self.authors}")
+        for (_, secondary_key) in self.persistence_manager.get_keys(AUTHORS_KEY):
+            client_id = int(secondary_key)
+            self.authors[client_id] = {}
+            (processed_ids, records) = split_processed_records(
+                self.persistence_manager.get(AUTHORS_KEY, secondary_key).splitlines())
+            for record in records:
+                [author, decades] = json.loads(record)
+                self.authors[client_id][author] = decades
+            self.middleware.restore_processed(client_id, processed_ids)
+        logging.info("State initialized with authors of %d clients", len(self.authors))
@@ -0,0 +1,101 @@
+import argparse
+import csv
+import socket
+import sys
+import threading
+import time
+
+from common.book import Book
+from common.receive_utils import receive_line
+from common.review import Review
+from input_boundary.src.client_stream import CHUNK_LENGTH_BYTES, EOF_STR, LENGTH_BYTES, PROTOCOL_MARKER, \
+    PROTOCOL_V2, ClientStream
+
+BOOKS_PATH = 'example_datasets/books_data.csv'
+REVIEWS_PATH = 'example_datasets/Books_rating.csv'
+CHUNK_SIZE = 1024 * 1024
+
+
+def send_lines(path: str, s: socket.socket):
+    """
+    First protocol version: a frame per stripped line, then an EOF line
+    """
+    with open(path, encoding='utf-8') as csvfile:
+        csvfile.readline()  # Skip header
+        for line in list(csvfile) + [EOF_STR]:
+            data = line.strip().encode()
+            s.sendall(len(data).to_bytes(LENGTH_BYTES, byteorder='big') + data)
+
+
+def send_chunks(path: str, s: socket.socket):
+    """
+    Second protocol version: chunks of whole lines, then an empty chunk
+    """
+    s.sendall(PROTOCOL_MARKER + PROTOCOL_V2.to_bytes(1, byteorder='big'))
+    with open(path, encoding='utf-8') as csvfile:
+        csvfile.readline()  # Skip header
+        while True:
+            data = ''.join(csvfile.readlines(CHUNK_SIZE)).encode()
+            s.sendall(len(data).to_bytes(CHUNK_LENGTH_BYTES, byteorder='big') + data)
+            if not data:
+                return
+
+
+def receive_per_line(s: socket.socket, entity) -> int:
+    """
+    Previous input boundary: every line parsed by a csv.reader of its own
+    """
+    rows = 0
+    while True:
+        line = receive_line(s, LENGTH_BYTES).decode().strip()
+        if line == EOF_STR:
+            return rows
+        if line and entity.from_csv_row(line, 1, rows):
+            rows += 1
+
+
+def receive_chunked(s: socket.socket, entity) -> int:
+    """
+    Current input boundary: a single csv.reader over the lines of the stream
+    """
+    rows = 0
+    stream = ClientStream(s)
+    stream.negotiate()
+    for fields in csv.reader(stream.lines()):
+        if fields and entity.from_csv_fields(fields, 1, rows):
+            rows += 1
+    return rows
+
+
+def measure(send, receive, path: str, entity, rounds: int) -> tuple[int, float]:
+    rows = 0
+    elapsed = 0.0
+    for _ in range(rounds):
+        (client, server) = socket.socketpair()
+        with client, server:
+            sender = threading.Thread(target=send, args=(path, client))
+            start = time.perf_counter()
+            sender.start()
+            rows = receive(server, entity)
+            elapsed += time.perf_counter() - start
+            sender.join()
+    return rows, rows * rounds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per-line and chunked CSV ingestion of the input boundary')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Times each file is sent')
+    args = parser.parse_args()
+    csv.field_size_limit(sys.maxsize)
+
+    print(f"{'file':<12}{'protocol':<12}{'rows':>10}{'rows/s':>12}")
+    for name, path, entity in [('books', BOOKS_PATH, Book), ('reviews', REVIEWS_PATH, Review)]:
+        for protocol, send, receive in [('per-line', send_lines, receive_per_line),
+                                        ('chunked', send_chunks, receive_chunked)]:
+            rows, rate = measure(send, receive, path, entity, args.rounds)
+            print(f"{name:<12}{protocol:<12}{rows:>10}{rate:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import csv
+import time
+
+from common.book import Book
+from common.book_stats import BookStats
+from common.packet_decoder import PacketDecoder
+from common.review import Review
+from common.review_and_author import ReviewAndAuthor
+
+BOOKS_PATH = 'example_datasets/books_data.csv'
+REVIEWS_PATH = 'example_datasets/Books_rating.csv'
+SAMPLE_SIZE = 2000
+
+
+def read_rows(path: str, limit: int) -> list[str]:
+    rows = []
+    with open(path, encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)  # Skip header
+        for row in reader:
+            rows.append(row)
+            if len(rows) == limit:
+                break
+    return rows
+
+
+def sample_packets(limit: int) -> dict[str, list]:
+    books = [Book(row[0], row[1], row[2], row[5], Book.extract_year(row[6]) or 0, row[8], 1, i)
+             for i, row in enumerate(read_rows(BOOKS_PATH, limit))]
+    reviews = [Review(row[1], float(row[6]), row[9], 1, i)
+               for i, row in enumerate(read_rows(REVIEWS_PATH, limit))]
+    return {
+        'Book': books,
+        'Review': reviews,
+        'ReviewAndAuthor': [ReviewAndAuthor(r.book_title, r.score, r.text, "['Some Author']", 1, r.packet_id)
+                            for r in reviews],
+        'BookStats': [BookStats(r.book_title, r.score, 1, r.packet_id) for r in reviews],
+    }
+
+
+def measure(packets: list, encode, rounds: int) -> tuple[float, float, float]:
+    bodies = [encode(packet) for packet in packets]
+    total = len(packets) * rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for packet in packets:
+            encode(packet)
+    encode_rate = total / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for body in bodies:
+            PacketDecoder.decode(body)
+    decode_rate = total / (time.perf_counter() - start)
+
+    average_size = sum(len(body.encode() if isinstance(body, str) else body)
+                       for body in bodies) / len(bodies)
+    return encode_rate, decode_rate, average_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the JSON and binary packet codecs')
+    parser.add_argument('--samples', type=int, default=SAMPLE_SIZE,
+                        help='Amount of packets of each type to use')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Times each sample is encoded and decoded')
+    args = parser.parse_args()
+
+    print(f"{'packet':<16}{'codec':<8}{'encode/s':>12}{'decode/s':>12}{'bytes':>10}")
+    for name, packets in sample_packets(args.samples).items():
+        for codec, encode in [('json', lambda p: p.to_json()), ('binary', lambda p: p.to_binary())]:
+            encode_rate, decode_rate, size = measure(packets, encode, args.rounds)
+            print(f"{name:<16}{codec:<8}{encode_rate:>12.0f}{decode_rate:>12.0f}{size:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import csv
+import sys
+import time
+
+from sentiment_analyzer.src.sentiment_engine import SentimentEngine, SentimentEngineType
+
+REVIEWS_PATH = 'example_datasets/Books_rating.csv'
+TOLERANCE = 1e-9
+
+
+def read_texts(path: str, limit: int) -> list[str]:
+    csv.field_size_limit(sys.maxsize)
+    texts = []
+    with open(path, encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)  # Skip header
+        for row in reader:
+            texts.append(row[9])
+            if len(texts) == limit:
+                break
+    return texts
+
+
+def measure(engine: SentimentEngine, texts: list[str], batch_size: int) -> tuple[list[float], float]:
+    scores = []
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        scores.extend(engine.score_batch(texts[i:i + batch_size]))
+    return scores, len(texts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the sentiment engines and validate them against TextBlob')
+    parser.add_argument('--samples', type=int, default=None,
+                        help='Amount of reviews to score, all of them by default')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Reviews scored per call')
+    args = parser.parse_args()
+
+    texts = read_texts(REVIEWS_PATH, args.samples)
+    # TextBlob goes first, its scores are the reference
+    expected = None
+
+    print(f"{'engine':<10}{'reviews/s':>12}{'mismatches':>12}{'max error':>12}")
+    for engine_type in [SentimentEngineType.TEXTBLOB, SentimentEngineType.LEXICON]:
+        scores, rate = measure(SentimentEngine.from_type(engine_type), texts, args.batch_size)
+        if engine_type == SentimentEngineType.TEXTBLOB:
+            expected = scores
+        errors = [abs(score - reference) for score, reference in zip(scores, expected)]
+        mismatches = sum(error > TOLERANCE for error in errors)
+        print(f"{engine_type:<10}{rate:>12.0f}{mismatches:>12}{max(errors):>12.2e}")
+
+
+if __name__ == '__main__':
+    main()
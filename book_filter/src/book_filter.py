@@ -2,9 +2,9 @@ import logging
 import os
 import json
 
-from common.book import Book
 from common.eof_packet import EOFPacket
 from common.middleware import Middleware
+from common.packet_view import PacketView
 
 filter_by_field: str = json.loads(os.getenv("FILTER_BY_FIELD")) or ''
 filter_by_values: list = json.loads(os.getenv("FILTER_BY_VALUES")) or []
@@ -20,7 +20,8 @@ class BookFilter:
         self.middleware: Middleware = Middleware(
             input_queues=input_queues, callback=self.filter_book,
             eof_callback=self.handle_eof, output_queues=output_queues,
-            output_exchanges=output_exchanges)
+            output_exchanges=output_exchanges,
+            lazy_decode=True)
         self.instance_id = instance_id
         self.cluster_size = cluster_size
 
@@ -45,14 +46,15 @@ class BookFilter:
         else:
             self.middleware.return_eof(eof_packet)
 
-    def filter_book(self, book: Book):
-        logging.debug(f" [x] Received {book}")
+    def filter_book(self, book: PacketView):
+        logging.debug(" [x] Received %s", book)
         if self.filter_by(filter_by_field, filter_by_values, book):
             logging.debug(" [x] Filter passed. ")
+            # Books pass the filter untouched, so the original body is forwarded
             self.middleware.send(book.encode())
-        logging.debug(f" [x] Done fitering book: {book.title}")
+        logging.debug(" [x] Done fitering book: %s", book)
 
-    def filter_by(self, field: str, compare_values: list[str], book: Book):
+    def filter_by(self, field: str, compare_values: list[str], book: PacketView):
         field_value = book.get(field)
         if field == 'title':
             for str in compare_values:
@@ -1,12 +1,13 @@
 import csv
 from io import TextIOWrapper
 import logging
+import os
 import signal
 import socket
 import threading
 import time
 
-from common.receive_utils import receive_exact, receive_line
+from common.receive_utils import receive_exact
 from common.result_packet import ResultPacket
 
 LENGTH_BYTES = 2
@@ -14,6 +15,16 @@ OUTPUT_DIR = "../output"
 CLIENT_ID_BYTES = 2
 WAIT_TIMEOUT = 10
 EOF_STR = "EOF"
+# The second protocol version sends chunks of whole lines with a 4 byte
+# length, announced by a marker and the version instead of a first line
+PROTOCOL_VERSION = int(os.getenv('PROTOCOL_VERSION', '2'))
+PROTOCOL_MARKER = b'\xff\xff'
+PROTOCOL_V2 = 2
+CHUNK_LENGTH_BYTES = 4
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', str(1024 * 1024)))
+# Results arrive in batches of length-prefixed frames, read this many bytes
+# at a time
+RESULTS_READ_SIZE = 64 * 1024
 
 
 class GracefulShutdown(Exception):
@@ -27,6 +38,12 @@ def send_line(line: str, socket: socket.socket):
     socket.sendall(encoded_msg)
 
 
+def send_chunk(lines: str, socket: socket.socket):
+    encoded_lines = lines.encode()
+    socket.sendall(len(encoded_lines).to_bytes(CHUNK_LENGTH_BYTES, byteorder='big'))
+    socket.sendall(encoded_lines)
+
+
 def process_result(result: ResultPacket):
     if result.query == 1:
         return process_query_1(result.result.payload)
@@ -131,7 +148,7 @@ class Client:
                 logging.info(f"Sent all books in {time.time() - start} seconds")
 
                 logging.info("Sending books EOF")
-                send_line(EOF_STR, self.input_socket)
+                self.__send_eof(self.input_socket)
                 logging.info("Sent books EOF")
 
                 logging.info("Sending reviews")
@@ -139,7 +156,7 @@ class Client:
                 logging.info(f"Sent all reviews in {time.time() - start} seconds")
 
                 logging.info("Sending reviews EOF")
-                send_line(EOF_STR, self.input_socket)
+                self.__send_eof(self.input_socket)
                 logging.info("Sent reviews EOF")
         except ConnectionRefusedError:
             logging.error("Connection refused")
@@ -168,6 +185,8 @@ class Client:
             self.client_id = int.from_bytes(client_id_bytes, byteorder='big')
             logging.info("Received client id: %d", self.client_id)
             self.condition.notify_all()
+            if PROTOCOL_VERSION == PROTOCOL_V2:
+                self.input_socket.sendall(PROTOCOL_MARKER + bytes([PROTOCOL_V2]))
             logging.info("Checking for output connection - timeout: %s seconds", WAIT_TIMEOUT)
             if not self.condition.wait_for(lambda: self.connected_to_output or self.should_stop, WAIT_TIMEOUT):
                 logging.error("Output connection timeout")
@@ -211,16 +230,27 @@ class Client:
         self.shutdown()
 
     def __receive_results(self):
+        buffer = bytearray()
         while not self.should_stop:
-            try:
-                data = receive_line(self.results_socket, LENGTH_BYTES).decode().strip()
-                result_packet = ResultPacket.decode(data)
+            data = self.results_socket.recv(RESULTS_READ_SIZE)
+            if not data:
+                logging.info("EOF reached")
+                break
+            buffer += data
+            # Every whole frame received is parsed, a partial one is kept
+            # until the rest of it arrives
+            position = 0
+            while len(buffer) - position >= LENGTH_BYTES:
+                start = position + LENGTH_BYTES
+                end = start + int.from_bytes(buffer[position:start], byteorder='big')
+                if len(buffer) < end:
+                    break
+                result_packet = ResultPacket.decode(buffer[start:end].decode())
                 result_data = process_result(result_packet)
                 self.results[result_packet.query].append(result_data)
                 logging.info("Saved result: %s", result_packet)
-            except EOFError:
-                logging.info("EOF reached")
-                break
+                position = end
+            del buffer[:position]
 
     def __output_results(self):
         for query in self.results.keys():
@@ -253,7 +283,24 @@ class Client:
         client_id_encoded = self.client_id.to_bytes(CLIENT_ID_BYTES, byteorder='big')
         socket.sendall(client_id_encoded)
 
+    def __send_eof(self, socket: socket.socket):
+        if PROTOCOL_VERSION == PROTOCOL_V2:
+            send_chunk("", socket)
+        else:
+            send_line(EOF_STR, socket)
+
     def __send_file(self, file: TextIOWrapper, socket: socket.socket):
+        if PROTOCOL_VERSION == PROTOCOL_V2:
+            while True:
+                if self.should_stop:
+                    raise GracefulShutdown
+                # Whole lines adding up to about CHUNK_SIZE
+                lines = file.readlines(CHUNK_SIZE)
+                if not lines:
+                    return
+                send_chunk(''.join(lines), socket)
+                logging.debug("Sent chunk of %d lines", len(lines))
+
         for line in file:
             if self.should_stop:
                 raise GracefulShutdown
@@ -6,6 +6,8 @@ from common.packet_type import PacketType
 from common.packet import Packet
 
 YEAR_REGEX = re.compile('[^\d]*(\d{4})[^\d]*')
+# Columns of a row of the books file
+CSV_FIELDS = 10
 
 
 class Book(Packet):
@@ -28,10 +30,18 @@ class Book(Packet):
 
     @staticmethod
     def from_csv_row(csv_row: str, client_id: int, packet_id: int) -> 'Book':
-        # Title,description,authors,image,previewLink,publisher,publishedDate,infoLink,categories,ratingsCount
         fields = list(csv.reader([csv_row]))[0]
+        return Book.from_csv_fields(fields, client_id, packet_id)
+
+    @staticmethod
+    def from_csv_fields(fields: list[str], client_id: int, packet_id: int) -> 'Book':
+        # Title,description,authors,image,previewLink,publisher,publishedDate,infoLink,categories,ratingsCount
+        # Malformed rows are skipped, like rows missing a field
+        if len(fields) < CSV_FIELDS:
+            return None
         title = fields[0].strip()
-        description = fields[1].strip()
+        # No query uses the description, the largest column, so it is not sent
+        description = ""
         authors = fields[2].strip()  # Book.extract_array(fields[2].strip())
         publisher = fields[5].strip()
         year = Book.extract_year(fields[6].strip())
@@ -98,4 +108,4 @@ class Book(Packet):
             packet_id)
 
     def __str__(self):
-        return self.encode()
+        return self.to_json()
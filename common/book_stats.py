@@ -1,5 +1,5 @@
 from common.packet_type import PacketType
-from common.packet import Packet
+from common.packet import NO_TITLE_ID, Packet
 
 
 class BookStats(Packet):
@@ -7,10 +7,12 @@ class BookStats(Packet):
                  title: str,
                  score: float,
                  client_id: int,
-                 packet_id: int):
+                 packet_id: int,
+                 title_id: int = NO_TITLE_ID):
         super().__init__(client_id, packet_id)
         self.title = title
         self.score = score
+        self.title_id = title_id
 
     @property
     def packet_type(self):
@@ -19,7 +21,8 @@ class BookStats(Packet):
     @property
     def payload(self):
         return [self.title,
-                self.score]
+                self.score,
+                self.title_id]
 
     @staticmethod
     def decode(
@@ -27,7 +30,8 @@ class BookStats(Packet):
             client_id: int, packet_id: int) -> 'BookStats':
         title = fields[0]
         score = fields[1]
-        return BookStats(title, score, client_id, packet_id)
+        title_id = fields[2] if len(fields) > 2 else NO_TITLE_ID
+        return BookStats(title, score, client_id, packet_id, title_id)
 
     def __lt__(self, other: 'BookStats'):
         return self.score < other.score
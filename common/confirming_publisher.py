@@ -0,0 +1,137 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable
+
+import pika
+
+
+class ConfirmingPublisher:
+    """
+    Publishes through a connection of its own with publisher confirms, keeping
+    up to window publishes in flight instead of waiting for each confirm
+
+    The connection runs its own event loop in a thread. Publishes are handed
+    to it in order, and publish only blocks while the window is full. Callbacks
+    registered with after_confirmed run, in order, once every publish handed
+    before them is confirmed. Nacked publishes are sent again, up to retries
+    times each.
+    """
+
+    def __init__(self, parameters: pika.ConnectionParameters, window: int, retries: int):
+        self.window = window
+        self.retries = retries
+        self.condition = threading.Condition()
+        # Publishes handed over and not confirmed yet
+        self.outstanding = 0
+        self.error = None
+        self.connection = None
+        self.channel = None
+        # Everything below is only touched from the event loop thread
+        self._sequence = 0
+        self._delivery_tag = 0
+        # Delivery tag -> (sequence, exchange, routing_key, body, attempt)
+        self._unconfirmed: dict[int, tuple[int, str, str, bytes, int]] = {}
+        # (sequence of the last publish handed before it, callback)
+        self._waiters: deque[tuple[int, Callable]] = deque()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(parameters,), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def publish(self, exchange: str, routing_key: str, body):
+        with self.condition:
+            while self.outstanding >= self.window and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.outstanding += 1
+        self.connection.ioloop.add_callback_threadsafe(
+            lambda: self._publish(exchange, routing_key, body))
+
+    def after_confirmed(self, callback: Callable):
+        """
+        Calls callback from the publisher thread once every publish handed
+        over so far is confirmed
+        """
+        self.connection.ioloop.add_callback_threadsafe(lambda: self._add_waiter(callback))
+
+    def close(self):
+        if self.connection is not None and self._thread.is_alive():
+            self.connection.ioloop.add_callback_threadsafe(self._close)
+            self._thread.join()
+
+    def _run(self, parameters: pika.ConnectionParameters):
+        self.connection = pika.SelectConnection(
+            parameters,
+            on_open_callback=lambda connection: connection.channel(on_open_callback=self._on_channel_open),
+            on_open_error_callback=self._on_connection_closed,
+            on_close_callback=self._on_connection_closed)
+        self.connection.ioloop.start()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        self.channel.add_on_close_callback(lambda _, reason: self._fail(reason))
+        self.channel.confirm_delivery(self._on_confirm, callback=lambda _: self._ready.set())
+
+    def _on_connection_closed(self, _connection, reason):
+        self._fail(reason)
+        self.connection.ioloop.stop()
+
+    def _close(self):
+        if self.connection.is_open:
+            self.connection.close()
+        else:
+            self.connection.ioloop.stop()
+
+    def _fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = OSError(f"Publisher connection closed: {error}")
+            self.condition.notify_all()
+        self._ready.set()
+
+    def _publish(self, exchange: str, routing_key: str, body, sequence: int = None, attempt: int = 0):
+        if sequence is None:
+            self._sequence += 1
+            sequence = self._sequence
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body)
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = (sequence, exchange, routing_key, body, attempt)
+
+    def _add_waiter(self, callback: Callable):
+        self._waiters.append((self._sequence, callback))
+        self._release_waiters()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        confirmed = [self._unconfirmed.pop(tag) for tag in tags if tag in self._unconfirmed]
+
+        if isinstance(method, pika.spec.Basic.Nack):
+            for (sequence, exchange, routing_key, body, attempt) in confirmed:
+                if attempt == self.retries:
+                    self._fail(f"publish to {routing_key or exchange} rejected {attempt + 1} times")
+                    self.connection.close()
+                    return
+                logging.warning("Publish to %s was rejected by the broker, retrying", routing_key or exchange)
+                self._publish(exchange, routing_key, body, sequence, attempt + 1)
+            return
+
+        with self.condition:
+            self.outstanding -= len(confirmed)
+            self.condition.notify_all()
+        self._release_waiters()
+
+    def _release_waiters(self):
+        # Publishes sent again keep their sequence, so the oldest one may
+        # not be the first unconfirmed
+        oldest = min((entry[0] for entry in self._unconfirmed.values()), default=None)
+        while self._waiters and (oldest is None or self._waiters[0][0] < oldest):
+            (_, callback) = self._waiters.popleft()
+            callback()
@@ -27,4 +27,4 @@ class EOFPacket(Packet):
         return EOFPacket(client_id, packet_id, ack_instances)
 
     def __str__(self):
-        return self.encode()
+        return self.to_json()
@@ -1,17 +1,44 @@
 import logging
 import os
+import threading
+import time
+from functools import partial
 from typing import Callable
 import pika
 
+from common.confirming_publisher import ConfirmingPublisher
 from common.packet import Packet
+from common.packet_codec import decode_packet_type
 from common.packet_type import PacketType
 from common.packet_decoder import PacketDecoder
+from common.packet_batch import PacketBatch
+from common.packet_view import PacketView
 from common.eof_packet import EOFPacket
 from common.persistence_manager import PersistenceManager
+from common.packet_id_set import SNAPSHOT_PREFIX, PacketIdSet
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
 RABBITMQ_HEARTBEAT = int(os.getenv('RABBITMQ_HEARTBEAT', '1200'))
+BATCH_SIZE = int(os.getenv('MIDDLEWARE_BATCH_SIZE', '1'))
+BATCH_MAX_BYTES = int(os.getenv('MIDDLEWARE_BATCH_MAX_BYTES', str(1024 * 1024)))
+BATCH_TIMEOUT = float(os.getenv('MIDDLEWARE_BATCH_TIMEOUT', '0.1'))
+GROUP_COMMIT_SIZE = int(os.getenv('MIDDLEWARE_GROUP_COMMIT_SIZE', '1'))
+GROUP_COMMIT_TIMEOUT = float(os.getenv('MIDDLEWARE_GROUP_COMMIT_TIMEOUT', '0.05'))
+PUBLISHER_CONFIRMS = os.getenv('MIDDLEWARE_PUBLISHER_CONFIRMS', '0') == '1'
+PUBLISH_RETRIES = int(os.getenv('MIDDLEWARE_PUBLISH_RETRIES', '3'))
+# Publishes waiting for their confirm before publishing blocks
+CONFIRM_WINDOW = int(os.getenv('MIDDLEWARE_CONFIRM_WINDOW', '1000'))
+# Seconds a shutdown waits for the outputs already published to be confirmed
+CONFIRM_SHUTDOWN_TIMEOUT = 5
+PREFETCH_COUNT = int(os.getenv('MIDDLEWARE_PREFETCH_COUNT', '100'))
+ADAPTIVE_PREFETCH = os.getenv('MIDDLEWARE_ADAPTIVE_PREFETCH', '0') == '1'
+PREFETCH_MAX = int(os.getenv('MIDDLEWARE_PREFETCH_MAX', '1000'))
+# Seconds of work the prefetched deliveries should hold
+PREFETCH_TARGET_SECONDS = float(os.getenv('MIDDLEWARE_PREFETCH_TARGET_SECONDS', '0.5'))
+PREFETCH_ADJUST_INTERVAL = float(os.getenv('MIDDLEWARE_PREFETCH_ADJUST_INTERVAL', '5'))
+PREFETCH_TOLERANCE = 0.25
+SERVICE_TIME_SMOOTHING = 0.1
 
 PROCESSED_KEY = 'processed'
 
@@ -32,11 +59,31 @@ class Middleware:
                  n_output_instances: int = None,
                  instance_id: int = None,
                  persistence_manager: PersistenceManager = None,
+                 batch_size: int = BATCH_SIZE,
+                 batch_max_bytes: int = BATCH_MAX_BYTES,
+                 batch_timeout: float = BATCH_TIMEOUT,
+                 lazy_decode: bool = False,
+                 group_commit_size: int = GROUP_COMMIT_SIZE,
+                 group_commit_timeout: float = GROUP_COMMIT_TIMEOUT,
+                 publisher_confirms: bool = PUBLISHER_CONFIRMS,
+                 confirm_window: int = CONFIRM_WINDOW,
+                 prefetch_count: int = PREFETCH_COUNT,
+                 adaptive_prefetch: bool = ADAPTIVE_PREFETCH,
+                 commit_callback: Callable = None,
+                 checkpoint_processed: bool = False,
                  ):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
-            RABBITMQ_HOST, RABBITMQ_PORT, heartbeat=RABBITMQ_HEARTBEAT))
+        parameters = pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT, heartbeat=RABBITMQ_HEARTBEAT)
+        self.connection = pika.BlockingConnection(parameters)
         self.channel = self.connection.channel()
-        self.channel.basic_qos(prefetch_count=100)
+        self.prefetch_count = prefetch_count
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        # Outputs are published by a connection of their own that keeps up to
+        # confirm_window of them unconfirmed, and the acks of a group are only
+        # released once every output published before them is confirmed
+        self.publisher_confirms = publisher_confirms
+        self.confirming_publisher = None
+        if self.publisher_confirms:
+            self.confirming_publisher = ConfirmingPublisher(parameters, confirm_window, PUBLISH_RETRIES)
         self.input_queues: dict[str, str] = {}
         self.output_queues = output_queues
         self.output_exchanges = output_exchanges
@@ -44,11 +91,44 @@ class Middleware:
         self.eof_callback = eof_callback
         self.n_output_instances = n_output_instances
         self.instance_id = instance_id
+        self.batch_size = batch_size
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_timeout = batch_timeout
+        # Callbacks receive a PacketView instead of a decoded packet
+        self.lazy_decode = lazy_decode
+        # Acks are held back and released together, once the outputs and the
+        # state changes of every delivery in the group are durable
+        self.group_commit_size = group_commit_size
+        self.group_commit_timeout = group_commit_timeout
+        # Called before every commit, so work deferred by the callbacks can
+        # still publish its outputs as part of the group
+        self.commit_callback = commit_callback
+        # Processed ids are not persisted by the middleware, but taken by the
+        # commit_callback to be written in the same record as the state they
+        # changed, so a restart never finds one without the other
+        self.checkpoint_processed = checkpoint_processed
+        self._unpersisted_ids: dict[int, list[int]] = {}
+        self._uncommitted_deliveries = 0
+        self._last_delivery_tag = None
+        self._commit_timer = None
+        # Prefetch is sized from the smoothed time a delivery takes to process,
+        # and never below what a group commit holds unacknowledged
+        self.adaptive_prefetch = adaptive_prefetch
+        self.min_prefetch = 2 * group_commit_size
+        self.service_time = None
+        self.ack_rate = 0.0
+        self._acked_deliveries = 0
+        self._metrics_started_at = time.monotonic()
+        self._batches: dict[tuple[str, str], list] = {}
+        self._batches_bytes: dict[tuple[str, str], int] = {}
+        self._batch_started_at = None
         self._init_input(input_queues)
         self._init_output()
         self.should_stop = False
         self.persistence_manager = persistence_manager
-        self.state: dict[int, set[int]] = {}
+        self.state: dict[int, PacketIdSet] = {}
+        if self.persistence_manager:
+            self.persistence_manager.register_compactor(PROCESSED_KEY, compact_processed_ids)
         self.init_state()
 
     def _init_input(self, input_queues):
@@ -88,17 +168,116 @@ class Middleware:
                 self.send_to_queue(f'{queue}{suffix}', data)
 
             for exchange in self.output_exchanges:
-                self.channel.basic_publish(
-                    exchange=exchange, routing_key='', body=data)
+                self._publish(exchange, '', data)
                 logging.debug("Sent to exchange %s: %s", exchange, data)
 
     def send_to_queue(self, queue: str, data: str):
-        self.channel.basic_publish(exchange='', routing_key=queue, body=data)
+        self._publish('', queue, data)
         logging.debug("Sent to queue %s: %s", queue, data)
 
+    def send_to_exchange(self, exchange: str, data: str):
+        self._publish(exchange, '', data)
+        logging.debug("Sent to exchange %s: %s", exchange, data)
+
+    def _publish(self, exchange: str, routing_key: str, data):
+        if self.batch_size <= 1:
+            self._basic_publish(exchange, routing_key, data)
+            return
+
+        if decode_packet_type(data) == PacketType.EOF.value:
+            # An EOF travels the ring of instances, so it could reach the
+            # consumer of another destination before the packets batched for
+            # it. Everything batched is published first, and the EOF right away.
+            self.flush()
+            self._basic_publish(exchange, routing_key, data)
+            return
+
+        destination = (exchange, routing_key)
+        if destination not in self._batches:
+            self._batches[destination] = []
+            self._batches_bytes[destination] = 0
+        if self._batch_started_at is None:
+            self._batch_started_at = time.monotonic()
+        self._batches[destination].append(data)
+        self._batches_bytes[destination] += len(data)
+
+        if len(self._batches[destination]) >= self.batch_size \
+                or self._batches_bytes[destination] >= self.batch_max_bytes:
+            self._flush_batch(destination)
+        elif time.monotonic() - self._batch_started_at >= self.batch_timeout:
+            self.flush()
+
+    def _flush_batch(self, destination: tuple[str, str]):
+        batch = self._batches.pop(destination, None)
+        self._batches_bytes.pop(destination, None)
+        if not self._batches:
+            self._batch_started_at = None
+        if not batch:
+            return
+        # A single packet is sent as is, there is no point in wrapping it
+        body = batch[0] if len(batch) == 1 else PacketBatch.encode(batch)
+        exchange, routing_key = destination
+        self._basic_publish(exchange, routing_key, body)
+        logging.debug("Flushed batch of %d packets to %s", len(batch), destination)
+
+    def _basic_publish(self, exchange: str, routing_key: str, body):
+        if self.confirming_publisher:
+            self.confirming_publisher.publish(exchange, routing_key, body)
+        else:
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body)
+
+    def flush(self):
+        for destination in list(self._batches.keys()):
+            self._flush_batch(destination)
+
+    def _commit(self):
+        if self._commit_timer is not None:
+            self.connection.remove_timeout(self._commit_timer)
+            self._commit_timer = None
+        if self.commit_callback:
+            self.commit_callback()
+        self.flush()
+        if self.persistence_manager:
+            self.persistence_manager.flush()
+        if self._last_delivery_tag is not None:
+            ack = partial(self._ack_committed, self._last_delivery_tag, self._uncommitted_deliveries)
+            if self.confirming_publisher:
+                self.confirming_publisher.after_confirmed(partial(self._ack_threadsafe, ack))
+            else:
+                ack()
+        self._acked_deliveries += self._uncommitted_deliveries
+        self._uncommitted_deliveries = 0
+        self._last_delivery_tag = None
+
+    def _ack_threadsafe(self, ack: Callable):
+        # Called by the publisher thread, acks are sent by the consuming one
+        try:
+            self.connection.add_callback_threadsafe(ack)
+        except pika.exceptions.ConnectionWrongStateError:
+            logging.debug("Connection closed before its deliveries were acked")
+
+    def _ack_committed(self, delivery_tag: int, deliveries: int):
+        if self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+            logging.debug("Committed %d deliveries", deliveries)
+
     def _shutdown(self):
         self.should_stop = True
 
+        try:
+            self._commit()
+            if self.confirming_publisher and self.confirming_publisher.error is None:
+                # Waiters run in order, so once this one runs the acks of
+                # every committed group are handed to this connection
+                confirmed = threading.Event()
+                self.confirming_publisher.after_confirmed(confirmed.set)
+                if confirmed.wait(timeout=CONFIRM_SHUTDOWN_TIMEOUT):
+                    self.connection.process_data_events(time_limit=0)
+        except Exception as e:
+            logging.error("Could not commit pending deliveries: %s", e)
+        if self.confirming_publisher:
+            self.confirming_publisher.close()
+
         if self.input_queues:
             self.stop()
 
@@ -112,6 +291,13 @@ class Middleware:
         logging.info("Stopping middleware")
         self.connection.add_callback_threadsafe(self._shutdown)
 
+    def add_callback_threadsafe(self, callback: Callable):
+        """
+        Runs callback on the thread consuming from this middleware, between
+        deliveries, so it can safely send packets
+        """
+        self.connection.add_callback_threadsafe(callback)
+
     def add_input_queue(self,
                         input_queue: str,
                         callback: Callable,
@@ -143,35 +329,104 @@ class Middleware:
                           ):
 
         def wrapper(ch, method, properties, body):
-            packet = PacketDecoder.decode(body)
-            action = CallbackAction.ACK
-            if packet.packet_type == PacketType.EOF:
-                logging.debug("Received EOF packet")
-                if eof_callback:
-                    action = eof_callback(packet) or CallbackAction.ACK
-
-                if action == CallbackAction.ACK:
-                    self.clear_processed(packet.client_id)
-            else:
-                if not self.is_duplicate(packet):
-                    action = callback(packet) or CallbackAction.ACK
-                    if action == CallbackAction.ACK:
-                        self.mark_as_processed(packet)
-
-            if not auto_ack:
-                if action == CallbackAction.ACK:
-                    self.ack(method.delivery_tag)
-                elif action == CallbackAction.NACK:
-                    self.nack(method.delivery_tag)
+            started_at = time.monotonic()
+            bodies = PacketBatch.decode(body) if PacketBatch.is_batch(body) else [body]
+            should_nack = False
+            for packet_body in bodies:
+                if self.lazy_decode:
+                    packet = PacketView(packet_body)
+                else:
+                    packet = PacketDecoder.decode(packet_body)
+                action = self._handle_packet(packet, callback, eof_callback)
+                if auto_ack:
+                    continue
+                if action == CallbackAction.NACK:
+                    should_nack = True
                 elif action == CallbackAction.REQUEUE:
-                    self.send_to_queue(method.routing_key, body)
-                    self.ack(method.delivery_tag)
+                    self.send_to_queue(method.routing_key, packet_body)
                     logging.debug("Requeued packet to %s", method.routing_key)
 
+            if auto_ack:
+                self.flush()
+            elif should_nack:
+                # A batch is acknowledged as a whole, so a single NACK
+                # means every packet in it will be redelivered
+                self._commit()
+                self.nack(method.delivery_tag)
+            else:
+                self.ack(method.delivery_tag)
+            self._observe_delivery(time.monotonic() - started_at)
+
         return wrapper
 
+    @property
+    def metrics(self) -> dict:
+        return {
+            'prefetch_count': self.prefetch_count,
+            'service_time': self.service_time,
+            'ack_rate': self.ack_rate,
+        }
+
+    def _observe_delivery(self, service_time: float):
+        if self.service_time is None:
+            self.service_time = service_time
+        else:
+            self.service_time += SERVICE_TIME_SMOOTHING * (service_time - self.service_time)
+
+        elapsed = time.monotonic() - self._metrics_started_at
+        if elapsed < PREFETCH_ADJUST_INTERVAL:
+            return
+        self.ack_rate = self._acked_deliveries / elapsed
+        self._acked_deliveries = 0
+        self._metrics_started_at += elapsed
+        if self.adaptive_prefetch:
+            self._adjust_prefetch()
+        logging.info("Prefetch count: %d, service time: %.6fs, ack rate: %.1f/s",
+                     self.prefetch_count, self.service_time, self.ack_rate)
+
+    def _adjust_prefetch(self):
+        # Little's law: the deliveries processed in PREFETCH_TARGET_SECONDS
+        target = int(PREFETCH_TARGET_SECONDS / max(self.service_time, 1e-6))
+        target = max(self.min_prefetch, min(PREFETCH_MAX, target))
+        # Small changes are not worth a round trip to the broker
+        if abs(target - self.prefetch_count) < self.prefetch_count * PREFETCH_TOLERANCE:
+            return
+        logging.info("Adjusting prefetch count from %d to %d", self.prefetch_count, target)
+        self.prefetch_count = target
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+    def _handle_packet(self,
+                       packet: Packet,
+                       callback: Callable[[Packet], CallbackAction],
+                       eof_callback: Callable[[EOFPacket], any]
+                       ) -> CallbackAction:
+        action = CallbackAction.ACK
+        if packet.packet_type == PacketType.EOF:
+            logging.debug("Received EOF packet")
+            if isinstance(packet, PacketView):
+                packet = packet.decode()
+            if eof_callback:
+                action = eof_callback(packet) or CallbackAction.ACK
+
+            if action == CallbackAction.ACK:
+                self.clear_processed(packet.client_id)
+        else:
+            if not self.is_duplicate(packet):
+                action = callback(packet) or CallbackAction.ACK
+                if action == CallbackAction.ACK:
+                    self.mark_as_processed(packet)
+        return action
+
     def ack(self, delivery_tag):
-        self.channel.basic_ack(delivery_tag=delivery_tag)
+        # Outputs and state must be durable before the input is acknowledged,
+        # so the ack is deferred until the group it belongs to is committed
+        self._last_delivery_tag = delivery_tag
+        self._uncommitted_deliveries += 1
+        if self._uncommitted_deliveries >= self.group_commit_size:
+            self._commit()
+        elif self._commit_timer is None:
+            self._commit_timer = self.connection.call_later(
+                self.group_commit_timeout, self._commit)
 
     def nack(self, delivery_tag):
         self.channel.basic_nack(delivery_tag=delivery_tag)
@@ -185,14 +440,13 @@ class Middleware:
         for queue in self.input_queues:
             queue = queue if self.instance_id is None else queue.removesuffix(
                 f'{self.instance_id}')+f"{self.instance_id+1}"
-            self.channel.basic_publish(
-                exchange='', routing_key=queue, body=data)
+            self._publish('', queue, data)
             logging.debug("Sent to queue %s: %s", queue, data)
 
     def is_duplicate(self, packet: Packet) -> bool:
         if self.persistence_manager:
-            processed_ids = self.state.get(packet.client_id, set())
-            if packet.packet_id in processed_ids:
+            processed_ids = self.state.get(packet.client_id)
+            if processed_ids is not None and packet.packet_id in processed_ids:
                 logging.debug(f"Packet {packet.trace_id} is a duplicate!")
                 return True
         return False
@@ -202,10 +456,13 @@ class Middleware:
             client_id = packet.client_id
             packet_id = packet.packet_id
             if client_id not in self.state:
-                self.state[client_id] = set()
+                self.state[client_id] = PacketIdSet()
             self.state[client_id].add(packet_id)
-            key = f"{PROCESSED_KEY}_{client_id}"
-            self.persistence_manager.append(key, str(packet_id))
+            if self.checkpoint_processed:
+                self._unpersisted_ids.setdefault(client_id, []).append(packet_id)
+            else:
+                key = f"{PROCESSED_KEY}_{client_id}"
+                self.persistence_manager.append(key, str(packet_id))
             logging.debug(f"Marked {packet.trace_id} as processed")
 
     def clear_processed(self, client_id: int):
@@ -213,16 +470,57 @@ class Middleware:
             key = f"{PROCESSED_KEY}_{client_id}"
             self.persistence_manager.delete_keys(key)
             self.state.pop(client_id, None)
+            self._unpersisted_ids.pop(client_id, None)
             logging.debug(f"Cleared processed packets for client {client_id}")
 
+    def take_processed(self) -> dict[int, str]:
+        """
+        Returns a processed_record of the packets of every client marked as
+        processed since the last call, for checkpoint_processed nodes to
+        persist along with their state
+        """
+        records = {client_id: processed_record(packet_ids)
+                   for client_id, packet_ids in self._unpersisted_ids.items()}
+        self._unpersisted_ids = {}
+        return records
+
+    def restore_processed(self, client_id: int, processed_ids: PacketIdSet):
+        self.state.setdefault(client_id, PacketIdSet()).update(processed_ids)
+
     def init_state(self):
         if self.persistence_manager:
             keys = self.persistence_manager.get_keys(PROCESSED_KEY)
             for (key, secondary_key) in keys:
                 client_id = int(key.split('_', maxsplit=1)[1])
                 processed_ids = self.persistence_manager.get(key, secondary_key).splitlines()
-                self.state[client_id] = set(processed_ids)
-            logging.debug(f"Initialized state with {self.state}")
+                self.state[client_id] = PacketIdSet.from_records(processed_ids)
+            logging.debug(f"Initialized state with {sum(len(ids) for ids in self.state.values())} processed packets")
         else:
             logging.debug(
                 "No persistence manager, skipping state initialization")
+
+
+def compact_processed_ids(records: list[str]) -> list[str]:
+    return [PacketIdSet.from_records(records).to_str()]
+
+
+def processed_record(packet_ids: list[int]) -> str:
+    processed_ids = PacketIdSet()
+    for packet_id in packet_ids:
+        processed_ids.add(packet_id)
+    return processed_ids.to_str()
+
+
+def split_processed_records(records: list[str]) -> tuple[PacketIdSet, list[str]]:
+    """
+    Separates the processed_records persisted by a checkpoint_processed node
+    from the records of its own state
+    """
+    processed_ids = PacketIdSet()
+    state_records = []
+    for record in records:
+        if record.startswith(SNAPSHOT_PREFIX):
+            processed_ids.update(PacketIdSet.from_str(record))
+        else:
+            state_records.append(record)
+    return (processed_ids, state_records)
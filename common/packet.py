@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
-import json
 
 from common.packet_type import PacketType
+from common.packet_codec import PACKET_CODEC, BinaryCodec, JsonCodec, PacketCodec
+
+# Title id of packets sent before titles were interned
+NO_TITLE_ID = -1
 
 
 class Packet(ABC):
@@ -19,15 +22,24 @@ class Packet(ABC):
     def payload(self) -> list:
         pass
 
-    def encode(self) -> str:
-        return json.dumps(
-            [
-                self.client_id,
-                self.packet_id,
-                self.packet_type.value,
-                self.payload
-            ]
-        )
+    def encode(self):
+        if PACKET_CODEC == PacketCodec.BINARY:
+            return self.to_binary()
+        return self.to_json()
+
+    def to_json(self) -> str:
+        return JsonCodec.encode(
+            self.client_id,
+            self.packet_id,
+            self.packet_type.value,
+            self.payload)
+
+    def to_binary(self) -> bytes:
+        return BinaryCodec.encode(
+            self.client_id,
+            self.packet_id,
+            self.packet_type.value,
+            self.payload)
 
     @staticmethod
     @abstractmethod
@@ -39,7 +51,7 @@ class Packet(ABC):
         return f"{self.client_id}-{self.packet_id}"
 
     def __str__(self):
-        return self.encode()
+        return self.to_json()
 
     def get(self, field: str):
         return getattr(self, field, None)
@@ -0,0 +1,33 @@
+BATCH_MAGIC = b'\x00PB'
+COUNT_BYTES = 4
+LENGTH_BYTES = 4
+
+
+class PacketBatch:
+    @staticmethod
+    def is_batch(body: bytes) -> bool:
+        return body[:len(BATCH_MAGIC)] == BATCH_MAGIC
+
+    @staticmethod
+    def encode(bodies: list) -> bytes:
+        # [MAGIC][COUNT]([LENGTH][BODY])*
+        parts = [BATCH_MAGIC, len(bodies).to_bytes(COUNT_BYTES, byteorder='big')]
+        for body in bodies:
+            if isinstance(body, str):
+                body = body.encode()
+            parts.append(len(body).to_bytes(LENGTH_BYTES, byteorder='big'))
+            parts.append(body)
+        return b''.join(parts)
+
+    @staticmethod
+    def decode(body: bytes) -> list[bytes]:
+        offset = len(BATCH_MAGIC)
+        count = int.from_bytes(body[offset:offset + COUNT_BYTES], byteorder='big')
+        offset += COUNT_BYTES
+        bodies = []
+        for _ in range(count):
+            length = int.from_bytes(body[offset:offset + LENGTH_BYTES], byteorder='big')
+            offset += LENGTH_BYTES
+            bodies.append(body[offset:offset + length])
+            offset += length
+        return bodies
@@ -0,0 +1,170 @@
+import json
+import os
+import struct
+
+from common.packet_type import PacketType
+
+PACKET_CODEC = os.getenv('PACKET_CODEC', 'json')
+
+BINARY_MAGIC = 0xB1
+BINARY_VERSION = 2
+# [MAGIC][VERSION][CLIENT_ID][PACKET_ID][PACKET_TYPE]
+HEADER_FORMAT = '>BBHiB'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+LIST_ITEM = struct.Struct('>i')
+
+# Payload layout of each packet type
+# s: UTF-8 string, i: integer, f: float, l: list of integers
+SCHEMAS = {
+    PacketType.EOF.value: 'l',
+    PacketType.BOOK.value: 'ssssis',
+    PacketType.REVIEW.value: 'sfs',
+    PacketType.BOOK_STATS.value: 'sfi',
+    PacketType.REVIEW_AND_AUTHOR.value: 'sfssi',
+    PacketType.AUTHORS.value: 's',
+}
+# Schemas of every version still decoded, so packets encoded before an
+# upgrade are read as they were written, their missing fields left to the
+# defaults of each packet
+VERSION_SCHEMAS = {
+    1: {**SCHEMAS,
+        PacketType.BOOK_STATS.value: 'sf',
+        PacketType.REVIEW_AND_AUTHOR.value: 'sfss'},
+    BINARY_VERSION: SCHEMAS,
+}
+FIELD_FORMATS = {'s': 'I', 'i': 'q', 'f': 'd', 'l': 'H'}
+# Characters of a JSON packet that always hold its client id, packet id and type
+JSON_HEADER_LENGTH = 64
+
+
+class PacketCodec:
+    JSON = 'json'
+    BINARY = 'binary'
+
+
+class JsonCodec:
+    @staticmethod
+    def encode(client_id: int, packet_id: int, packet_type: int, payload: list) -> str:
+        return json.dumps([client_id, packet_id, packet_type, payload])
+
+    @staticmethod
+    def decode(body) -> tuple[int, int, int, list]:
+        fields = json.loads(body)
+        return fields[0], fields[1], fields[2], fields[3]
+
+    @staticmethod
+    def decode_type(body) -> int:
+        # The header fields are integers, so the type is found without
+        # parsing the payload
+        separator = ',' if isinstance(body, str) else b','
+        return int(body[:JSON_HEADER_LENGTH].split(separator, 3)[2])
+
+
+class BinaryCodec:
+    """
+    Length-prefixed binary packets
+
+    Each packet is a fixed-width header and a fixed-width section holding the
+    numeric fields and the lengths of the variable fields, both packed with a
+    single precompiled struct per packet type, followed by the raw UTF-8 bytes
+    of every string and the items of every list, in payload order. Only the
+    current version is encoded, but every version in VERSION_SCHEMAS is
+    decoded.
+    """
+    STRUCTS = {(version, packet_type): struct.Struct(HEADER_FORMAT + ''.join(FIELD_FORMATS[field] for field in schema))
+               for version, schemas in VERSION_SCHEMAS.items()
+               for packet_type, schema in schemas.items()}
+
+    @staticmethod
+    def is_binary(body) -> bool:
+        return isinstance(body, (bytes, bytearray, memoryview)) \
+            and len(body) > 0 and body[0] == BINARY_MAGIC
+
+    @staticmethod
+    def encode(client_id: int, packet_id: int, packet_type: int, payload: list) -> bytes:
+        schema = SCHEMAS.get(packet_type)
+        if schema is None:
+            raise ValueError(f"Packet type {packet_type} has no binary schema")
+        values = []
+        tail = []
+        for field, value in zip(schema, payload):
+            if field == 's':
+                value = value.encode()
+                values.append(len(value))
+                tail.append(value)
+            elif field == 'l':
+                values.append(len(value))
+                tail.extend(LIST_ITEM.pack(item) for item in value)
+            else:
+                values.append(value)
+        fixed = BinaryCodec.STRUCTS[(BINARY_VERSION, packet_type)].pack(
+            BINARY_MAGIC, BINARY_VERSION, client_id, packet_id, packet_type, *values)
+        return fixed + b''.join(tail)
+
+    @staticmethod
+    def decode_header(body: bytes) -> tuple[int, int, int]:
+        (_magic, version, client_id, packet_id, packet_type) = struct.unpack_from(HEADER_FORMAT, body, 0)
+        if version not in VERSION_SCHEMAS:
+            raise ValueError(f"Unsupported binary packet version: {version}")
+        return client_id, packet_id, packet_type
+
+    @staticmethod
+    def decode_field(body: bytes, index: int):
+        """
+        Decodes the field at index of the payload, or returns None if the
+        version of the packet did not have it yet
+        """
+        (version, packet_type) = (body[1], body[HEADER_SIZE - 1])
+        schema = VERSION_SCHEMAS[version][packet_type]
+        if index >= len(schema):
+            return None
+        fixed = BinaryCodec.STRUCTS[(version, packet_type)]
+        values = fixed.unpack_from(body, 0)[5:]
+        # Skip the variable sections of the previous fields without decoding them
+        offset = fixed.size
+        for field, value in zip(schema[:index], values):
+            if field == 's':
+                offset += value
+            elif field == 'l':
+                offset += value * LIST_ITEM.size
+
+        field, value = schema[index], values[index]
+        if field == 's':
+            return str(body[offset:offset + value], 'utf-8')
+        elif field == 'l':
+            return [item for (item,) in LIST_ITEM.iter_unpack(
+                body[offset:offset + value * LIST_ITEM.size])]
+        return value
+
+    @staticmethod
+    def decode(body: bytes) -> tuple[int, int, int, list]:
+        (version, packet_type) = (body[1], body[HEADER_SIZE - 1])
+        if version not in VERSION_SCHEMAS:
+            raise ValueError(f"Unsupported binary packet version: {version}")
+        fixed = BinaryCodec.STRUCTS.get((version, packet_type))
+        if fixed is None:
+            raise ValueError(f"Packet type {packet_type} has no binary schema")
+        values = fixed.unpack_from(body, 0)
+
+        payload = []
+        offset = fixed.size
+        for field, value in zip(VERSION_SCHEMAS[version][packet_type], values[5:]):
+            if field == 's':
+                payload.append(str(body[offset:offset + value], 'utf-8'))
+                offset += value
+            elif field == 'l':
+                payload.append([item for (item,) in LIST_ITEM.iter_unpack(
+                    body[offset:offset + value * LIST_ITEM.size])])
+                offset += value * LIST_ITEM.size
+            else:
+                payload.append(value)
+        return values[2], values[3], packet_type, payload
+
+
+def decode_packet_type(body) -> int:
+    """
+    Type of an encoded packet of either codec, read from its header alone
+    """
+    if BinaryCodec.is_binary(body):
+        return body[HEADER_SIZE - 1]
+    return JsonCodec.decode_type(body)
@@ -1,4 +1,3 @@
-import json
 import logging
 
 from common.authors import Authors
@@ -9,16 +8,25 @@ from common.packet_type import PacketType
 from common.review import Review
 from common.review_and_author import ReviewAndAuthor
 from common.packet import Packet
+from common.packet_codec import BinaryCodec, JsonCodec
 
 
 class PacketDecoder:
     @staticmethod
-    def decode(body: str) -> 'Packet':
-        fields = json.loads(body)
-        client_id = fields[0]
-        packet_id = fields[1]
-        packet_type = PacketType(fields[2])
-        packet_payload = fields[3]
+    def decode(body) -> 'Packet':
+        # JSON and binary packets can coexist, binary ones start with a magic byte
+        if BinaryCodec.is_binary(body):
+            client_id, packet_id, packet_type, packet_payload = BinaryCodec.decode(body)
+        else:
+            client_id, packet_id, packet_type, packet_payload = JsonCodec.decode(body)
+        return PacketDecoder.decode_fields(
+            client_id, packet_id, PacketType(packet_type), packet_payload)
+
+    @staticmethod
+    def decode_fields(client_id: int,
+                      packet_id: int,
+                      packet_type: PacketType,
+                      packet_payload: list) -> 'Packet':
         if packet_type == PacketType.BOOK:
             return Book.decode(packet_payload, client_id, packet_id)
         elif packet_type == PacketType.REVIEW:
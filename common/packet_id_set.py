@@ -0,0 +1,107 @@
+import base64
+import json
+import zlib
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+SNAPSHOT_PREFIX = 'bitmap:'
+
+
+class PacketIdSet:
+    """
+    Set of packet ids stored as a chunked bitmap
+
+    Ids are split into chunks of CHUNK_SIZE consecutive ids, each one a
+    bitmap that is only allocated once an id of the chunk is added. Since
+    packet ids are assigned in order, chunks fill up one after the other and
+    full chunks are kept as a single number, so memory grows with the gaps
+    between processed ids rather than with the amount of them.
+    """
+
+    def __init__(self):
+        self._chunks: dict[int, bytearray] = {}
+        self._counts: dict[int, int] = {}
+        self._full: set[int] = set()
+
+    def __contains__(self, packet_id: int) -> bool:
+        high = packet_id >> CHUNK_BITS
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            return high in self._full
+        low = packet_id & CHUNK_MASK
+        return chunk[low >> 3] & (1 << (low & 7)) != 0
+
+    def __len__(self) -> int:
+        return len(self._full) * CHUNK_SIZE + sum(self._counts.values())
+
+    def add(self, packet_id: int):
+        high = packet_id >> CHUNK_BITS
+        if high in self._full:
+            return
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            chunk = self._chunks[high] = bytearray(CHUNK_SIZE // 8)
+            self._counts[high] = 0
+        low = packet_id & CHUNK_MASK
+        bit = 1 << (low & 7)
+        if chunk[low >> 3] & bit:
+            return
+        chunk[low >> 3] |= bit
+        self._counts[high] += 1
+        if self._counts[high] == CHUNK_SIZE:
+            self._chunks.pop(high)
+            self._counts.pop(high)
+            self._full.add(high)
+
+    def update(self, other: 'PacketIdSet'):
+        for high in other._full:
+            self._chunks.pop(high, None)
+            self._counts.pop(high, None)
+            self._full.add(high)
+        for high, chunk in other._chunks.items():
+            if high in self._full:
+                continue
+            current = self._chunks.get(high)
+            if current is None:
+                self._chunks[high] = bytearray(chunk)
+                self._counts[high] = other._counts[high]
+                continue
+            merged = (int.from_bytes(current, 'little') | int.from_bytes(chunk, 'little'))
+            self._chunks[high] = bytearray(merged.to_bytes(len(chunk), 'little'))
+            self._counts[high] = bin(merged).count('1')
+            if self._counts[high] == CHUNK_SIZE:
+                self._chunks.pop(high)
+                self._counts.pop(high)
+                self._full.add(high)
+
+    def to_str(self) -> str:
+        # Sparse bitmaps are mostly zeros, so they compress well
+        chunks = {high: base64.b64encode(zlib.compress(chunk)).decode()
+                  for high, chunk in self._chunks.items()}
+        return SNAPSHOT_PREFIX + json.dumps({'full': sorted(self._full), 'chunks': chunks})
+
+    @staticmethod
+    def from_str(data: str) -> 'PacketIdSet':
+        snapshot = json.loads(data.removeprefix(SNAPSHOT_PREFIX))
+        packet_ids = PacketIdSet()
+        packet_ids._full = set(snapshot['full'])
+        for high, chunk in snapshot['chunks'].items():
+            chunk = bytearray(zlib.decompress(base64.b64decode(chunk)))
+            packet_ids._chunks[int(high)] = chunk
+            packet_ids._counts[int(high)] = bin(int.from_bytes(chunk, 'little')).count('1')
+        return packet_ids
+
+    @staticmethod
+    def from_records(records: list[str]) -> 'PacketIdSet':
+        """
+        Builds the set from persisted records, each one either a single
+        packet id or a snapshot of a whole set
+        """
+        packet_ids = PacketIdSet()
+        for record in records:
+            if record.startswith(SNAPSHOT_PREFIX):
+                packet_ids.update(PacketIdSet.from_str(record))
+            else:
+                packet_ids.add(int(record))
+        return packet_ids
@@ -0,0 +1,73 @@
+from common.packet import NO_TITLE_ID, Packet
+from common.packet_codec import BinaryCodec, JsonCodec
+from common.packet_decoder import PacketDecoder
+from common.packet_type import PacketType
+
+# Name of each payload field, in payload order
+FIELDS = {
+    PacketType.EOF: ['ack_instances'],
+    PacketType.BOOK: ['title', 'description', 'authors', 'publisher', 'year', 'categories'],
+    PacketType.REVIEW: ['book_title', 'score', 'text'],
+    PacketType.BOOK_STATS: ['title', 'score', 'title_id'],
+    PacketType.REVIEW_AND_AUTHOR: ['book_title', 'score', 'text', 'authors', 'title_id'],
+    PacketType.AUTHORS: ['authors'],
+}
+# Value of the fields missing from packets encoded before they were added
+DEFAULTS = {'title_id': NO_TITLE_ID}
+
+
+class PacketView:
+    """
+    Read-only view over an encoded packet
+
+    Only the header is parsed up front, payload fields are decoded on demand.
+    Encoding an unmodified view returns the original body, so pass-through
+    nodes can forward packets without decoding and re-encoding them.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self._payload = None
+        self._packet = None
+        if BinaryCodec.is_binary(body):
+            client_id, packet_id, packet_type = BinaryCodec.decode_header(body)
+        else:
+            client_id, packet_id, packet_type, self._payload = JsonCodec.decode(body)
+        self.client_id = client_id
+        self.packet_id = packet_id
+        self.packet_type = PacketType(packet_type)
+
+    def get(self, field: str):
+        fields = FIELDS.get(self.packet_type, [])
+        if field not in fields:
+            return None
+        index = fields.index(field)
+        if self._payload is not None:
+            value = self._payload[index] if index < len(self._payload) else None
+        else:
+            value = BinaryCodec.decode_field(self.body, index)
+        return DEFAULTS.get(field) if value is None else value
+
+    def decode(self) -> Packet:
+        if self._packet is None:
+            if self._payload is not None:
+                self._packet = PacketDecoder.decode_fields(
+                    self.client_id, self.packet_id, self.packet_type, self._payload)
+            else:
+                self._packet = PacketDecoder.decode(self.body)
+        return self._packet
+
+    def encode(self):
+        return self.body
+
+    @property
+    def trace_id(self) -> str:
+        return f"{self.client_id}-{self.packet_id}"
+
+    def __getattr__(self, name: str):
+        if name in FIELDS.get(self.__dict__.get('packet_type'), []):
+            return self.get(name)
+        raise AttributeError(name)
+
+    def __str__(self):
+        return f"PacketView({self.packet_type.name}, {self.trace_id})"
@@ -0,0 +1,57 @@
+from abc import ABC, abstractmethod
+import hashlib
+import os
+
+PARTITIONER = os.getenv('PARTITIONER', 'hash')
+
+JUMP_MULTIPLIER = 2862933555777941757
+UINT64_MASK = (1 << 64) - 1
+
+
+def stable_hash(key) -> int:
+    # Unlike hash(), this does not depend on the process hash seed,
+    # so every replica maps the same key to the same value
+    digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, byteorder='big')
+
+
+class PartitionerType:
+    HASH = "hash"
+    JUMP = "jump"
+
+
+class Partitioner(ABC):
+    @abstractmethod
+    def partition(self, key, n_partitions: int) -> int:
+        pass
+
+    @staticmethod
+    def from_type(partitioner_type: str = PARTITIONER) -> 'Partitioner':
+        if partitioner_type == PartitionerType.HASH:
+            return HashPartitioner()
+        elif partitioner_type == PartitionerType.JUMP:
+            return JumpHashPartitioner()
+        raise ValueError(f"Unknown partitioner: {partitioner_type}")
+
+
+class HashPartitioner(Partitioner):
+    def partition(self, key, n_partitions: int) -> int:
+        return stable_hash(key) % n_partitions
+
+
+class JumpHashPartitioner(Partitioner):
+    """
+    Jump consistent hash (Lamping & Veach)
+
+    Growing from n to n + 1 partitions only moves ~1/(n + 1) of the keys,
+    all of them to the new partition.
+    """
+
+    def partition(self, key, n_partitions: int) -> int:
+        key = stable_hash(key)
+        bucket, jump = -1, 0
+        while jump < n_partitions:
+            bucket = jump
+            key = (key * JUMP_MULTIPLIER + 1) & UINT64_MASK
+            jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+        return bucket
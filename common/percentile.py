@@ -0,0 +1,108 @@
+import math
+import random
+
+DEFAULT_COMPRESSION = 100
+# Unmerged points kept, relative to the compression, before compressing
+BUFFER_FACTOR = 5
+
+
+def quickselect(values: list[float], k: int) -> float:
+    """
+    Returns the k-th smallest value (0-based) in expected linear time,
+    without sorting the whole list
+    """
+    if not 0 <= k < len(values):
+        raise IndexError(f"Rank {k} out of range for {len(values)} values")
+    while True:
+        pivot = random.choice(values)
+        lows = [value for value in values if value < pivot]
+        if k < len(lows):
+            values = lows
+            continue
+        highs = [value for value in values if value > pivot]
+        pivots = len(values) - len(lows) - len(highs)
+        if k < len(lows) + pivots:
+            return pivot
+        k -= len(lows) + pivots
+        values = highs
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning & Ertl)
+
+    Approximates the distribution of a stream of values with a bounded amount
+    of weighted centroids, smaller towards both tails so extreme quantiles
+    stay accurate.
+    """
+
+    def __init__(self, compression: int = DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means: list[float] = []
+        self.weights: list[float] = []
+        self.count = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer: list[tuple[float, float]] = []
+
+    def __len__(self) -> int:
+        return int(self.count)
+
+    def add(self, value: float, weight: float = 1.0):
+        self._buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= BUFFER_FACTOR * self.compression:
+            self._compress()
+
+    def quantile(self, q: float) -> float:
+        self._compress()
+        if not self.means:
+            raise ValueError("Quantile of an empty digest")
+        if len(self.means) == 1:
+            return self.means[0]
+
+        # Each centroid's mean sits at the middle of its weight, values are
+        # interpolated linearly between neighbouring centers
+        target = q * self.count
+        cumulative = 0.0
+        previous_center, previous_mean = 0.0, self.min
+        for mean, weight in zip(self.means, self.weights):
+            center = cumulative + weight / 2
+            if target < center:
+                fraction = (target - previous_center) / (center - previous_center)
+                return previous_mean + fraction * (mean - previous_mean)
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        if self.count == previous_center:
+            return self.max
+        fraction = (target - previous_center) / (self.count - previous_center)
+        return previous_mean + min(fraction, 1.0) * (self.max - previous_mean)
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        centroids = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        self.means, self.weights = [], []
+
+        (current_mean, current_weight) = centroids[0]
+        merged_weight = 0.0
+        k_lower = self._k(0.0)
+        for mean, weight in centroids[1:]:
+            q = (merged_weight + current_weight + weight) / self.count
+            if self._k(q) - k_lower <= 1:
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                self.means.append(current_mean)
+                self.weights.append(current_weight)
+                merged_weight += current_weight
+                k_lower = self._k(merged_weight / self.count)
+                (current_mean, current_weight) = (mean, weight)
+        self.means.append(current_mean)
+        self.weights.append(current_weight)
@@ -2,10 +2,19 @@ import os
 import logging
 import uuid
 import json
+from typing import Callable, Iterator
 
 KEYS_INDEX_KEY_PREFIX = 'keys_index_'
 LENGTH_BYTES = 6
 TEMP_FILE = '_temp'
+COMPACTION_BYTES = int(os.getenv('PERSISTENCE_COMPACTION_BYTES', str(1024 * 1024)))
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND')
+
+
+class PersistenceBackend:
+    FILES = "files"
+    WAL = "wal"
+    SQLITE = "sqlite"
 
 
 class PersistenceManager:
@@ -15,8 +24,28 @@ class PersistenceManager:
             os.makedirs(storage_path)
         self.storage_path = storage_path
         self._keys_index: dict[str, dict[str, str]] = {}
+        self._compactors: dict[str, Callable[[list[str]], list[str]]] = {}
+        self._log_sizes: dict[tuple[str, str], int] = {}
+        self._compacted_sizes: dict[tuple[str, str], int] = {}
         self._init_state()
 
+    @staticmethod
+    def from_backend(storage_path: str, default: str = PersistenceBackend.FILES) -> 'PersistenceManager':
+        """
+        Creates the PersistenceManager of the backend set in
+        PERSISTENCE_BACKEND, or of the given default if it is not set
+        """
+        backend = PERSISTENCE_BACKEND or default
+        if backend == PersistenceBackend.FILES:
+            return PersistenceManager(storage_path)
+        elif backend == PersistenceBackend.WAL:
+            from common.wal_persistence_manager import WalPersistenceManager
+            return WalPersistenceManager(storage_path)
+        elif backend == PersistenceBackend.SQLITE:
+            from common.sqlite_persistence_manager import SqlitePersistenceManager
+            return SqlitePersistenceManager(storage_path)
+        raise ValueError(f"Unknown persistence backend: {backend}")
+
     def _append(self, path, data: str):
         try:
             logging.debug(f"Appending to {path}")
@@ -27,8 +56,10 @@ class PersistenceManager:
             with open(path, 'ab') as f:
                 f.write(length_bytes + data)
                 f.flush()
+            return len(length_bytes) + len(data)
         except Exception as e:
             logging.error(f"Error appending to {path}: {e}")
+            return 0
 
     def _write(self, path, data: str):
         try:
@@ -45,20 +76,21 @@ class PersistenceManager:
         except Exception as e:
             logging.error(f"Error writing to {path}: {e}")
 
+    def _read_records(self, path):
+        logging.debug(f"Reading from {path}")
+        with open(path, 'rb') as f:
+            while (length := f.read(LENGTH_BYTES)):
+                length = int.from_bytes(length, byteorder='big')
+                content = f.readline()
+                if len(content) == length:
+                    yield content.decode('unicode_escape')
+                else:
+                    logging.error(f"Corrupted data in {path} expected {length} bytes, got {len(content)} bytes")
+                    logging.error(f"Content: {content}")
+
     def _read(self, path):
         try:
-            logging.debug(f"Reading from {path}")
-            with open(path, 'rb') as f:
-                data = ''
-                while (length := f.read(LENGTH_BYTES)):
-                    length = int.from_bytes(length, byteorder='big')
-                    content = f.readline()
-                    if len(content) == length:
-                        data += content.decode('unicode_escape')
-                    else:
-                        logging.error(f"Corrupted data in {path} expected {length} bytes, got {len(content)} bytes")
-                        logging.error(f"Content: {content}")
-                return data
+            return ''.join(self._read_records(path))
         except OSError as e:
             if e.errno == 2:  # File not found
                 return ''
@@ -85,14 +117,77 @@ class PersistenceManager:
         path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
         return self._read(path).removesuffix('\n')
 
+    def get_records(self, key: str, secondary_key: str = 'default') -> Iterator[str]:
+        """
+        Yields the values put or appended to key one at a time, instead of
+        reading all of them at once
+        """
+        if key not in self._keys_index.get(secondary_key, {}):
+            return
+        path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
+        try:
+            for record in self._read_records(path):
+                yield record.removesuffix('\n')
+        except OSError as e:
+            if e.errno != 2:  # File not found
+                logging.error(f"Error reading from {path}: {e}")
+
     def append(self, key: str, value: str, secondary_key: str = 'default'):
         try:
             path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
             logging.debug(f"Appending value: {value} for key: {key}")
-            self._append(path, value)
+            written = self._append(path, value)
+            self._maybe_compact(key, secondary_key, written)
         except Exception as e:
             logging.error(f"Error appending value: {value} for key: {key}: {e}")
 
+    def register_compactor(self, prefix: str, compactor: Callable[[list[str]], list[str]]):
+        """
+        Registers a function that, given every value appended to a key
+        starting with prefix, returns an equivalent and smaller list of values.
+        Once the log of such a key grows past COMPACTION_BYTES (and doubles
+        its size since the last compaction) it is replaced by its snapshot.
+        """
+        self._compactors[prefix] = compactor
+
+    def _get_compactor(self, key: str):
+        for prefix, compactor in self._compactors.items():
+            if key.startswith(prefix):
+                return compactor
+        return None
+
+    def _maybe_compact(self, key: str, secondary_key: str, written: int):
+        if self._get_compactor(key) is None:
+            return
+        if (secondary_key, key) in self._log_sizes:
+            self._log_sizes[(secondary_key, key)] += written
+        else:
+            self._log_sizes[(secondary_key, key)] = self._stored_size(key, secondary_key)
+
+        threshold = max(COMPACTION_BYTES, 2 * self._compacted_sizes.get((secondary_key, key), 0))
+        if self._log_sizes[(secondary_key, key)] >= threshold:
+            self.compact(key, secondary_key)
+
+    def _stored_size(self, key: str, secondary_key: str) -> int:
+        return os.path.getsize(f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}')
+
+    def _compacted(self, key: str, secondary_key: str):
+        size = self._stored_size(key, secondary_key)
+        self._log_sizes[(secondary_key, key)] = size
+        self._compacted_sizes[(secondary_key, key)] = size
+
+    def compact(self, key: str, secondary_key: str = 'default'):
+        compactor = self._get_compactor(key)
+        if compactor is None or key not in self._keys_index.get(secondary_key, {}):
+            return
+        path = f'{self.storage_path}/{self._get_internal_key(key, secondary_key)}'
+        values = self.get(key, secondary_key).splitlines()
+        snapshot = compactor(values)
+        # The whole snapshot is written as a single record, replacing the log
+        self._write(path, '\n'.join(snapshot))
+        self._compacted(key, secondary_key)
+        logging.debug(f"Compacted key: {key} from {len(values)} to {len(snapshot)} values")
+
     def get_keys(self, prefix='', secondary_key: str = None) -> list[tuple[str, str]]:
         try:
             logging.debug(f"Getting keys with prefix: {prefix}, secondary_key: {secondary_key}")
@@ -111,6 +206,8 @@ class PersistenceManager:
             for (key, secondary_key) in keys_to_delete:
                 path = f'{self.storage_path}/{self._keys_index[secondary_key][key]}'
                 self._delete(path)
+                self._log_sizes.pop((secondary_key, key), None)
+                self._compacted_sizes.pop((secondary_key, key), None)
                 self._keys_index[secondary_key].pop(key)
                 logging.debug(f"Deleted key: {key}")
             new_keys = [json.dumps([key, value]) for key, value in self._keys_index[secondary_key].items()]
@@ -121,6 +218,10 @@ class PersistenceManager:
         except Exception as e:
             logging.error(f"Error deleting keys by prefix: {prefix}: {e}")
 
+    def flush(self):
+        # Every operation is written as soon as it happens
+        pass
+
     def _get_internal_key(self, key: str, secondary_key: str = 'default') -> str:
         internal_key = self._keys_index.get(secondary_key, {}).get(key)
         if internal_key is None:
@@ -1,20 +1,22 @@
 import socket
 
-MAX_READ_SIZE = 1024
 
-
-def receive_exact(s: socket.socket, length: int) -> bytes:
-    data = b''
-    while len(data) < length:
-        bytes_remaining = length - len(data)
+def receive_exact_into(s: socket.socket, view: memoryview):
+    received = 0
+    while received < len(view):
         try:
-            new_data = s.recv(min(MAX_READ_SIZE, bytes_remaining))
+            new_bytes = s.recv_into(view[received:])
         except socket.timeout:
             raise EOFError("Timeout while reading data")
-        if not new_data:
+        if new_bytes == 0:
             raise EOFError("EOF reached while reading data")
-        data += new_data
-    return data
+        received += new_bytes
+
+
+def receive_exact(s: socket.socket, length: int) -> bytes:
+    data = bytearray(length)
+    receive_exact_into(s, memoryview(data))
+    return bytes(data)
 
 
 def receive_line(s: socket.socket, length_bytes: int) -> bytes:
@@ -22,3 +24,17 @@ def receive_line(s: socket.socket, length_bytes: int) -> bytes:
     length = int.from_bytes(length_as_bytes, byteorder='big')
     data = receive_exact(s, length)
     return data
+
+
+def receive_chunk(s: socket.socket, length_bytes: int, buffer: bytearray) -> memoryview:
+    """
+    Receives a length-prefixed chunk into buffer, which grows to fit it.
+    The returned view must be released before receiving the next chunk.
+    """
+    length_as_bytes = receive_exact(s, length_bytes)
+    length = int.from_bytes(length_as_bytes, byteorder='big')
+    if length > len(buffer):
+        buffer.extend(bytes(length - len(buffer)))
+    view = memoryview(buffer)[:length]
+    receive_exact_into(s, view)
+    return view
@@ -18,18 +18,30 @@ class ResultPacket(Packet):
 
     @property
     def payload(self) -> list:
-        return [self.query, self.result.encode()]
-
-    def encode(self) -> str:
-        encoded_res = json.dumps([self.query, self.result.encode()])
+        return [self.query, self.result.to_json()]
+
+    def encode(self) -> bytes:
+        # Clients always receive JSON results, regardless of the packet codec.
+        # The fields of the result are inlined, [query, client_id, packet_id,
+        # packet_type, payload], instead of nesting its JSON as a string
+        encoded_res = json.dumps([self.query,
+                                  self.result.client_id,
+                                  self.result.packet_id,
+                                  self.result.packet_type.value,
+                                  self.result.payload]).encode()
         length = len(encoded_res).to_bytes(LENGTH_BYTES, byteorder='big')
-        return length + encoded_res.encode()
+        return length + encoded_res
 
     @staticmethod
     def decode(data: str) -> 'ResultPacket':
         fields = json.loads(data)
         query = int(fields[0])
-        result = PacketDecoder().decode(fields[1])
+        if len(fields) == 2:
+            # [query, result JSON], as sent by earlier output gateways
+            result = PacketDecoder().decode(fields[1])
+        else:
+            (client_id, packet_id, packet_type, payload) = fields[1:]
+            result = PacketDecoder.decode_fields(client_id, packet_id, PacketType(packet_type), payload)
         return ResultPacket(query, result)
 
     def __str__(self):
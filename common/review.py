@@ -3,6 +3,9 @@ import csv
 from common.packet_type import PacketType
 from common.packet import Packet
 
+# Columns of a row of the reviews file
+CSV_FIELDS = 10
+
 
 class Review(Packet):
     def __init__(self,
@@ -26,10 +29,20 @@ class Review(Packet):
 
     @staticmethod
     def from_csv_row(csv_row: str, client_id: int, packet_id: int) -> 'Review':
-        # Id,Title,Price,User_id,profileName,review/helpfulness,review/score,review/time,review/summary,review/text
         fields = list(csv.reader([csv_row]))[0]
+        return Review.from_csv_fields(fields, client_id, packet_id)
+
+    @staticmethod
+    def from_csv_fields(fields: list[str], client_id: int, packet_id: int) -> 'Review':
+        # Id,Title,Price,User_id,profileName,review/helpfulness,review/score,review/time,review/summary,review/text
+        # Malformed rows are skipped, like rows missing a field
+        if len(fields) < CSV_FIELDS:
+            return None
         title = fields[1].strip()
-        score = float(fields[6].strip())
+        try:
+            score = float(fields[6].strip())
+        except ValueError:
+            return None
         text = fields[9].strip()
 
         return Review(title, score, text, client_id, packet_id)
@@ -43,4 +56,4 @@ class Review(Packet):
         return Review(title, score, text, client_id, packet_id)
 
     def __str__(self):
-        return self.encode()
+        return self.to_json()
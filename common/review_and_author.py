@@ -1,4 +1,4 @@
-from common.packet import Packet
+from common.packet import NO_TITLE_ID, Packet
 from common.packet_type import PacketType
 
 
@@ -9,12 +9,16 @@ class ReviewAndAuthor(Packet):
                  text: str,
                  authors: str,
                  client_id: int,
-                 packet_id: int):
+                 packet_id: int,
+                 title_id: int = NO_TITLE_ID):
         super().__init__(client_id, packet_id)
+        # The title and authors of a book are only sent with its first
+        # review, the rest of them only carry its title_id
         self.book_title = book_title
         self.score = score
         self.text = text
         self.authors = authors
+        self.title_id = title_id
 
     @property
     def packet_type(self):
@@ -22,7 +26,7 @@ class ReviewAndAuthor(Packet):
 
     @property
     def payload(self):
-        return [self.book_title, self.score, self.text, self.authors]
+        return [self.book_title, self.score, self.text, self.authors, self.title_id]
 
     @staticmethod
     def decode(
@@ -32,5 +36,6 @@ class ReviewAndAuthor(Packet):
         score = fields[1]
         text = fields[2]
         authors = fields[3]
+        title_id = fields[4] if len(fields) > 4 else NO_TITLE_ID
         return ReviewAndAuthor(
-            title, score, text, authors, client_id, packet_id)
+            title, score, text, authors, client_id, packet_id, title_id)
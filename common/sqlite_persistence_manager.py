@@ -0,0 +1,115 @@
+import logging
+import sqlite3
+
+from common.persistence_manager import PersistenceManager
+from common.wal_persistence_manager import FSYNC
+
+DATABASE_FILE = 'store.db'
+# Sorts after every character a key can hold, so [prefix, prefix + PREFIX_END)
+# is the range of keys starting with prefix
+PREFIX_END = '\U0010ffff'
+
+
+class SqlitePersistenceManager(PersistenceManager):
+    """
+    PersistenceManager backed by a single SQLite database
+
+    Every value is a row of one table indexed by (secondary_key, key), so
+    the number of files does not grow with the number of keys and deleting
+    every key with a prefix is a single range delete. Operations are grouped
+    into a transaction only committed on flush(), so the Middleware decides
+    when the state is durable: after the outputs it depends on were
+    published.
+    """
+
+    def __init__(self, storage_path='./'):
+        self._connection = None
+        self._pending = 0
+        super().__init__(storage_path)
+
+    def put(self, key: str, value: str, secondary_key: str = 'default'):
+        logging.debug(f"Putting value: {value} for key: {key}")
+        self._connection.execute('DELETE FROM entries WHERE secondary_key = ? AND key = ?', (secondary_key, key))
+        self._connection.execute('INSERT INTO entries VALUES (?, ?, ?)', (secondary_key, key, value))
+        self._operation_done()
+
+    def get(self, key: str, secondary_key: str = 'default') -> str:
+        rows = self._connection.execute(
+            'SELECT value FROM entries WHERE secondary_key = ? AND key = ? ORDER BY rowid',
+            (secondary_key, key))
+        return '\n'.join(value for (value,) in rows)
+
+    def get_records(self, key: str, secondary_key: str = 'default'):
+        rows = self._connection.execute(
+            'SELECT value FROM entries WHERE secondary_key = ? AND key = ? ORDER BY rowid',
+            (secondary_key, key))
+        for (value,) in rows:
+            yield value
+
+    def append(self, key: str, value: str, secondary_key: str = 'default'):
+        logging.debug(f"Appending value: {value} for key: {key}")
+        self._connection.execute('INSERT INTO entries VALUES (?, ?, ?)', (secondary_key, key, value))
+        self._operation_done()
+        self._maybe_compact(key, secondary_key, len(value))
+
+    def compact(self, key: str, secondary_key: str = 'default'):
+        compactor = self._get_compactor(key)
+        if compactor is None:
+            return
+        values = self.get(key, secondary_key).splitlines()
+        snapshot = compactor(values)
+        # Both statements are part of the same transaction, the key is never seen empty
+        self._connection.execute('DELETE FROM entries WHERE secondary_key = ? AND key = ?', (secondary_key, key))
+        self._connection.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                                     [(secondary_key, key, value) for value in snapshot])
+        self._operation_done()
+        self._compacted(key, secondary_key)
+        logging.debug(f"Compacted key: {key} from {len(values)} to {len(snapshot)} values")
+
+    def get_keys(self, prefix='', secondary_key: str = None) -> list[tuple[str, str]]:
+        logging.debug(f"Getting keys with prefix: {prefix}, secondary_key: {secondary_key}")
+        query = 'SELECT DISTINCT key, secondary_key FROM entries WHERE key >= ? AND key < ?'
+        params = (prefix, prefix + PREFIX_END)
+        if secondary_key:
+            query += ' AND secondary_key = ?'
+            params += (secondary_key,)
+        return [(key, _secondary_key) for (key, _secondary_key) in self._connection.execute(query, params)]
+
+    def delete_keys(self, prefix: str = '', secondary_key: str = 'default'):
+        logging.debug(f"Deleting keys by prefix: {prefix}, secondary_key: {secondary_key}")
+        self._connection.execute('DELETE FROM entries WHERE secondary_key = ? AND key >= ? AND key < ?',
+                                 (secondary_key, prefix, prefix + PREFIX_END))
+        self._operation_done()
+        for (_secondary_key, key) in [entry for entry in self._log_sizes
+                                      if entry[0] == secondary_key and entry[1].startswith(prefix)]:
+            self._log_sizes.pop((_secondary_key, key), None)
+            self._compacted_sizes.pop((_secondary_key, key), None)
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._pending = 0
+        try:
+            self._connection.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Error committing to database: {e}")
+
+    def _operation_done(self):
+        self._pending += 1
+
+    def _stored_size(self, key: str, secondary_key: str) -> int:
+        (size,) = self._connection.execute(
+            'SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries WHERE secondary_key = ? AND key = ?',
+            (secondary_key, key)).fetchone()
+        return size
+
+    def _init_state(self):
+        self._connection = sqlite3.connect(f'{self.storage_path}/{DATABASE_FILE}', check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute(f'PRAGMA synchronous = {"FULL" if FSYNC else "OFF"}')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries (secondary_key TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL)')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS entries_by_key ON entries (secondary_key, key)')
+        self._connection.commit()
+        logging.debug(f"Opened database at {self.storage_path}/{DATABASE_FILE}")
@@ -0,0 +1,61 @@
+import heapq
+import json
+
+from common.book_stats import BookStats
+
+
+class TopK:
+    """
+    The k best scored BookStats of a stream
+
+    Kept as a min-heap of (score, packet_id, title) entries, so the worst
+    kept entry is replaced in O(log k).
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self._heap: list[tuple[float, int, str]] = []
+        self._packet_ids: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def add(self, book_stats: BookStats) -> bool:
+        """
+        Returns whether the top-K changed. A packet that is already kept
+        (redelivered before it was acknowledged) is ignored.
+        """
+        return self._add((book_stats.score, book_stats.packet_id, book_stats.title))
+
+    def _add(self, entry: tuple[float, int, str]) -> bool:
+        (score, packet_id, _) = entry
+        if packet_id in self._packet_ids:
+            return False
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif self._heap[0][0] < score:
+            (_, replaced_packet_id, _) = heapq.heapreplace(self._heap, entry)
+            self._packet_ids.discard(replaced_packet_id)
+        else:
+            return False
+        self._packet_ids.add(packet_id)
+        return True
+
+    def items(self, client_id: int) -> list[BookStats]:
+        """
+        Kept entries from the best to the worst scored
+        """
+        return [BookStats(title, score, client_id, packet_id)
+                for (score, packet_id, title) in sorted(self._heap, reverse=True)]
+
+    def to_str(self) -> str:
+        return json.dumps([[title, score, packet_id] for (score, packet_id, title) in self._heap])
+
+    @staticmethod
+    def from_str(data: str, k: int) -> 'TopK':
+        top_k = TopK(k)
+        for [title, score, packet_id] in json.loads(data):
+            top_k._heap.append((score, packet_id, title))
+            top_k._packet_ids.add(packet_id)
+        heapq.heapify(top_k._heap)
+        return top_k
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+
+from common.persistence_manager import LENGTH_BYTES, TEMP_FILE, PersistenceManager
+
+WAL_FILE = 'wal'
+CHECKPOINT_FILE = 'checkpoint'
+CHECKPOINT_BYTES = int(os.getenv('PERSISTENCE_CHECKPOINT_BYTES', str(64 * 1024 * 1024)))
+FSYNC = os.getenv('PERSISTENCE_FSYNC', '1') == '1'
+
+PUT_OP = 'p'
+APPEND_OP = 'a'
+DELETE_OP = 'd'
+
+
+class WalPersistenceManager(PersistenceManager):
+    """
+    PersistenceManager backed by a single append-only write-ahead log
+
+    The whole state lives in memory. Every operation is buffered as a log
+    record and written with one write (and fsync) per group commit, which
+    only happens on flush(), so the Middleware decides when the state is
+    durable: after the outputs it depends on were published. When the
+    log grows past CHECKPOINT_BYTES the state is snapshotted into a
+    checkpoint and the log is truncated, so recovery loads the checkpoint
+    and replays only the tail of the log.
+    """
+
+    def __init__(self, storage_path='./'):
+        self._values: dict[str, dict[str, list[str]]] = {}
+        self._pending: list[bytes] = []
+        self._lsn = 0
+        self._wal_size = 0
+        self._wal_file = None
+        super().__init__(storage_path)
+
+    def put(self, key: str, value: str, secondary_key: str = 'default'):
+        logging.debug(f"Putting value: {value} for key: {key}")
+        self._values.setdefault(secondary_key, {})[key] = [value]
+        self._log(PUT_OP, secondary_key, key, value)
+
+    def get(self, key: str, secondary_key: str = 'default') -> str:
+        return '\n'.join(self._values.get(secondary_key, {}).get(key, []))
+
+    def get_records(self, key: str, secondary_key: str = 'default'):
+        yield from list(self._values.get(secondary_key, {}).get(key, []))
+
+    def append(self, key: str, value: str, secondary_key: str = 'default'):
+        logging.debug(f"Appending value: {value} for key: {key}")
+        self._values.setdefault(secondary_key, {}).setdefault(key, []).append(value)
+        self._log(APPEND_OP, secondary_key, key, value)
+
+    def get_keys(self, prefix='', secondary_key: str = None) -> list[tuple[str, str]]:
+        keys = []
+        for _secondary_key in [secondary_key] if secondary_key else self._values.keys():
+            keys.extend([(key, _secondary_key) for key in self._values.get(_secondary_key, {})
+                         if key.startswith(prefix)])
+        return keys
+
+    def delete_keys(self, prefix: str = '', secondary_key: str = 'default'):
+        logging.debug(f"Deleting keys by prefix: {prefix}, secondary_key: {secondary_key}")
+        self._delete_prefix(prefix, secondary_key)
+        self._log(DELETE_OP, secondary_key, prefix, None)
+
+    def flush(self):
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._pending = []
+        try:
+            self._wal_file.write(data)
+            self._wal_file.flush()
+            if FSYNC:
+                os.fsync(self._wal_file.fileno())
+            self._wal_size += len(data)
+        except Exception as e:
+            logging.error(f"Error writing to write-ahead log: {e}")
+            return
+
+        if self._wal_size >= CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def compact(self, key: str, secondary_key: str = 'default'):
+        compactor = self._get_compactor(key)
+        values = self._values.get(secondary_key, {}).get(key)
+        if compactor is not None and values is not None:
+            self._values[secondary_key][key] = compactor(values)
+
+    def checkpoint(self):
+        self.flush()
+        # Compacted values only need to be consistent with the checkpoint,
+        # the log they replace is truncated right after it is written
+        for (key, secondary_key) in self.get_keys():
+            self.compact(key, secondary_key)
+        logging.debug(f"Checkpointing state at lsn {self._lsn}")
+        data = json.dumps({'lsn': self._lsn, 'values': self._values})
+        try:
+            temp_path = f'{self.storage_path}/{TEMP_FILE}'
+            with open(temp_path, 'wb') as f:
+                f.write(self._frame(data))
+                f.flush()
+                if FSYNC:
+                    os.fsync(f.fileno())
+            os.replace(temp_path, f'{self.storage_path}/{CHECKPOINT_FILE}')
+        except Exception as e:
+            logging.error(f"Error writing checkpoint: {e}")
+            return
+
+        # Every record in the log is now part of the checkpoint
+        self._wal_file.close()
+        self._wal_file = open(f'{self.storage_path}/{WAL_FILE}', 'wb')
+        self._wal_size = 0
+
+    def _log(self, op: str, secondary_key: str, key: str, value):
+        self._lsn += 1
+        self._pending.append(self._frame(json.dumps([self._lsn, op, secondary_key, key, value])))
+
+    def _frame(self, data: str) -> bytes:
+        data = data.encode('unicode_escape') + b'\n'
+        return len(data).to_bytes(LENGTH_BYTES, byteorder='big') + data
+
+    def _delete_prefix(self, prefix: str, secondary_key: str):
+        keys = self._values.get(secondary_key, {})
+        for key in [key for key in keys if key.startswith(prefix)]:
+            keys.pop(key)
+        if not keys:
+            self._values.pop(secondary_key, None)
+
+    def _read_records(self, path):
+        try:
+            yield from super()._read_records(path)
+        except FileNotFoundError:
+            return
+
+    def _init_state(self):
+        for data in self._read_records(f'{self.storage_path}/{CHECKPOINT_FILE}'):
+            checkpoint = json.loads(data)
+            self._lsn = checkpoint['lsn']
+            self._values = checkpoint['values']
+
+        replayed = 0
+        for data in self._read_records(f'{self.storage_path}/{WAL_FILE}'):
+            [lsn, op, secondary_key, key, value] = json.loads(data)
+            # Records older than the checkpoint are already part of it
+            if lsn <= self._lsn:
+                continue
+            self._lsn = lsn
+            replayed += 1
+            if op == PUT_OP:
+                self._values.setdefault(secondary_key, {})[key] = [value]
+            elif op == APPEND_OP:
+                self._values.setdefault(secondary_key, {}).setdefault(key, []).append(value)
+            elif op == DELETE_OP:
+                self._delete_prefix(key, secondary_key)
+
+        self._wal_file = open(f'{self.storage_path}/{WAL_FILE}', 'ab')
+        self._wal_size = self._wal_file.tell()
+        # Start from a clean log, so a torn record at the end of the
+        # previous one can not corrupt the records appended after it
+        if replayed or self._wal_size:
+            self.checkpoint()
+        logging.info(f"Initialized write-ahead log at lsn {self._lsn}, replayed {replayed} records")
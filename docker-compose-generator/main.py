@@ -47,6 +47,14 @@ def initialize_config():
         config["CONTAINERS"]["1990_1999_REVIEWS_STATS_ROUTER_BY_TITLE"])
     config_params["fiction_review_sentiment_analyzer"] = int(
         config["CONTAINERS"]["FICTION_REVIEW_SENTIMENT_ANALYZER"])
+    config_params["fiction_review_sentiment_router_by_title"] = config["CONTAINERS"].getint(
+        "FICTION_REVIEW_SENTIMENT_ROUTER_BY_TITLE", fallback=1)
+    config_params["fiction_review_sentiment_aggregator"] = config["CONTAINERS"].getint(
+        "FICTION_REVIEW_SENTIMENT_AGGREGATOR", fallback=1)
+    config_params["top_books_router_by_title"] = config["CONTAINERS"].getint(
+        "TOP_BOOKS_ROUTER_BY_TITLE", fallback=1)
+    config_params["review_mean_aggregator"] = config["CONTAINERS"].getint(
+        "REVIEW_MEAN_AGGREGATOR", fallback=1)
     config_params["docktor"] = int(
         config["CONTAINERS"]["DOCKTOR"])
 
@@ -1,5 +1,20 @@
 import json
 
+MIDDLEWARE_BATCH_SIZE = 100
+PACKET_CODEC = "binary"
+MIDDLEWARE_GROUP_COMMIT_SIZE = 10
+# Opt-in: 1 makes every publish wait for the broker to confirm it, at the
+# cost of a round trip per message
+MIDDLEWARE_PUBLISHER_CONFIRMS = 0
+MIDDLEWARE_PREFETCH_COUNT = 100
+SENTIMENT_WORKERS = 4
+SENTIMENT_ENGINE = "lexicon"
+PERCENTILE_MODE = "exact"
+INPUT_GATEWAY_PUBLISHERS = 2
+INPUT_GATEWAY_MAX_CONCURRENT_CONNECTIONS = 5
+# "threads" serves each client from a thread, "asyncio" all of them from a loop
+GATEWAY_SERVER_MODE = "threads"
+
 
 class ConfigGenerator:
     def __init__(self, config_params):
@@ -88,7 +103,7 @@ class ConfigGenerator:
 
         self._generate_router(
             "1990_1999_review_stats_router_by_title",
-            "book_title",
+            "title_id",
             self.config_params["1990_1999_reviews_stats_router_by_title"],
             self.config_params["review_stats_service"],
             {"1990_1999_reviews": ""},
@@ -105,7 +120,9 @@ class ConfigGenerator:
                           input_queues: dict[str, str] = None,
                           output_queues: list[str] = None,
                           output_exchanges: list[str] = None,
-                          instances: int = 1):
+                          instances: int = 1,
+                          prefetch_count: int = MIDDLEWARE_PREFETCH_COUNT,
+                          adaptive_prefetch: bool = False):
         if volumes is None:
             volumes = []
         volumes.append("storage:/storage")
@@ -114,7 +131,13 @@ class ConfigGenerator:
             service_name_instance = f"{service_name}{instance_suffix}"
             current_environment = ["PYTHONUNBUFFERED=1",
                                    "LOGGING_LEVEL=INFO",
-                                   "PYTHONHASHSEED=1234"]
+                                   "PYTHONHASHSEED=1234",
+                                   f"MIDDLEWARE_BATCH_SIZE={MIDDLEWARE_BATCH_SIZE}",
+                                   f"PACKET_CODEC={PACKET_CODEC}",
+                                   f"MIDDLEWARE_GROUP_COMMIT_SIZE={MIDDLEWARE_GROUP_COMMIT_SIZE}",
+                                   f"MIDDLEWARE_PUBLISHER_CONFIRMS={MIDDLEWARE_PUBLISHER_CONFIRMS}",
+                                   f"MIDDLEWARE_PREFETCH_COUNT={prefetch_count}",
+                                   f"MIDDLEWARE_ADAPTIVE_PREFETCH={int(adaptive_prefetch)}"]
             current_environment.extend(environment)
             current_environment.append(f"INSTANCE_ID={instance_id}")
             current_environment.append(f"CLUSTER_SIZE={instances}")
@@ -270,7 +293,8 @@ class ConfigGenerator:
             input_queues=input_queues,
             output_queues=output_queues,
             output_exchanges=[],
-            instances=instances
+            instances=instances,
+            prefetch_count=500
         )
 
     def _generate_client(self):
@@ -296,6 +320,9 @@ class ConfigGenerator:
              "SERVER_LISTEN_BACKLOG=1",
              "BOOKS_EXCHANGE=books",
              "REVIEWS_EXCHANGE=reviews",
+             f"PUBLISHERS={INPUT_GATEWAY_PUBLISHERS}",
+             f"MAX_CONCURRENT_CONNECTIONS={INPUT_GATEWAY_MAX_CONCURRENT_CONNECTIONS}",
+             f"SERVER_MODE={GATEWAY_SERVER_MODE}",
              ],
             ["test_net"],
             output_exchanges=output_exchanges
@@ -314,7 +341,8 @@ class ConfigGenerator:
             "output_gateway:latest",
             ["SERVER_PORT=12345",
              "SERVER_LISTEN_BACKLOG=1",
-             f"RESULT_QUEUES={result_queues}"],
+             f"RESULT_QUEUES={result_queues}",
+             f"SERVER_MODE={GATEWAY_SERVER_MODE}"],
             ["test_net"],
         )
 
@@ -335,30 +363,97 @@ class ConfigGenerator:
         self._generate_service(
             "fiction_review_sentiment_analyzer",
             "sentiment_analyzer:latest",
-            [],
+            [f"SENTIMENT_WORKERS={SENTIMENT_WORKERS}",
+             f"SENTIMENT_ENGINE={SENTIMENT_ENGINE}"],
             ["test_net"],
             input_queues={"fiction_reviews": ""},
             output_queues=["fiction_reviews_sentiment_scores"],
-            instances=instances
+            instances=instances,
+            prefetch_count=20,
+            adaptive_prefetch=True
         )
 
     def _generate_sentiment_aggregator(self):
+        instances = self.config_params["fiction_review_sentiment_aggregator"]
+        if instances == 1:
+            self._generate_service(
+                "fiction_review_sentiment_aggregator",
+                "sentiment_aggregator:latest",
+                ["SENTIMENT_AGGREGATOR_ROLE=single",
+                 f"PERCENTILE_MODE={PERCENTILE_MODE}"],
+                ["test_net"],
+                input_queues={"fiction_reviews_sentiment_scores": ""},
+                output_queues=["query5_result"],
+            )
+            return
+
+        # Reviews are aggregated by title across the partial instances, the
+        # percentile is then computed over the averages they send
+        self._generate_router(
+            "fiction_review_sentiment_router_by_title",
+            "title_id",
+            self.config_params["fiction_review_sentiment_router_by_title"],
+            instances,
+            {"fiction_reviews_sentiment_scores": ""},
+            ["fiction_reviews_sentiment_scores_by_title"]
+        )
         self._generate_service(
             "fiction_review_sentiment_aggregator",
             "sentiment_aggregator:latest",
-            [],
+            ["SENTIMENT_AGGREGATOR_ROLE=partial"],
+            ["test_net"],
+            input_queues={"fiction_reviews_sentiment_scores_by_title": ""},
+            output_queues=["fiction_books_sentiment"],
+            instances=instances
+        )
+        self._generate_service(
+            "fiction_review_sentiment_merger",
+            "sentiment_aggregator:latest",
+            ["SENTIMENT_AGGREGATOR_ROLE=merge",
+             f"PERCENTILE_MODE={PERCENTILE_MODE}"],
             ["test_net"],
-            input_queues={"fiction_reviews_sentiment_scores": ""},
+            input_queues={"fiction_books_sentiment": ""},
             output_queues=["query5_result"],
         )
 
     def _generate_review_mean_aggregator(self):
+        instances = self.config_params["review_mean_aggregator"]
+        if instances == 1:
+            self._generate_service(
+                "review_mean_aggregator",
+                "review_mean_aggregator:latest",
+                ["REVIEW_MEAN_AGGREGATOR_ROLE=single"],
+                ["test_net"],
+                input_queues={"top_10_books": ""},
+                output_queues=["query4_result"],
+            )
+            return
+
+        # Each partial instance keeps the top books of its share of the
+        # titles, the merger keeps the top books among theirs
+        self._generate_router(
+            "top_books_router_by_title",
+            "title",
+            self.config_params["top_books_router_by_title"],
+            instances,
+            {"top_10_books": ""},
+            ["top_10_books_by_title"]
+        )
         self._generate_service(
             "review_mean_aggregator",
             "review_mean_aggregator:latest",
-            [],
+            ["REVIEW_MEAN_AGGREGATOR_ROLE=partial"],
+            ["test_net"],
+            input_queues={"top_10_books_by_title": ""},
+            output_queues=["top_books_partial"],
+            instances=instances
+        )
+        self._generate_service(
+            "review_mean_merger",
+            "review_mean_aggregator:latest",
+            ["REVIEW_MEAN_AGGREGATOR_ROLE=merge"],
             ["test_net"],
-            input_queues={"top_10_books": ""},
+            input_queues={"top_books_partial": ""},
             output_queues=["query4_result"],
         )
 
@@ -3,6 +3,8 @@ import socket
 import logging
 import time
 
+from common.partitioner import Partitioner
+
 SOCKET_TIMEOUT = 5
 
 
@@ -27,6 +29,7 @@ class Docktor:
             "label": f"com.docker.compose.project={project_name}"
         }
         self.sleep_interval = sleep_interval
+        self.partitioner = Partitioner.from_type()
         socket.setdefaulttimeout(SOCKET_TIMEOUT)
 
     def start(self):
@@ -69,7 +72,7 @@ class Docktor:
             # Should only healthcheck the Docktor instance with the next id in the ring
             return docktor_id == (self.instance_id + 1) % self.cluster_size
         else:
-            instance_id = hash(service_name) % (self.cluster_size)
+            instance_id = self.partitioner.partition(service_name, self.cluster_size)
             return instance_id == self.instance_id
 
     def shutdown(self):
@@ -2,6 +2,7 @@ from configparser import ConfigParser
 import logging
 import os
 from src.input_boundary import InputBoundary
+from src.async_input_boundary import AsyncInputBoundary
 import signal
 from common.logs import initialize_log
 
@@ -29,6 +30,7 @@ def initialize_config():
         config_params["logging_level"] = os.getenv('LOGGING_LEVEL', config["DEFAULT"]["LOGGING_LEVEL"])
         config_params["books_exchange"] = os.getenv('BOOKS_EXCHANGE')
         config_params["reviews_exchange"] = os.getenv('REVIEWS_EXCHANGE')
+        config_params["server_mode"] = os.getenv('SERVER_MODE', 'threads')
     except KeyError as e:
         raise e
     except ValueError as e:
@@ -40,10 +42,12 @@ def initialize_config():
 def main():
     config_params = initialize_config()
     initialize_log(config_params["logging_level"])
-    boundary = InputBoundary(config_params["port"],
-                             config_params["listen_backlog"],
-                             config_params["books_exchange"],
-                             config_params["reviews_exchange"])
+    # Clients are served by a thread each, or all of them by an asyncio loop
+    boundary_class = AsyncInputBoundary if config_params["server_mode"] == "asyncio" else InputBoundary
+    boundary = boundary_class(config_params["port"],
+                              config_params["listen_backlog"],
+                              config_params["books_exchange"],
+                              config_params["reviews_exchange"])
     signal.signal(signal.SIGTERM, lambda signum, frame: boundary.shutdown())
     boundary.run()
     logging.info("Input gateway stopped")
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+
+from .client_state import ClientState
+from .client_stream import AsyncClientStream
+from .input_boundary import CLIENT_ID_BYTES, PACKET_BATCH_SIZE, TIMEOUT, InputBoundary
+from .publisher import Publisher
+from common.book import Book
+from common.eof_packet import EOFPacket
+from common.review import Review
+
+ASYNC_MAX_CONCURRENT_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONCURRENT_CONNECTIONS', '256'))
+STREAM_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class AsyncInputBoundary(InputBoundary):
+    """
+    Input boundary serving every client from a single asyncio event loop
+
+    The publishers are still threads with blocking broker connections. A
+    client only hands its batches to them from the loop, and waits for room
+    in its publisher from the default executor, so a client ahead of its
+    publisher does not hold up the others.
+    """
+
+    def __init__(self, port: int, backlog: int, books_exchange: str, reviews_exchange: str):
+        super().__init__(port, backlog, books_exchange, reviews_exchange)
+        self.loop = None
+        self.stopped = None
+        self.writers: set[asyncio.StreamWriter] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    def run(self):
+        self._start_publishers()
+        asyncio.run(self.__serve())
+        self._join_publishers()
+
+    def shutdown(self):
+        logging.info("Graceful shutdown")
+        self.should_stop = True
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def __serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        connections = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_CONNECTIONS)
+
+        async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            self.tasks.add(asyncio.current_task())
+            self.writers.add(writer)
+            try:
+                async with connections:
+                    await self.__handle_client_connection(reader, writer)
+            finally:
+                writer.close()
+                self.writers.discard(writer)
+                self.tasks.discard(asyncio.current_task())
+
+        server = await asyncio.start_server(handle_client, sock=self.socket, limit=STREAM_BUFFER_SIZE)
+        await self.stopped.wait()
+
+        server.close()
+        await server.wait_closed()
+        self._stop_publishers()
+        for writer in list(self.writers):
+            logging.info("Closing client connection %s", writer.get_extra_info('peername'))
+            writer.close()
+        logging.info("Waiting for clients to finish")
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def __handle_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_id = self._next_client_id()
+        logging.info("Connection from %s - Assigning client id: %s", writer.get_extra_info('peername'), client_id)
+        packet_id = 0
+        queued_books_eof = False
+        batch = []
+        publisher = self._publisher(client_id)
+
+        try:
+            writer.write(client_id.to_bytes(CLIENT_ID_BYTES, byteorder='big'))
+            await writer.drain()
+            self._change_client_state(client_id, ClientState.SENDING_BOOKS)
+            stream = AsyncClientStream(reader, TIMEOUT)
+            await stream.negotiate()
+            for (exchange, from_csv_fields) in [(self.books_exchange, Book.from_csv_fields),
+                                                (self.reviews_exchange, Review.from_csv_fields)]:
+                async for rows in stream.rows():
+                    if self.should_stop:
+                        break
+                    for fields in rows:
+                        if not fields:
+                            continue
+                        packet = from_csv_fields(fields, client_id, packet_id)
+                        if packet:
+                            batch.append(packet)
+                            packet_id += 1
+                            if len(batch) == PACKET_BATCH_SIZE:
+                                await self.__put(publisher, client_id, exchange, batch)
+                                batch = []
+                if self.should_stop:
+                    break
+
+                logging.info(f"EOF reached for {client_id} - queueing EOFPacket {packet_id}")
+                batch.append(EOFPacket(client_id, packet_id))
+                await self.__put(publisher, client_id, exchange, batch)
+                batch = []
+                if not queued_books_eof:
+                    queued_books_eof = True
+                    packet_id += 1
+
+        except (ConnectionResetError, OSError, EOFError, ValueError) as e:
+            logging.error(e)
+            logging.error(f"Sending EOF packet for client {client_id}")
+            eof_packet = EOFPacket(client_id, packet_id)
+            if not queued_books_eof:
+                await self.__put(publisher, client_id, self.books_exchange, batch + [eof_packet])
+                batch = []
+            await self.__put(publisher, client_id, self.reviews_exchange, batch + [eof_packet])
+
+    async def __put(self, publisher: Publisher, client_id: int, exchange: str, packets: list):
+        if not publisher.put(client_id, exchange, packets, block=False):
+            await self.loop.run_in_executor(None, publisher.put, client_id, exchange, packets)
@@ -0,0 +1,221 @@
+import asyncio
+import csv
+import io
+import logging
+import socket
+from typing import AsyncIterator, Iterable, Iterator
+
+from common.receive_utils import receive_chunk, receive_exact
+
+LENGTH_BYTES = 2
+EOF_STR = "EOF"
+# Clients of the second protocol version start with this marker and their
+# version instead of the length of their first line, then send chunks of
+# whole lines with a 4 byte length. An empty chunk is an EOF.
+PROTOCOL_MARKER = b'\xff\xff'
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+CHUNK_LENGTH_BYTES = 4
+INITIAL_CHUNK_BUFFER_SIZE = 1024 * 1024
+# First protocol version lines parsed at once by AsyncClientStream, out of
+# reads of up to FRAMES_READ_SIZE bytes
+LINES_PER_BLOCK = 500
+FRAMES_READ_SIZE = 64 * 1024
+
+
+def parse_rows(lines: Iterable[str]) -> Iterator[list[str]]:
+    """
+    Rows of a csv.reader over lines, skipping the malformed ones instead of
+    giving up on the rest of the file
+    """
+    reader = csv.reader(lines)
+    while True:
+        try:
+            yield next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            logging.warning("Skipping malformed CSV row ending at line %d: %s", reader.line_num, e)
+
+
+class ClientStream:
+    """
+    CSV lines sent by a client, split in the files ended by each of its EOFs
+
+    Lines of the second protocol version keep their line breaks, so a
+    csv.reader over them can parse quoted fields spanning several lines.
+    """
+
+    def __init__(self, client_socket: socket.socket):
+        self.socket = client_socket
+        self.version = None
+        self.buffer = None
+        self._next_length = None
+
+    def negotiate(self):
+        header = receive_exact(self.socket, LENGTH_BYTES)
+        if header != PROTOCOL_MARKER:
+            self.version = PROTOCOL_V1
+            self._next_length = int.from_bytes(header, byteorder='big')
+            return
+        self.version = receive_exact(self.socket, 1)[0]
+        if self.version != PROTOCOL_V2:
+            raise ValueError(f"Unsupported protocol version: {self.version}")
+        self.buffer = bytearray(INITIAL_CHUNK_BUFFER_SIZE)
+
+    def lines(self) -> Iterator[str]:
+        """
+        Yields the lines of the next file, until its EOF
+        """
+        if self.version == PROTOCOL_V1:
+            yield from self._frame_lines()
+        else:
+            yield from self._chunk_lines()
+
+    def _frame_lines(self) -> Iterator[str]:
+        while True:
+            if self._next_length is None:
+                self._next_length = int.from_bytes(receive_exact(self.socket, LENGTH_BYTES), byteorder='big')
+            line = receive_exact(self.socket, self._next_length).decode().strip()
+            self._next_length = None
+            if line == EOF_STR:
+                return
+            yield line
+
+    def _chunk_lines(self) -> Iterator[str]:
+        while True:
+            chunk = receive_chunk(self.socket, CHUNK_LENGTH_BYTES, self.buffer)
+            if len(chunk) == 0:
+                return
+            # The whole chunk is decoded at once, it only holds whole lines
+            lines = io.StringIO(str(chunk, 'utf-8'))
+            chunk.release()
+            yield from lines
+
+
+class AsyncClientStream:
+    """
+    Rows of the CSV files sent by a client, read from an asyncio stream
+
+    Rows are parsed in blocks, a chunk or LINES_PER_BLOCK lines at a time,
+    since a csv.reader cannot wait on the stream between lines. A record
+    left open by a chunk that ends inside a quoted field is carried over and
+    parsed along with the next chunk.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, timeout: float):
+        self.reader = reader
+        self.timeout = timeout
+        self.version = None
+        self.frames = bytearray()
+        self._position = 0
+
+    async def negotiate(self):
+        header = await self._read(LENGTH_BYTES)
+        if header != PROTOCOL_MARKER:
+            self.version = PROTOCOL_V1
+            self.frames += header
+            return
+        self.version = (await self._read(1))[0]
+        if self.version != PROTOCOL_V2:
+            raise ValueError(f"Unsupported protocol version: {self.version}")
+
+    async def rows(self) -> AsyncIterator[list[list[str]]]:
+        """
+        Yields blocks of rows of the next file, until its EOF
+        """
+        if self.version == PROTOCOL_V1:
+            blocks = self._frame_rows()
+        else:
+            blocks = self._chunk_rows()
+        async for rows in blocks:
+            yield rows
+
+    async def _frame_rows(self) -> AsyncIterator[list[list[str]]]:
+        lines = []
+        while True:
+            line = self._next_frame()
+            if line is None:
+                # Every buffered frame is taken, parse them before waiting
+                if lines:
+                    yield list(parse_rows(lines))
+                    lines = []
+                await self._read_frames()
+                continue
+            line = line.decode().strip()
+            if line == EOF_STR:
+                break
+            lines.append(line)
+            if len(lines) == LINES_PER_BLOCK:
+                yield list(parse_rows(lines))
+                lines = []
+        if lines:
+            yield list(parse_rows(lines))
+
+    def _next_frame(self):
+        """
+        Takes the next line out of the buffered frames, or returns None if
+        it was not fully read yet
+        """
+        start = self._position + LENGTH_BYTES
+        if len(self.frames) < start:
+            return None
+        end = start + int.from_bytes(self.frames[self._position:start], byteorder='big')
+        if len(self.frames) < end:
+            return None
+        self._position = end
+        return bytes(self.frames[start:end])
+
+    async def _read_frames(self):
+        del self.frames[:self._position]
+        self._position = 0
+        try:
+            data = await asyncio.wait_for(self.reader.read(FRAMES_READ_SIZE), self.timeout)
+        except asyncio.TimeoutError:
+            raise EOFError("Timeout while reading data")
+        if not data:
+            raise EOFError("EOF reached while reading data")
+        self.frames += data
+
+    async def _chunk_rows(self) -> AsyncIterator[list[list[str]]]:
+        pending = []
+        quotes = 0
+        while True:
+            length = int.from_bytes(await self._read(CHUNK_LENGTH_BYTES), byteorder='big')
+            if length == 0:
+                break
+            text = str(await self._read(length), 'utf-8')
+            # Quotes inside quoted fields are doubled, so only an odd count
+            # leaves a field open
+            end = len(text) if (quotes + text.count('"')) % 2 == 0 else _records_end(text, quotes)
+            if end == 0:
+                pending.append(text)
+                quotes += text.count('"')
+                continue
+            pending.append(text[:end])
+            yield list(parse_rows(io.StringIO(''.join(pending))))
+            pending = [text[end:]] if end < len(text) else []
+            quotes = text.count('"', end)
+        if pending:
+            yield list(parse_rows(io.StringIO(''.join(pending))))
+
+    async def _read(self, length: int) -> bytes:
+        try:
+            return await asyncio.wait_for(self.reader.readexactly(length), self.timeout)
+        except asyncio.TimeoutError:
+            raise EOFError("Timeout while reading data")
+
+
+def _records_end(text: str, quotes: int) -> int:
+    """
+    Returns where the last record ending in text ends, given the quotes
+    before it, or 0 if every line break of text is inside a quoted field
+    """
+    end = 0
+    start = 0
+    while (newline := text.find('\n', start)) != -1:
+        quotes += text.count('"', start, newline + 1)
+        start = newline + 1
+        if quotes % 2 == 0:
+            end = start
+    return end
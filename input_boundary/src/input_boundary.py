@@ -1,27 +1,29 @@
+import csv
 import logging
-from queue import Queue
+import os
 import socket
+import sys
 import threading
 from concurrent.futures import ThreadPoolExecutor
 
 from .client_state import ClientState
-from common.receive_utils import receive_line
-from common.packet import PacketType
+from .client_stream import ClientStream, parse_rows
+from .publisher import Publisher
 from common.eof_packet import EOFPacket
-from common.middleware import Middleware
 from common.book import Book
 from common.review import Review
 from common.persistence_manager import PersistenceManager
 
-MAX_READ_SIZE = 1024
-LENGTH_BYTES = 2
-QUEUE_SIZE = 10000
+# Packets are queued for the publishers in batches of this size
+PACKET_BATCH_SIZE = 500
 CLIENT_ID_BYTES = 2
-MAX_CONCURRENT_CONNECTIONS = 5
+MAX_CONCURRENT_CONNECTIONS = int(os.getenv('MAX_CONCURRENT_CONNECTIONS', '5'))
+# Each publisher has its own broker connection, and every packet of a
+# client goes through the same one
+PUBLISHERS = int(os.getenv('PUBLISHERS', '2'))
 TIMEOUT = 5
 CLIENT_ID_KEY = "client_id"
 CLIENT_STATE_PREFIX = "client_state_"
-EOF_STR = "EOF"
 
 
 class InputBoundary:
@@ -34,30 +36,26 @@ class InputBoundary:
         self.should_stop = False
         self.threads = {}
         self.client_sockets = set()
-        self.books_packet_queue = Queue(maxsize=QUEUE_SIZE)
-        self.reviews_packet_queue = Queue(maxsize=QUEUE_SIZE)
-        self.books_middleware_sender_thread = None
-        self.reviews_middleware_sender_thread = None
         self.client_id = 0
-        self.persistence_manager = PersistenceManager('../storage/input_boundary')
+        self.persistence_manager = PersistenceManager.from_backend('../storage/input_boundary')
         self.persistence_manager_lock = threading.Lock()
         self.books_exchange = books_exchange
         self.reviews_exchange = reviews_exchange
+        # Descriptions and review texts may be longer than the default limit
+        csv.field_size_limit(sys.maxsize)
+        self.publishers = [Publisher([books_exchange, reviews_exchange], self.__on_eof_sent)
+                           for _ in range(PUBLISHERS)]
+        self.publisher_threads = []
         self._init_state()
         logging.info("Listening for connections and redirecting to exchanges %s and %s", books_exchange, reviews_exchange)
 
     def run(self):
-        self.books_middleware_sender_thread = threading.Thread(
-            target=self.__middleware_sender, args=(self.books_packet_queue, self.books_exchange))
-        self.books_middleware_sender_thread.start()
-        self.reviews_middleware_sender_thread = threading.Thread(
-            target=self.__middleware_sender, args=(self.reviews_packet_queue, self.reviews_exchange, True))
-        self.reviews_middleware_sender_thread.start()
+        self._start_publishers()
         with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CONNECTIONS) as executor:
             while self.should_stop is False:
                 try:
                     client_socket, address = self.socket.accept()
-                    client_id = self.__next_client_id()
+                    client_id = self._next_client_id()
                     self.client_sockets.add(client_socket)
                     logging.info(
                         "Connection from %s - Assigning client id: %s", address,
@@ -72,90 +70,93 @@ class InputBoundary:
                     logging.info("Server socket closed")
                     continue
 
-    def __next_client_id(self):
+    def _start_publishers(self):
+        for publisher in self.publishers:
+            thread = threading.Thread(target=publisher.run)
+            thread.start()
+            self.publisher_threads.append(thread)
+
+    def _stop_publishers(self):
+        for publisher in self.publishers:
+            publisher.stop()
+
+    def _join_publishers(self):
+        logging.info("Waiting for publishers to finish")
+        for thread in self.publisher_threads:
+            thread.join()
+
+    def _next_client_id(self):
         client_id = self.client_id
         self.client_id += 1
         with self.persistence_manager_lock:
             self.persistence_manager.put(CLIENT_ID_KEY, str(self.client_id))
+            self.persistence_manager.flush()
         return client_id
 
-    def __middleware_sender(self, packet_queue, output_exchange, should_clean_on_eof: bool = False):
-        logging.info("Middleware sender started")
-        middleware = Middleware(output_exchanges=[output_exchange])
-        while self.should_stop is False:
-            try:
-                packet = packet_queue.get(block=True)
-                if packet is None:
-                    middleware.shutdown()
-                    break
-                middleware.send(packet.encode())
-                if packet.packet_type == PacketType.EOF:
-                    client_id = packet.client_id
-                    logging.info(f"Sent EOF packet for client {client_id} to {output_exchange}")
-                    if not should_clean_on_eof:
-                        self._change_client_state(client_id, ClientState.SENDING_REVIEWS)
-                    else:
-                        with self.persistence_manager_lock:
-                            self.persistence_manager.delete_keys(f"{CLIENT_STATE_PREFIX}{client_id}")
-            except OSError:
-                logging.error("Middleware closed")
-                break
-        logging.info("Middleware sender stopped")
+    def _publisher(self, client_id: int) -> Publisher:
+        return self.publishers[client_id % len(self.publishers)]
+
+    def __on_eof_sent(self, exchange: str, client_id: int):
+        if exchange == self.books_exchange:
+            self._change_client_state(client_id, ClientState.SENDING_REVIEWS)
+        else:
+            with self.persistence_manager_lock:
+                self.persistence_manager.delete_keys(f"{CLIENT_STATE_PREFIX}{client_id}")
+                self.persistence_manager.flush()
 
     def __handle_client_connection(self, client_socket: socket.socket, client_id: int):
         packet_id = 0
 
         client_socket.settimeout(TIMEOUT)
         queued_books_eof = False
+        batch = []
+        publisher = self._publisher(client_id)
 
         with client_socket:
             client_socket.sendall(client_id.to_bytes(CLIENT_ID_BYTES, byteorder='big'))
             self._change_client_state(client_id, ClientState.SENDING_BOOKS)
-            while self.should_stop is False:
-                try:
-                    data = receive_line(client_socket, LENGTH_BYTES).decode().strip()
-                    logging.debug("Received line: %s", data)
-                    if data == EOF_STR:
-                        logging.info(f"EOF reached for {client_id} - queueing EOFPacket {packet_id}")
-                        eof_packet = EOFPacket(client_id, packet_id)
-                        if not queued_books_eof:
-                            self.books_packet_queue.put(eof_packet)
-                            queued_books_eof = True
-                            packet_id += 1
-                        else:
-                            self.reviews_packet_queue.put(eof_packet)
+            try:
+                stream = ClientStream(client_socket)
+                stream.negotiate()
+                for (exchange, from_csv_fields) in [(self.books_exchange, Book.from_csv_fields),
+                                                    (self.reviews_exchange, Review.from_csv_fields)]:
+                    # A single reader per file, which only builds the packets
+                    # out of the columns the queries use
+                    for fields in parse_rows(stream.lines()):
+                        if self.should_stop:
                             break
-                    elif not queued_books_eof:
-                        packet = Book.from_csv_row(data, client_id, packet_id)
-                        if packet:
-                            self.books_packet_queue.put(packet)
-                            packet_id += 1
-                    else:
-                        packet = Review.from_csv_row(data, client_id, packet_id)
+                        if not fields:
+                            continue
+                        packet = from_csv_fields(fields, client_id, packet_id)
                         if packet:
-                            self.reviews_packet_queue.put(packet)
+                            batch.append(packet)
                             packet_id += 1
-
-                except (ConnectionResetError, OSError, EOFError) as e:
-                    logging.error(e)
-                    logging.error(f"Sending EOF packet for client {client_id}")
-                    eof_packet = EOFPacket(client_id, packet_id)
+                            if len(batch) == PACKET_BATCH_SIZE:
+                                publisher.put(client_id, exchange, batch)
+                                batch = []
+                    if self.should_stop:
+                        break
+
+                    logging.info(f"EOF reached for {client_id} - queueing EOFPacket {packet_id}")
+                    batch.append(EOFPacket(client_id, packet_id))
+                    publisher.put(client_id, exchange, batch)
+                    batch = []
                     if not queued_books_eof:
-                        self.books_packet_queue.put(eof_packet)
-                    self.reviews_packet_queue.put(eof_packet)
-                    break
+                        queued_books_eof = True
+                        packet_id += 1
+
+            except (ConnectionResetError, OSError, EOFError, ValueError) as e:
+                logging.error(e)
+                logging.error(f"Sending EOF packet for client {client_id}")
+                eof_packet = EOFPacket(client_id, packet_id)
+                if not queued_books_eof:
+                    publisher.put(client_id, self.books_exchange, batch + [eof_packet])
+                    batch = []
+                publisher.put(client_id, self.reviews_exchange, batch + [eof_packet])
 
         self.threads.pop(client_id, None)
         self.client_sockets.discard(client_socket)
 
-    def __clear_queues(self):
-        for queue in [self.books_packet_queue, self.reviews_packet_queue]:
-            if queue:
-                with queue.mutex:
-                    queue.queue.clear()
-                    queue.put(None)
-                logging.info("Cleared packet queues")
-
     def shutdown(self):
         logging.info("Graceful shutdown")
         self.should_stop = True
@@ -168,32 +169,32 @@ class InputBoundary:
             client_socket.shutdown(socket.SHUT_RDWR)
             client_socket.close()
 
-        self.__clear_queues()
+        self._stop_publishers()
 
         logging.info("Waiting for threads to finish")
         threads = list(self.threads.values())
         for thread in threads:
             thread.result()
 
-        logging.info("Waiting for middleware senders to finish")
-        for thread in [self.books_middleware_sender_thread, self.reviews_middleware_sender_thread]:
-            if thread:
-                thread.join()
+        self._join_publishers()
 
     def _change_client_state(self, client_id: int, new_state: ClientState):
         with self.persistence_manager_lock:
             self.persistence_manager.put(f"{CLIENT_STATE_PREFIX}{client_id}", str(new_state))
+            self.persistence_manager.flush()
 
     def _init_state(self):
         for (key, _secondary_key) in self.persistence_manager.get_keys(CLIENT_STATE_PREFIX):
             client_id = int(key.removeprefix(CLIENT_STATE_PREFIX))
             client_state = ClientState.from_str(self.persistence_manager.get(key))
             eof_packet = EOFPacket(client_id, -1)
+            publisher = self._publisher(client_id)
             if client_state == ClientState.SENDING_BOOKS:
-                self.books_packet_queue.put(eof_packet)
-            self.reviews_packet_queue.put(eof_packet)
+                publisher.put(client_id, self.books_exchange, [eof_packet])
+            publisher.put(client_id, self.reviews_exchange, [eof_packet])
             logging.info(f"Sent EOF packet for client {client_id}")
         self.persistence_manager.delete_keys(CLIENT_STATE_PREFIX)
+        self.persistence_manager.flush()
 
         self.client_id = int(self.persistence_manager.get(CLIENT_ID_KEY) or "0")
         logging.info(f"Initialized state with latest client id {self.client_id}")
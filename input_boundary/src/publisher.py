@@ -0,0 +1,104 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable
+
+from common.middleware import BATCH_TIMEOUT, Middleware
+from common.packet import Packet, PacketType
+
+# Batches of a client waiting to be published, past which its connection
+# handler blocks until the publisher catches up
+CLIENT_QUEUE_SIZE = 20
+
+
+class Publisher:
+    """
+    Publishes the packets of the clients assigned to it through a broker
+    connection of its own
+
+    Every client has its own queue of batches, and the clients with pending
+    batches are served in turns of one batch each, so a large client cannot
+    starve the others sharing the publisher.
+    """
+
+    def __init__(self, exchanges: list[str], eof_callback: Callable[[str, int], None]):
+        self.exchanges = exchanges
+        self.eof_callback = eof_callback
+        self.pending: dict[int, deque[tuple[str, list[Packet]]]] = {}
+        # Clients with pending batches, in the order they are served
+        self.turns: deque[int] = deque()
+        self.condition = threading.Condition()
+        self.should_stop = False
+
+    def put(self, client_id: int, exchange: str, packets: list[Packet], block: bool = True) -> bool:
+        """
+        Queues packets of a client to be published to exchange, after every
+        packet it queued before. Returns False, without queueing them, if
+        the client has no room left and block is False.
+        """
+        with self.condition:
+            while len(self.pending.get(client_id, ())) >= CLIENT_QUEUE_SIZE and not self.should_stop:
+                if not block:
+                    return False
+                self.condition.wait()
+            if self.should_stop:
+                return True
+            if client_id not in self.pending:
+                self.pending[client_id] = deque()
+                self.turns.append(client_id)
+            self.pending[client_id].append((exchange, packets))
+            self.condition.notify_all()
+            return True
+
+    def run(self):
+        logging.info("Publisher started")
+        middleware = Middleware(output_exchanges=self.exchanges)
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    break
+                if not batch:
+                    # Nothing else to batch for now, publish what is pending
+                    middleware.flush()
+                    continue
+                (exchange, packets) = batch
+                for packet in packets:
+                    middleware.send_to_exchange(exchange, packet.encode())
+                    if packet.packet_type == PacketType.EOF:
+                        middleware.flush()
+                        logging.info(f"Sent EOF packet for client {packet.client_id} to {exchange}")
+                        self.eof_callback(exchange, packet.client_id)
+        except OSError:
+            logging.error("Middleware closed")
+        middleware.shutdown()
+        logging.info("Publisher stopped")
+
+    def _next_batch(self):
+        """
+        Returns the (exchange, packets) of the client whose turn it is, an
+        empty tuple if there were none for a while, or None once stopped
+        """
+        with self.condition:
+            if not self.turns and not self.should_stop:
+                self.condition.wait(timeout=BATCH_TIMEOUT)
+            if self.should_stop:
+                return None
+            if not self.turns:
+                return ()
+            client_id = self.turns.popleft()
+            batches = self.pending[client_id]
+            batch = batches.popleft()
+            if batches:
+                self.turns.append(client_id)
+            else:
+                del self.pending[client_id]
+            self.condition.notify_all()
+            return batch
+
+    def stop(self):
+        with self.condition:
+            self.should_stop = True
+            self.pending.clear()
+            self.turns.clear()
+            self.condition.notify_all()
@@ -3,6 +3,7 @@ import logging
 import os
 import signal
 from src.output_boundary import OutputBoundary
+from src.async_output_boundary import AsyncOutputBoundary
 from common.logs import initialize_log
 
 DEFAULT_PORT = 12345
@@ -14,7 +15,9 @@ def main():
     listen_backlog = os.getenv("LISTEN_BACKLOG", DEFAULT_LISTEN_BACKLOG)
     result_queues = json.loads(os.getenv("RESULT_QUEUES"))
     initialize_log(os.getenv("LOG_LEVEL", "INFO"))
-    output_boundary = OutputBoundary(port,
+    # Clients are served by a thread each, or all of them by an asyncio loop
+    boundary_class = AsyncOutputBoundary if os.getenv("SERVER_MODE", "threads") == "asyncio" else OutputBoundary
+    output_boundary = boundary_class(port,
                                      listen_backlog,
                                      result_queues)
     signal.signal(signal.SIGTERM, lambda signum, frame: output_boundary.shutdown())
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import queue
+
+from .output_boundary import CLIENT_ID_BYTES, QUEUE_SIZE, OutputBoundary
+
+STREAM_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class ResultsQueue(queue.Queue):
+    """
+    Bounded queue filled from threads and drained from an event loop
+
+    Producers block while it is full, as with any queue.Queue, and only
+    wake the loop up when its consumer is waiting for an item.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int):
+        super().__init__(maxsize=maxsize)
+        self.loop = loop
+        self.waiter = None
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        super().put(item, block, timeout)
+        with self.mutex:
+            waiter, self.waiter = self.waiter, None
+        if waiter is not None:
+            self.loop.call_soon_threadsafe(_wake, waiter)
+
+    async def get_async(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                pass
+            waiter = self.loop.create_future()
+            with self.mutex:
+                # An item may have been put since get_nowait
+                if self._qsize():
+                    continue
+                self.waiter = waiter
+            await waiter
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AsyncOutputBoundary(OutputBoundary):
+    """
+    Output boundary serving every client from a single asyncio event loop
+
+    Results are still consumed by the middleware thread, which hands them to
+    the loop through a bounded ResultsQueue per client, waiting for room
+    when the client falls behind.
+    """
+
+    def __init__(self, port: int, backlog: int, result_queues: dict[int, str]):
+        super().__init__(port, backlog, result_queues)
+        self.loop = None
+        self.stopped = None
+        self.writers: set[asyncio.StreamWriter] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    def run(self):
+        asyncio.run(self.__serve())
+        logging.info("Joining threads")
+        for thread in self.threads:
+            thread.join()
+        self.threads.clear()
+        logging.info("Joined all threads")
+
+    def shutdown(self):
+        logging.info("Graceful shutdown")
+        self.should_stop = True
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def _new_queue(self):
+        return ResultsQueue(self.loop, QUEUE_SIZE)
+
+    async def __serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self._start_threads()
+
+        async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            self.tasks.add(asyncio.current_task())
+            self.writers.add(writer)
+            try:
+                await self.__handle_client_connection(reader, writer)
+            finally:
+                writer.close()
+                self.writers.discard(writer)
+                self.tasks.discard(asyncio.current_task())
+
+        server = await asyncio.start_server(handle_client, sock=self.server_socket, limit=STREAM_BUFFER_SIZE)
+        await self.stopped.wait()
+
+        server.close()
+        await server.wait_closed()
+        if self.middleware:
+            self.middleware.shutdown()
+        with self.condition:
+            self.condition.notify_all()
+
+        with self.lock:
+            queues = list(self.queues.values())
+            self.queues.clear()
+        for results_queue in queues:
+            with results_queue.mutex:
+                results_queue.queue.clear()
+            results_queue.put((None, None))
+        logging.info("Closing client connections")
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def __handle_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_id = 'unknown'
+        logging.info("Connection from %s", writer.get_extra_info('peername'))
+        try:
+            client_id = int.from_bytes(await reader.readexactly(CLIENT_ID_BYTES), byteorder='big')
+        except (EOFError, ConnectionResetError):
+            logging.error("[CLIENT %s] Connection closed by client", client_id)
+            return
+
+        with self.lock:
+            if client_id not in self.queues:
+                self.queues[client_id] = self._new_queue()
+            results_queue = self.queues[client_id]
+            self.connected_clients.add(client_id)
+            self.access_times.pop(client_id, None)
+
+        eofs = {query: False for query in self.result_queues.keys()}
+        finished = False
+        while not finished:
+            item = await results_queue.get_async()
+            (data, finished) = self._coalesce_results(client_id, results_queue, item, eofs)
+            if not data:
+                continue
+            try:
+                writer.write(data)
+                await writer.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                logging.error("[CLIENT %s] Connection closed by client", client_id)
+                break
+
+        with self.lock:
+            self.queues.pop(client_id, None)
+            self.connected_clients.discard(client_id)
+            self.access_times.pop(client_id, None)
+        logging.info("[CLIENT %s] Connection closed", client_id)
@@ -13,6 +13,9 @@ from common.result_packet import ResultPacket
 CLIENT_ID_BYTES = 2
 QUEUE_SIZE = 10000
 QUEUE_TIMEOUT = 60 * 60  # 1 hour
+# Results already queued for a client are sent together, in writes of up
+# to about this many bytes
+WRITE_BUDGET = 64 * 1024
 
 
 class OutputBoundary():
@@ -64,13 +67,7 @@ class OutputBoundary():
         logging.info("Joined all threads")
 
     def run(self):
-        middleware_receiver_thread = threading.Thread(
-            target=self.__middleware_receiver)
-        cleaner_thread = threading.Thread(target=self.__cleaner)
-        self.threads.append(middleware_receiver_thread)
-        self.threads.append(cleaner_thread)
-        middleware_receiver_thread.start()
-        cleaner_thread.start()
+        self._start_threads()
 
         while not self.should_stop:
             try:
@@ -87,6 +84,18 @@ class OutputBoundary():
             self.threads.append(thread)
             thread.start()
 
+    def _start_threads(self):
+        middleware_receiver_thread = threading.Thread(
+            target=self.__middleware_receiver)
+        cleaner_thread = threading.Thread(target=self.__cleaner)
+        self.threads.append(middleware_receiver_thread)
+        self.threads.append(cleaner_thread)
+        middleware_receiver_thread.start()
+        cleaner_thread.start()
+
+    def _new_queue(self):
+        return queue.Queue(maxsize=QUEUE_SIZE)
+
     def __middleware_receiver(self):
         self._init_middleware()
         self.middleware.start()
@@ -134,8 +143,7 @@ class OutputBoundary():
             result_packet = ResultPacket(query, result)
             with self.lock:
                 if client_id not in self.queues:
-                    self.queues[client_id] = queue.Queue(
-                        maxsize=QUEUE_SIZE)
+                    self.queues[client_id] = self._new_queue()
                 if client_id not in self.connected_clients:
                     self.access_times[client_id] = time.time()
             self.queues[client_id].put((query, result_packet))
@@ -153,8 +161,7 @@ class OutputBoundary():
             logging.info("[CLIENT %s] Query %s finished", client_id, query)
             with self.lock:
                 if client_id not in self.queues:
-                    self.queues[client_id] = queue.Queue(
-                        maxsize=QUEUE_SIZE)
+                    self.queues[client_id] = self._new_queue()
                 if client_id not in self.connected_clients:
                     self.access_times[client_id] = time.time()
             self.queues[client_id].put((query, eof_packet))
@@ -185,6 +192,35 @@ class OutputBoundary():
     #     self.server_socket.listen(self.backlog)
     #     self.should_stop = False
 
+    def _coalesce_results(self, client_id: int, results_queue, item: tuple, eofs: dict) -> tuple[bytearray, bool]:
+        """
+        Encodes item along with the results queued after it, up to
+        WRITE_BUDGET bytes. Returns them and whether the connection is over,
+        because every query finished or the queue was closed.
+        """
+        data = bytearray()
+        while True:
+            (query, packet) = item
+            logging.debug("Received result: %s", item)
+            if query is None and packet is None:
+                logging.info("[CLIENT %s] disconnected due to shutdown or cleaner", client_id)
+                return (data, True)
+
+            if packet.packet_type == PacketType.EOF:
+                eofs[query] = True
+                if all(eofs.values()):
+                    return (data, True)
+            else:
+                data += packet.encode()
+                logging.debug("[CLIENT %s] Sending result: %s", client_id, packet)
+
+            if len(data) >= WRITE_BUDGET:
+                return (data, False)
+            try:
+                item = results_queue.get_nowait()
+            except queue.Empty:
+                return (data, False)
+
     def __receive_client_id(self, socket: socket.socket):
         client_id_bytes = receive_exact(socket, CLIENT_ID_BYTES)
         return int.from_bytes(client_id_bytes, byteorder='big')
@@ -194,8 +230,7 @@ class OutputBoundary():
         client_id = 'unknown'
         try:
             client_id = self.__receive_client_id(client_socket)
-            results_queue = self.queues.get(
-                client_id, queue.Queue(maxsize=QUEUE_SIZE))
+            results_queue = self.queues.get(client_id, self._new_queue())
             with self.lock:
                 if client_id not in self.queues:
                     self.queues[client_id] = results_queue
@@ -215,21 +250,14 @@ class OutputBoundary():
         with client_socket:
             eofs = {query: False for query in self.result_queues.keys()}
 
-            while not all(eofs.values()):
-                query, packet = results_queue.get(block=True)
-                logging.debug("Received result: %s", (query, packet))
-                if query is None and packet is None:
-                    logging.info("[CLIENT %s] disconnected due to shutdown or cleaner", client_id)
-                    break
-
-                if packet.packet_type == PacketType.EOF:
-                    eofs[query] = True
+            finished = False
+            while not finished:
+                item = results_queue.get(block=True)
+                (data, finished) = self._coalesce_results(client_id, results_queue, item, eofs)
+                if not data:
                     continue
-
                 try:
-                    client_socket.sendall(packet.encode())
-                    logging.debug("[CLIENT %s] Sent result: %s",
-                                  client_id, packet)
+                    client_socket.sendall(data)
                 except (BrokenPipeError, ConnectionResetError):
                     logging.error("[CLIENT %s] Connection closed by client", client_id)
                     break
@@ -0,0 +1,246 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+BOOK_STORE_MEMORY_BYTES = int(os.getenv('BOOK_STORE_MEMORY_BYTES', str(64 * 1024 * 1024)))
+INITIAL_SLOTS = 1 << 12
+# Approximate size of a cached book besides its title and authors
+ENTRY_OVERHEAD = 200
+# [TITLE_HASH][RECORD_OFFSET + 1], an empty slot has a zero offset
+SLOT = struct.Struct('<QQ')
+# [INDEX][TITLE_LENGTH][AUTHORS_LENGTH], followed by the title and the authors
+RECORD = struct.Struct('<III')
+HASH_MASK = (1 << 64) - 1
+READ_CHUNK = 1 << 20
+
+
+class DiskBookTable:
+    """
+    Append-only file of the books of a client, with an open addressing hash
+    index of their titles in a memory mapped file
+
+    Books are numbered in the order they are first added. A book added
+    again with other authors gets a new record, which replaces the previous
+    one. The index only holds title hashes and record offsets, so titles are
+    only read from disk on a hash match, and it is rebuilt from the records
+    when the table is opened.
+    """
+
+    def __init__(self, path: str):
+        self.data_path = f'{path}.data'
+        self.index_path = f'{path}.index'
+        self.fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        self.size = 0
+        self.count = 0
+        self.used = 0
+        self.slots = 0
+        self.index = None
+        self.index_file = None
+        self._create_index(INITIAL_SLOTS)
+        self._load()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, title: str):
+        """
+        Returns the (authors, index) of a book, or None if it was not added
+        """
+        (_, offset) = self._find(title, hash(title) & HASH_MASK)
+        if offset is None:
+            return None
+        (index, _, authors) = self._read(offset)
+        return (authors, index)
+
+    def add(self, title: str, authors: str) -> int:
+        title_hash = hash(title) & HASH_MASK
+        (slot, offset) = self._find(title, title_hash)
+        if offset is not None:
+            (index, _, stored_authors) = self._read(offset)
+            if stored_authors == authors:
+                return index
+        else:
+            index = self.count
+            self.count += 1
+
+        encoded_title = title.encode()
+        encoded_authors = authors.encode()
+        record = RECORD.pack(index, len(encoded_title), len(encoded_authors)) + encoded_title + encoded_authors
+        os.write(self.fd, record)
+        self._set_slot(slot, title_hash, self.size, offset is None)
+        self.size += len(record)
+        return index
+
+    def close(self):
+        self.index.close()
+        self.index_file.close()
+        os.close(self.fd)
+
+    def delete(self):
+        self.close()
+        for path in [self.data_path, self.index_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _set_slot(self, slot: int, title_hash: int, offset: int, is_new: bool):
+        SLOT.pack_into(self.index, slot * SLOT.size, title_hash, offset + 1)
+        if is_new:
+            self.used += 1
+            if 2 * self.used > self.slots:
+                self._resize()
+
+    def _find(self, title: str, title_hash: int) -> tuple:
+        """
+        Returns the slot of a title and the offset of its record, or the
+        empty slot where it would go and None
+        """
+        mask = self.slots - 1
+        slot = title_hash & mask
+        while True:
+            (slot_hash, offset) = SLOT.unpack_from(self.index, slot * SLOT.size)
+            if offset == 0:
+                return (slot, None)
+            if slot_hash == title_hash and self._read(offset - 1)[1] == title:
+                return (slot, offset - 1)
+            slot = (slot + 1) & mask
+
+    def _read(self, offset: int) -> tuple[int, str, str]:
+        (index, title_length, authors_length) = RECORD.unpack(os.pread(self.fd, RECORD.size, offset))
+        data = os.pread(self.fd, title_length + authors_length, offset + RECORD.size)
+        return (index, str(data[:title_length], 'utf-8'), str(data[title_length:], 'utf-8'))
+
+    def _create_index(self, slots: int):
+        with open(self.index_path, 'wb') as f:
+            f.truncate(slots * SLOT.size)
+        self.index_file = open(self.index_path, 'r+b')
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        self.slots = slots
+        self.used = 0
+
+    def _resize(self):
+        old_index, old_index_file, old_slots = self.index, self.index_file, self.slots
+        entries = [SLOT.unpack_from(old_index, slot * SLOT.size) for slot in range(old_slots)]
+        old_index.close()
+        old_index_file.close()
+        self._create_index(2 * old_slots)
+        mask = self.slots - 1
+        for (title_hash, offset) in entries:
+            if offset == 0:
+                continue
+            slot = title_hash & mask
+            while SLOT.unpack_from(self.index, slot * SLOT.size)[1] != 0:
+                slot = (slot + 1) & mask
+            SLOT.pack_into(self.index, slot * SLOT.size, title_hash, offset)
+            self.used += 1
+
+    def _load(self):
+        data = bytearray()
+        offset = 0
+        while True:
+            chunk = os.pread(self.fd, READ_CHUNK, offset + len(data))
+            if not chunk:
+                break
+            data += chunk
+            position = 0
+            while position + RECORD.size <= len(data):
+                (index, title_length, authors_length) = RECORD.unpack_from(data, position)
+                end = position + RECORD.size + title_length + authors_length
+                if end > len(data):
+                    break
+                title = str(data[position + RECORD.size:position + RECORD.size + title_length], 'utf-8')
+                title_hash = hash(title) & HASH_MASK
+                (slot, previous) = self._find(title, title_hash)
+                self._set_slot(slot, title_hash, offset + position, previous is None)
+                self.count = max(self.count, index + 1)
+                position = end
+            del data[:position]
+            offset += position
+        # A record cut short by a crash is dropped, it was never acknowledged
+        if data:
+            os.ftruncate(self.fd, offset)
+        self.size = offset
+
+
+class BookStore:
+    """
+    Books of every client, on disk, with the most recently used ones cached
+    in memory up to a memory ceiling shared by every client
+    """
+
+    def __init__(self, path: str, memory_bytes: int = BOOK_STORE_MEMORY_BYTES):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.cached_bytes = 0
+        self.cache: OrderedDict[tuple[int, str], tuple[str, int]] = OrderedDict()
+        self.tables: dict[int, DiskBookTable] = {}
+        # Books are added and looked up from different threads
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith('.data'):
+                client_id = int(name.removesuffix('.data'))
+                self.tables[client_id] = DiskBookTable(f'{path}/{client_id}')
+                logging.info("[Client %s] Loaded %d books", client_id, len(self.tables[client_id]))
+
+    def __contains__(self, client_id: int) -> bool:
+        return client_id in self.tables
+
+    def count(self, client_id: int) -> int:
+        table = self.tables.get(client_id)
+        return len(table) if table else 0
+
+    def add(self, client_id: int, title: str, authors: str) -> int:
+        """
+        Returns the index of the book among the books of its client
+        """
+        with self.lock:
+            table = self.tables.get(client_id)
+            if table is None:
+                table = self.tables[client_id] = DiskBookTable(f'{self.path}/{client_id}')
+            index = table.add(title, authors)
+            if (client_id, title) in self.cache:
+                self._cache(client_id, title, (authors, index))
+            return index
+
+    def get(self, client_id: int, title: str):
+        """
+        Returns the (authors, index) of a book, or None if it was not added
+        """
+        with self.lock:
+            book = self.cache.get((client_id, title))
+            if book is not None:
+                self.cache.move_to_end((client_id, title))
+                return book
+            table = self.tables.get(client_id)
+            if table is None:
+                return None
+            book = table.get(title)
+            if book is not None:
+                self._cache(client_id, title, book)
+            return book
+
+    def delete(self, client_id: int):
+        with self.lock:
+            table = self.tables.pop(client_id, None)
+            if table is not None:
+                table.delete()
+            for key in [key for key in self.cache if key[0] == client_id]:
+                self._uncache(key)
+
+    def _cache(self, client_id: int, title: str, book: tuple[str, int]):
+        key = (client_id, title)
+        if key in self.cache:
+            self._uncache(key)
+        self.cache[key] = book
+        self.cached_bytes += len(title) + len(book[0]) + ENTRY_OVERHEAD
+        while self.cached_bytes > self.memory_bytes and self.cache:
+            self._uncache(next(iter(self.cache)))
+
+    def _uncache(self, key: tuple[int, str]):
+        (authors, _) = self.cache.pop(key)
+        self.cached_bytes -= len(key[1]) + len(authors) + ENTRY_OVERHEAD
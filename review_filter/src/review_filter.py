@@ -1,18 +1,23 @@
 import logging
+import os
 import threading
 import time
 from common.book import Book
 from common.eof_packet import EOFPacket
 from common.middleware import CallbackAction, Middleware
+from common.packet_decoder import PacketDecoder
 from common.review import Review
 from common.review_and_author import ReviewAndAuthor
 from common.persistence_manager import PersistenceManager
+from .book_store import BookStore
 import json
 
-BOOKS_KEY = 'books'
 EOFS_KEY = 'eofs'
-REQUEUE_EOF_KEY = 'should_requeue_eof'
+PENDING_REVIEWS_KEY = 'pending_reviews'
 CLEANUP_TIMEOUT = 60 * 20  # 20 minutes
+# Reviews of a client waiting for its books EOF that are kept in memory,
+# the rest are only read back from disk once the EOF arrives
+PENDING_REVIEWS_IN_MEMORY = int(os.getenv('PENDING_REVIEWS_IN_MEMORY', '10000'))
 
 
 class ReviewFilter:
@@ -29,13 +34,20 @@ class ReviewFilter:
         self.cluster_size = cluster_size
         self.output_queues = output_queues
         self.output_exchanges = output_exchanges
-        self.books: dict[int, dict[str, str]] = {}
+        # Reviews only carry the title and authors of their book the first
+        # time it is sent, the rest of them only its title id
+        self.sent_title_ids: dict[int, set[int]] = {}
         self.eofs: set[int] = set()
-        self.should_requeue_eof: set[int] = set()
+        # Reviews received before the books EOF of their client, which could
+        # still match a book. Clients in spilled_reviews have more of them
+        # on disk than in memory.
+        self.pending_reviews: dict[int, list[Review]] = {}
+        self.spilled_reviews: set[int] = set()
         self.last_packet_timestamp: dict[int, float] = {}
 
-        self.persistence_manager = PersistenceManager(
-            f'../storage/review_filter_{review_input_queue[0]}_{book_input_queue[0]}_{instance_id}')
+        storage_path = f'../storage/review_filter_{review_input_queue[0]}_{book_input_queue[0]}_{instance_id}'
+        self.persistence_manager = PersistenceManager.from_backend(storage_path)
+        self.books = BookStore(f'{storage_path}_books')
         self._init_state()
 
         self.reviews_middleware = None
@@ -108,7 +120,8 @@ class ReviewFilter:
             eof_callback=self.handle_books_eof,
             output_queues=self.output_queues,
             output_exchanges=self.output_exchanges,
-            instance_id=self.instance_id)
+            instance_id=self.instance_id,
+            commit_callback=self._flush_state)
         self.books_middleware.start()
 
     def _reviews_receiver(self):
@@ -117,6 +130,7 @@ class ReviewFilter:
             output_queues=self.output_queues,
             output_exchanges=self.output_exchanges,
             instance_id=self.instance_id,
+            commit_callback=self._flush_state,
         )
         self.reviews_middleware.add_input_queue(
             f"{self.review_input_queue[0]}_{self.instance_id}",
@@ -125,46 +139,41 @@ class ReviewFilter:
             eof_callback=self.handle_reviews_eof,
             auto_ack=False
         )
+        # Books EOFs received before a restart whose reviews were not resolved
+        for client_id in list(self.pending_reviews.keys()):
+            if client_id in self.eofs:
+                self._resolve_pending_reviews(client_id)
         self.reviews_middleware.start()
 
+    def _flush_state(self):
+        # State changes of a group are durable before its deliveries are acked
+        with self.persistence_manager_lock:
+            self.persistence_manager.flush()
+
     def _add_book(self, book: Book):
         client_id = book.client_id
-        if client_id not in self.books:
-            self.books[client_id] = {}
-        self.books[client_id][book.title] = book.authors
-        with self.persistence_manager_lock:
-            self.persistence_manager.append(f"{BOOKS_KEY}_{client_id}", json.dumps([book.title, book.authors]))
+        self.books.add(client_id, book.title, book.authors)
 
         logging.debug("Received and saved book: %s", book.title)
-        if len(self.books[client_id]) % 2000 == 0:
-            logging.info("[Client %s] Stored books count: %d", client_id,  len(self.books[client_id]))
+        if self.books.count(client_id) % 2000 == 0:
+            logging.info("[Client %s] Stored books count: %d", client_id, self.books.count(client_id))
 
     def _reset_filter(self, client_id: int):
         logging.info("Starting filter reset for client id %s", client_id)
         with self.persistence_manager_lock:
-            self.books.pop(client_id, None)
-            self.persistence_manager.delete_keys(f"{BOOKS_KEY}_{client_id}")
+            self.books.delete(client_id)
+            self.sent_title_ids.pop(client_id, None)
+            if self.pending_reviews.pop(client_id, None) is not None:
+                self.spilled_reviews.discard(client_id)
+                self.persistence_manager.delete_keys(PENDING_REVIEWS_KEY, secondary_key=str(client_id))
             self.eofs.discard(client_id)
             self.persistence_manager.put(EOFS_KEY, json.dumps(list(self.eofs)))
 
-        if client_id in self.should_requeue_eof:
-            self.__remove_should_requeue_eof(client_id)
-
         with self.lock:
             self.last_packet_timestamp.pop(client_id, None)
 
         logging.info("Filter reset for client id %s", client_id)
 
-    def __add_should_requeue_eof(self, client_id: int):
-        with self.persistence_manager_lock:
-            self.should_requeue_eof.add(client_id)
-            self.persistence_manager.put(REQUEUE_EOF_KEY, json.dumps(list(self.should_requeue_eof)))
-
-    def __remove_should_requeue_eof(self, client_id: int):
-        with self.persistence_manager_lock:
-            self.should_requeue_eof.remove(client_id)
-            self.persistence_manager.put(REQUEUE_EOF_KEY, json.dumps(list(self.should_requeue_eof)))
-
     def handle_books_eof(self, eof_packet: EOFPacket):
         logging.info(f" [x] Received Books EOF: {eof_packet}")
         if self.instance_id not in eof_packet.ack_instances:
@@ -174,6 +183,12 @@ class ReviewFilter:
         with self.persistence_manager_lock:
             self.eofs.add(eof_packet.client_id)
             self.persistence_manager.put(EOFS_KEY, json.dumps(list(self.eofs)))
+        # Reviews filtered before the EOF may still be buffered after it, so
+        # they are resolved once the reviews thread is done with them
+        if self.reviews_middleware:
+            client_id = eof_packet.client_id
+            self.reviews_middleware.add_callback_threadsafe(
+                lambda: self._resolve_pending_reviews(client_id))
 
         if len(eof_packet.ack_instances) == self.cluster_size:
             logging.debug(f" [x] Finished propagating Books EOF: {eof_packet}")
@@ -182,11 +197,12 @@ class ReviewFilter:
             logging.debug(f" [x] Propagated Books EOF: {eof_packet}")
 
     def handle_reviews_eof(self, eof_packet: EOFPacket):
-        if (eof_packet.client_id not in self.eofs and eof_packet.client_id in self.books) or eof_packet.client_id in self.should_requeue_eof:
-            logging.warning(f"Received reviews EOF for client {eof_packet.client_id} but have to requeue it - requeuing")
-            if eof_packet.client_id in self.should_requeue_eof:
-                self.__remove_should_requeue_eof(eof_packet.client_id)
+        client_id = eof_packet.client_id
+        if client_id not in self.eofs and (client_id in self.books or client_id in self.pending_reviews):
+            logging.warning(f"Received reviews EOF for client {client_id} but have to requeue it - requeuing")
             return CallbackAction.REQUEUE
+        # Its books EOF may have arrived after the last review of the client
+        self._resolve_pending_reviews(client_id)
 
         if self.instance_id not in eof_packet.ack_instances:
             eof_packet.ack_instances.append(self.instance_id)
@@ -204,36 +220,82 @@ class ReviewFilter:
     def _filter_review(self, review: Review):
         with self.lock:
             self.last_packet_timestamp[review.client_id] = time.time()
-        if review.book_title in self.books.get(review.client_id, {}):
-            author = self.books[review.client_id][review.book_title]
+        # Taken before looking the book up, since every book is stored by the
+        # time its EOF arrives. Checked after, the EOF could be seen without
+        # the book that arrived right before it, dropping its review.
+        with self.persistence_manager_lock:
+            books_eof = review.client_id in self.eofs
+        if not self._send_review(review) and not books_eof:
+            self._buffer_review(review)
+        return CallbackAction.ACK
+
+    def _buffer_review(self, review: Review):
+        client_id = review.client_id
+        # Persisted before the review is acknowledged, so it is not lost
+        with self.persistence_manager_lock:
+            self.persistence_manager.append(PENDING_REVIEWS_KEY, review.to_json(), secondary_key=str(client_id))
+        pending_reviews = self.pending_reviews.setdefault(client_id, [])
+        if len(pending_reviews) < PENDING_REVIEWS_IN_MEMORY:
+            pending_reviews.append(review)
+        elif client_id not in self.spilled_reviews:
+            self.spilled_reviews.add(client_id)
+            logging.info("[Client %s] Spilling pending reviews to disk", client_id)
+
+    def _resolve_pending_reviews(self, client_id: int):
+        if client_id not in self.pending_reviews:
+            return
+        reviews = self.pending_reviews.pop(client_id)
+        if client_id in self.spilled_reviews:
+            self.spilled_reviews.discard(client_id)
+            # Read back one at a time, all of them may not fit in memory. Only
+            # this thread appends to the key, so it is read without the lock.
+            reviews = (PacketDecoder.decode(record) for record in self.persistence_manager.get_records(
+                PENDING_REVIEWS_KEY, secondary_key=str(client_id)))
+
+        # Reviews buffered again after a restart, before being acknowledged
+        packet_ids = set()
+        matched = 0
+        for review in reviews:
+            if review.packet_id in packet_ids:
+                continue
+            packet_ids.add(review.packet_id)
+            matched += self._send_review(review)
+        # Published before the buffer is dropped, a crash in between only sends them again
+        self.reviews_middleware.flush()
+        with self.persistence_manager_lock:
+            self.persistence_manager.delete_keys(PENDING_REVIEWS_KEY, secondary_key=str(client_id))
+        logging.info("[Client %s] Resolved %d pending reviews, %d matched a book", client_id, len(packet_ids), matched)
+
+    def _send_review(self, review: Review) -> bool:
+        book = self.books.get(review.client_id, review.book_title)
+        if book is not None:
+            (authors, index) = book
+            # Books keep their index across restarts, so do their ids, which
+            # are unique across the cluster
+            title_id = index * self.cluster_size + self.instance_id
+            sent_title_ids = self.sent_title_ids.setdefault(review.client_id, set())
+            if title_id in sent_title_ids:
+                (title, author) = ("", "")
+            else:
+                # Only kept in memory, so after a restart the title is sent
+                # again instead of risking it was never published
+                sent_title_ids.add(title_id)
+                (title, author) = (review.book_title, authors)
             review_and_author = ReviewAndAuthor(
-                review.book_title,
+                title,
                 review.score,
                 review.text,
                 author,
                 review.client_id,
-                review.packet_id
+                review.packet_id,
+                title_id
             )
             self.reviews_middleware.send(review_and_author.encode())
             logging.debug("Filter passed - review for: %s", review.book_title)
-        elif review.client_id not in self.eofs:
-            if review.client_id not in self.should_requeue_eof:
-                self.__add_should_requeue_eof(review.client_id)
-            return CallbackAction.REQUEUE
-
-        return CallbackAction.ACK
+            return True
+        return False
 
     def _init_state(self):
-        # Load books
-        for (key, secondary_key) in self.persistence_manager.get_keys(BOOKS_KEY):
-            client_id = int(key.removeprefix(f"{BOOKS_KEY}_"))
-            books = self.persistence_manager.get(
-                key, secondary_key).splitlines()
-            self.books[client_id] = {}
-            for book in books:
-                book = json.loads(book)
-                self.books[client_id][book[0]] = book[1]
-
         # Load eofs
         self.eofs = set(json.loads(
             self.persistence_manager.get(EOFS_KEY) or '[]'))
@@ -242,8 +304,11 @@ class ReviewFilter:
         for client_id in self.eofs:
             self.last_packet_timestamp[client_id] = time.time()
 
-        # Load should_requeue_eof
-        self.should_requeue_eof = set(json.loads(self.persistence_manager.get(REQUEUE_EOF_KEY) or '[]'))
+        # Pending reviews are only read back from disk when resolved
+        for (_, secondary_key) in self.persistence_manager.get_keys(PENDING_REVIEWS_KEY):
+            client_id = int(secondary_key)
+            self.pending_reviews[client_id] = []
+            self.spilled_reviews.add(client_id)
 
         logging.info(
-            f"Initialized state with {self.books}, eofs: {self.eofs}, should_requeue_eof: {self.should_requeue_eof}")
+            f"Initialized state with books of {list(self.books.tables.keys())}, eofs: {self.eofs}, pending reviews: {list(self.pending_reviews.keys())}")
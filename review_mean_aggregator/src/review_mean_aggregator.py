@@ -1,31 +1,52 @@
 import logging
+import os
 from common.book_stats import BookStats
 from common.eof_packet import EOFPacket
 from common.middleware import Middleware
-from common.packet_decoder import PacketDecoder
-from common.persistence_manager import PersistenceManager
-import json
+from common.persistence_manager import PersistenceBackend, PersistenceManager
+from common.top_k import TopK
 
 
 MAX_BOOKS = 10
 BOOK_STATS_KEY = 'book_stats'
+REVIEW_MEAN_AGGREGATOR_ROLE = os.getenv('REVIEW_MEAN_AGGREGATOR_ROLE', 'single')
+
+
+class ReviewMeanAggregatorRole:
+    # Keeps the top books of every title and sends them at EOF
+    SINGLE = "single"
+    # Keeps the top books of its share of the titles and sends them at EOF
+    PARTIAL = "partial"
+    # Keeps the top books among the ones sent by every partial instance
+    MERGE = "merge"
 
 
 class ReviewMeanAggregator:
     def __init__(self,
                  input_queues: dict[str, str],
-                 output_queues: list[str]):
-        self.persistence_manager = PersistenceManager(
-            '../storage/review_mean_aggregator')
+                 output_queues: list[str],
+                 instance_id: int = None,
+                 cluster_size: int = 1,
+                 role: str = REVIEW_MEAN_AGGREGATOR_ROLE):
+        self.role = role
+        self.instance_id = instance_id
+        self.cluster_size = cluster_size
+        storage_path = '../storage/review_mean_aggregator'
+        if role == ReviewMeanAggregatorRole.PARTIAL:
+            storage_path += f'_{instance_id}'
+        elif role == ReviewMeanAggregatorRole.MERGE:
+            storage_path += '_merge'
+        self.persistence_manager = PersistenceManager.from_backend(storage_path, PersistenceBackend.WAL)
+        self.books_stats: dict[int, TopK] = {}
+        self._init_state()
         self.middleware = Middleware(
             input_queues=input_queues,
             output_queues=output_queues,
             callback=self._save_stats,
             eof_callback=self._handle_eof,
+            instance_id=instance_id if role == ReviewMeanAggregatorRole.PARTIAL else None,
             persistence_manager=self.persistence_manager,
         )
-        self.books_stats: dict[int, list[BookStats]] = {}
-        self._init_state()
 
     def start(self):
         self.middleware.start()
@@ -36,12 +57,33 @@ class ReviewMeanAggregator:
 
     def _handle_eof(self, eof_packet: EOFPacket):
         client_id = eof_packet.client_id
-        for book_stats in self.books_stats.get(client_id, []):
-            self.middleware.send(book_stats.encode())
+        if self.role == ReviewMeanAggregatorRole.PARTIAL:
+            if self.instance_id not in eof_packet.ack_instances:
+                eof_packet.ack_instances.append(self.instance_id)
+                self._send_top_books(client_id)
+                self._clear_client(client_id)
+
+            if len(eof_packet.ack_instances) == self.cluster_size:
+                self.middleware.send(EOFPacket(client_id, eof_packet.packet_id).encode())
+                logging.debug("Forwarded EOF")
+            else:
+                self.middleware.return_eof(eof_packet)
+            return
+
+        self._send_top_books(client_id)
         self.middleware.send(EOFPacket(
             eof_packet.client_id,
             eof_packet.packet_id
         ).encode())
+        self._clear_client(client_id)
+
+    def _send_top_books(self, client_id: int):
+        if client_id not in self.books_stats:
+            return
+        for book_stats in self.books_stats[client_id].items(client_id):
+            self.middleware.send(book_stats.encode())
+
+    def _clear_client(self, client_id: int):
         if client_id in self.books_stats:
             self.persistence_manager.delete_keys(
                 f"{BOOK_STATS_KEY}_{client_id}")
@@ -50,37 +92,19 @@ class ReviewMeanAggregator:
     def _save_stats(self, book_stats: BookStats):
         client_id = book_stats.client_id
         if client_id not in self.books_stats:
-            self.books_stats[client_id] = []
-        # Only save the new packet if it is not already in the list.
-        # If it is, it means that the packet was already processed but not acknowledged.
-        if book_stats.packet_id not in [stats.packet_id
-                                        for stats in self.books_stats
-                                        [client_id]]:
-            # If the list is not full, add the new packet
-            if len(self.books_stats[client_id]) < MAX_BOOKS:
-                self.books_stats[client_id].append(book_stats)
-            # If the list is full, replace the smallest packet with the new one (if the new one is bigger)
-            elif self.books_stats[client_id][-1] < book_stats:
-                self.books_stats[client_id][-1] = book_stats
-            # If the new packet is smaller than the smallest packet, we dont have to change anything
-            else:
-                return
-
-            # Sort the list after adding the new packet, then persist the state
-            self.books_stats[client_id].sort(reverse=True)
+            self.books_stats[client_id] = TopK(MAX_BOOKS)
+        # Duplicates (processed but not acknowledged) and books that do not
+        # make it into the top leave the state unchanged, so nothing is written
+        if self.books_stats[client_id].add(book_stats):
             self.persistence_manager.put(
-                f"{BOOK_STATS_KEY}_{client_id}", json.dumps(
-                    [book_stats.encode()
-                     for book_stats in self.books_stats[client_id]]))
+                f"{BOOK_STATS_KEY}_{client_id}", self.books_stats[client_id].to_str())
 
     def _init_state(self):
         for (key, secondary_key) in self.persistence_manager.get_keys(prefix=BOOK_STATS_KEY):
             client_id = int(key.removeprefix(f"{BOOK_STATS_KEY}_"))
-            state = json.loads(self.persistence_manager.get(
-                key, secondary_key) or '[]')
-            self.books_stats[client_id] = [
-                PacketDecoder.decode(book_stats) for book_stats in state]
+            self.books_stats[client_id] = TopK.from_str(
+                self.persistence_manager.get(key, secondary_key) or '[]', MAX_BOOKS)
         logging.info("Initialized review mean aggregator with state: ")
-        for client_id, client_book_stats in self.books_stats.items():
+        for client_id, top_books in self.books_stats.items():
             logging.info(
-                f"client_id: {client_id}, book_stats: {[book_stats.encode() for book_stats in client_book_stats]}")
+                f"client_id: {client_id}, book_stats: {[book_stats.to_json() for book_stats in top_books.items(client_id)]}")
@@ -0,0 +1,147 @@
+import bisect
+import json
+from array import array
+
+
+class BookTable:
+    """
+    Review count, rating sum and last packet id of every book of a client
+
+    Books are numbered on their first review and their stats are kept in
+    parallel typed arrays indexed by that number, a few dozen bytes per book
+    besides its title and authors, which only arrive with one of its reviews.
+    The books with at least required_reviews reviews are kept sorted by
+    average rating as they are updated, so the best ones are read in O(k).
+    Books updated since the last checkpoint are tracked so only they are
+    persisted.
+    """
+
+    def __init__(self, required_reviews: int):
+        self.required_reviews = required_reviews
+        self.rows: dict[int, int] = {}
+        self.title_ids = array('q')
+        self.titles: list[str] = []
+        self.authors: list[str] = []
+        self.counts = array('I')
+        self.sums = array('d')
+        self.packet_ids = array('q')
+        # (average, row) of every eligible book, from the worst to the best
+        self.eligible: list[tuple[float, int]] = []
+        self.dirty: set[int] = set()
+        self.named: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def add(self, title_id: int, title: str, authors: str, score: float, packet_id: int) -> bool:
+        """
+        Counts a review, unless it was already counted (processed but not
+        acknowledged before a restart). Returns whether the book just got
+        both the required reviews and its title, which happens only once.
+        """
+        row = self.rows.get(title_id)
+        if row is None:
+            row = self._insert(title_id, 0, 0.0, packet_id)
+        elif self.packet_ids[row] == packet_id:
+            return self._learn(row, title, authors) and self.counts[row] >= self.required_reviews
+
+        learned = self._learn(row, title, authors)
+        if self.counts[row] >= self.required_reviews:
+            self._remove_eligible(row)
+        self.counts[row] += 1
+        self.sums[row] += score
+        self.packet_ids[row] = packet_id
+        if self.counts[row] >= self.required_reviews:
+            bisect.insort(self.eligible, (self.average(row), row))
+        self.dirty.add(row)
+        return bool(self.titles[row]) and (
+            self.counts[row] == self.required_reviews or (learned and self.counts[row] > self.required_reviews))
+
+    def book(self, title_id: int) -> tuple[str, str]:
+        row = self.rows[title_id]
+        return (self.titles[row], self.authors[row])
+
+    def average(self, row: int) -> float:
+        return self.sums[row] / self.counts[row]
+
+    def top(self, k: int) -> list[tuple[str, float, int]]:
+        """
+        (title, average, last packet id) of the k best averaged eligible books
+        """
+        return [(self.titles[row], average, self.packet_ids[row])
+                for (average, row) in reversed(self.eligible[-k:])]
+
+    def checkpoint(self) -> list[str]:
+        """
+        Returns a record of every book updated since the last checkpoint,
+        with its title and authors only the first time
+        """
+        records = []
+        for row in sorted(self.dirty):
+            record = [self.title_ids[row], self.counts[row], self.sums[row], self.packet_ids[row]]
+            if row in self.named:
+                record.extend([self.titles[row], self.authors[row]])
+            records.append(json.dumps(record))
+        self.dirty.clear()
+        self.named.clear()
+        return records
+
+    def load(self, records: list[str]):
+        """
+        Restores the books of checkpointed records, the latest record of a
+        book taking precedence
+        """
+        for record in records:
+            record = json.loads(record)
+            [title_id, count, total, packet_id] = record[:4]
+            row = self.rows.get(title_id)
+            if row is None:
+                row = self._insert(title_id, count, total, packet_id)
+            else:
+                if self.counts[row] >= self.required_reviews:
+                    self._remove_eligible(row)
+                self.counts[row] = count
+                self.sums[row] = total
+                self.packet_ids[row] = packet_id
+            if len(record) > 4:
+                [self.titles[row], self.authors[row]] = record[4:]
+            if count >= self.required_reviews:
+                bisect.insort(self.eligible, (self.average(row), row))
+        self.named.clear()
+
+    def _learn(self, row: int, title: str, authors: str) -> bool:
+        if not title or self.titles[row]:
+            return False
+        self.titles[row] = title
+        self.authors[row] = authors
+        self.named.add(row)
+        self.dirty.add(row)
+        return True
+
+    def _insert(self, title_id: int, count: int, total: float, packet_id: int) -> int:
+        row = len(self.titles)
+        self.rows[title_id] = row
+        self.title_ids.append(title_id)
+        self.titles.append('')
+        self.authors.append('')
+        self.counts.append(count)
+        self.sums.append(total)
+        self.packet_ids.append(packet_id)
+        return row
+
+    def _remove_eligible(self, row: int):
+        index = bisect.bisect_left(self.eligible, (self.average(row), row))
+        del self.eligible[index]
+
+    @staticmethod
+    def compact(records: list[str]) -> list[str]:
+        # Latest stats of every book, along with its title and authors
+        latest = {}
+        names = {}
+        for record in records:
+            record = json.loads(record)
+            latest.pop(record[0], None)
+            latest[record[0]] = record[:4]
+            if len(record) > 4:
+                names[record[0]] = record[4:]
+        return [json.dumps(record + names.get(title_id, [])) for title_id, record in latest.items()]
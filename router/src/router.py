@@ -1,6 +1,7 @@
-from common.book import Book
 from common.middleware import Middleware
 from common.eof_packet import EOFPacket
+from common.packet_view import PacketView
+from common.partitioner import Partitioner
 import logging
 
 
@@ -19,11 +20,13 @@ class Router:
             eof_callback=self.handle_eof,
             output_queues=output_queues,
             output_exchanges=output_exchanges,
-            n_output_instances=n_instances)
+            n_output_instances=n_instances,
+            lazy_decode=True)
         self.instance_id = instance_id
         self.cluster_size = cluster_size
         self.hash_by_field = hash_by_field
         self.n_instances = n_instances
+        self.partitioner = Partitioner.from_type()
 
     def start(self):
         self.middleware.start()
@@ -46,18 +49,19 @@ class Router:
         else:
             self.middleware.return_eof(eof_packet)
 
-    def hash_and_route(self, book: Book, field_value):
-        instance_id = hash(field_value) % (self.n_instances)
-        self.middleware.send(book.encode(), instance_id)
-        logging.debug(f" [x] Routed packet to instance {instance_id}")
+    def hash_and_route(self, packet: PacketView, field_value):
+        instance_id = self.partitioner.partition(field_value, self.n_instances)
+        # The packet is not modified, so its original body is forwarded as is
+        self.middleware.send(packet.encode(), instance_id)
+        logging.debug(" [x] Routed packet to instance %d", instance_id)
 
-    def route_by_field_hash(self, book: Book):
-        logging.debug(f" [x] Received {book}")
-        field_value = book.get(self.hash_by_field)
+    def route_by_field_hash(self, packet: PacketView):
+        logging.debug(" [x] Received %s", packet)
+        field_value = packet.get(self.hash_by_field)
         # if isinstance(field_value, list):
         #     for value in field_value:
         #         book.set(self.hash_by_field, [value])
         #         self.hash_and_route(book, value)
         # else:
         #     self.hash_and_route(book, field_value)
-        self.hash_and_route(book, field_value)
+        self.hash_and_route(packet, field_value)
@@ -13,11 +13,15 @@ def main():
     initialize_log(os.getenv('LOGGING_LEVEL', 'INFO'))
     input_queues = json.loads(os.getenv('INPUT_QUEUES') or '[]')
     output_queues = json.loads(os.getenv('OUTPUT_QUEUES') or '[]')
+    instance_id = int(os.getenv('INSTANCE_ID') or '0')
+    cluster_size = int(os.getenv('CLUSTER_SIZE') or '1')
 
     healthcheck_port = json.loads(os.getenv("HEALTHCHECK_PORT") or '8888')
 
     sentiment_aggregator = SentimentAggregator(input_queues,
-                                               output_queues)
+                                               output_queues,
+                                               instance_id,
+                                               cluster_size)
     logging.info("Review mean aggregator is starting")
     healthcheck = HealthCheck(port=healthcheck_port)
     healthcheck_thread = threading.Thread(target=healthcheck.start, daemon=True)
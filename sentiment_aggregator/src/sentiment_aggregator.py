@@ -1,28 +1,67 @@
 import logging
+import os
 from common.book_stats import BookStats
 from common.eof_packet import EOFPacket
 from common.middleware import Middleware
-from common.persistence_manager import PersistenceManager
+from common.percentile import TDigest, quickselect
+from common.persistence_manager import PersistenceBackend, PersistenceManager
 import json
 
 
 PERCENTILE = 90
 BOOK_STATS_PREFIX = 'book_stats_'
+BOOK_AVERAGES_PREFIX = 'book_averages_'
+SENTIMENT_AGGREGATOR_ROLE = os.getenv('SENTIMENT_AGGREGATOR_ROLE', 'single')
+PERCENTILE_MODE = os.getenv('PERCENTILE_MODE', 'exact')
+
+
+class SentimentAggregatorRole:
+    # Aggregates every review and computes the percentile
+    SINGLE = "single"
+    # Aggregates the reviews of its share of the titles and sends their averages
+    PARTIAL = "partial"
+    # Computes the percentile over the averages sent by every partial instance
+    MERGE = "merge"
+
+
+class PercentileMode:
+    # Selects the exact percentile among every average
+    EXACT = "exact"
+    # Estimates the percentile from a t-digest of the averages
+    APPROXIMATE = "approximate"
 
 
 class SentimentAggregator:
     def __init__(self,
                  input_queues: dict[str, str],
-                 output_queues: list[str]):
-        self.persistence_manager = PersistenceManager(
-            '../storage/sentiment_aggregator')
-        self.books_stats: dict[int, dict[str, dict[str, str]]] = {}
+                 output_queues: list[str],
+                 instance_id: int = None,
+                 cluster_size: int = 1,
+                 role: str = SENTIMENT_AGGREGATOR_ROLE,
+                 mode: str = PERCENTILE_MODE):
+        self.role = role
+        self.mode = mode
+        self.instance_id = instance_id
+        self.cluster_size = cluster_size
+        storage_path = '../storage/sentiment_aggregator'
+        if role == SentimentAggregatorRole.PARTIAL:
+            storage_path += f'_{instance_id}'
+        elif role == SentimentAggregatorRole.MERGE:
+            storage_path += '_merge'
+        self.persistence_manager = PersistenceManager.from_backend(storage_path, PersistenceBackend.WAL)
+        # Stats of every book of a client by title id, its title is only set
+        # by the review that carried it
+        self.books_stats: dict[int, dict[int, dict]] = {}
+        # Final average of each book, only kept by the merge role
+        self.book_averages: dict[int, list[BookStats]] = {}
+        self.digests: dict[int, TDigest] = {}
         self._init_state()
         self.middleware = Middleware(
             input_queues=input_queues,
             output_queues=output_queues,
-            callback=self._save_stats,
-            eof_callback=self._calculate_percentile,
+            callback=self._save_average if role == SentimentAggregatorRole.MERGE else self._save_stats,
+            eof_callback=self._handle_eof,
+            instance_id=instance_id if role == SentimentAggregatorRole.PARTIAL else None,
             persistence_manager=self.persistence_manager
         )
 
@@ -33,63 +72,122 @@ class SentimentAggregator:
         logging.info("Graceful shutdown")
         self.middleware.shutdown()
 
-    def _calculate_percentile(self, eof_packet: EOFPacket):
+    def _handle_eof(self, eof_packet: EOFPacket):
         client_id = eof_packet.client_id
-        if client_id in self.books_stats:
-            stats: list[BookStats] = []
-            for title, book_stats in self.books_stats[client_id].items():
-                average_score = book_stats["total_score"] / book_stats["total_reviews"]
-                stats.append(
-                    BookStats(
-                        title, average_score, client_id,
-                        book_stats["packet_id"]))
-            stats.sort(key=lambda x: x.score)
-            percentile_90_score = stats[int(len(stats) * (PERCENTILE / 100))].score
-            logging.info("90th percentile score: %f", percentile_90_score)
-            percentile = [book_stats for book_stats in stats
-                          if book_stats.score >= percentile_90_score]
-
-            for book_stats in percentile:
-                self.middleware.send(book_stats.encode())
-                logging.info("Sent book stats: %s", book_stats)
+        if self.role == SentimentAggregatorRole.PARTIAL:
+            if self.instance_id not in eof_packet.ack_instances:
+                eof_packet.ack_instances.append(self.instance_id)
+                for book_stats in self._get_averages(client_id):
+                    self.middleware.send(book_stats.encode())
+                self._clear_client(client_id)
+
+            if len(eof_packet.ack_instances) == self.cluster_size:
+                self.middleware.send(EOFPacket(client_id, eof_packet.packet_id).encode())
+                logging.debug("Forwarded EOF")
+            else:
+                self.middleware.return_eof(eof_packet)
+            return
+
+        if self.role == SentimentAggregatorRole.MERGE:
+            stats = self.book_averages.get(client_id, [])
+        else:
+            stats = self._get_averages(client_id)
+        for book_stats in self._get_percentile(client_id, stats):
+            self.middleware.send(book_stats.encode())
+            logging.info("Sent book stats: %s", book_stats)
 
         self.middleware.send(EOFPacket(
             client_id,
             eof_packet.packet_id
         ).encode())
+        self._clear_client(client_id)
+
+    def _get_averages(self, client_id: int) -> list[BookStats]:
+        return [BookStats(book_stats["title"], book_stats["total_score"] / book_stats["total_reviews"],
+                          client_id, book_stats["packet_id"], title_id)
+                for title_id, book_stats in self.books_stats.get(client_id, {}).items()]
+
+    def _get_percentile(self, client_id: int, stats: list[BookStats]) -> list[BookStats]:
+        if not stats:
+            return []
+        if self.mode == PercentileMode.APPROXIMATE:
+            digest = self.digests.get(client_id)
+            if digest is None:
+                digest = TDigest()
+                for book_stats in stats:
+                    digest.add(book_stats.score)
+            percentile_score = digest.quantile(PERCENTILE / 100)
+        else:
+            percentile_score = quickselect([book_stats.score for book_stats in stats],
+                                           int(len(stats) * (PERCENTILE / 100)))
+        logging.info("90th percentile score: %f", percentile_score)
+        return [book_stats for book_stats in stats
+                if book_stats.score >= percentile_score]
+
+    def _clear_client(self, client_id: int):
         self.persistence_manager.delete_keys(f"{BOOK_STATS_PREFIX}{client_id}_")
+        self.persistence_manager.delete_keys(f"{BOOK_AVERAGES_PREFIX}{client_id}")
         self.books_stats.pop(client_id, None)
+        self.book_averages.pop(client_id, None)
+        self.digests.pop(client_id, None)
+
+    def _save_average(self, book_stats: BookStats):
+        client_id = book_stats.client_id
+        self._add_average(book_stats)
+        self.persistence_manager.append(
+            f'{BOOK_AVERAGES_PREFIX}{client_id}',
+            json.dumps([book_stats.title, book_stats.score, book_stats.packet_id]))
+        logging.debug("Received book average: %s", book_stats)
+
+    def _add_average(self, book_stats: BookStats):
+        client_id = book_stats.client_id
+        self.book_averages.setdefault(client_id, []).append(book_stats)
+        if self.mode == PercentileMode.APPROXIMATE:
+            if client_id not in self.digests:
+                self.digests[client_id] = TDigest()
+            self.digests[client_id].add(book_stats.score)
 
     def _save_stats(self, book_stats: BookStats):
         client_id = book_stats.client_id
         if client_id not in self.books_stats:
             self.books_stats[client_id] = {}
 
-        if book_stats.title not in self.books_stats[client_id]:
-            self.books_stats[client_id][book_stats.title] = {
+        title_id = book_stats.title_id
+        if title_id not in self.books_stats[client_id]:
+            self.books_stats[client_id][title_id] = {
+                "title": book_stats.title,
                 "total_score": book_stats.score,
                 "total_reviews": 1,
                 "packet_id": book_stats.packet_id
             }
         else:
+            stats = self.books_stats[client_id][title_id]
+            if book_stats.title:
+                stats["title"] = book_stats.title
             # Only update state if it is not a duplicate
             # (received and saved but then shutdown and restarted before acking the message)
-            if self.books_stats[client_id][book_stats.title]["packet_id"] != book_stats.packet_id:
-                self.books_stats[client_id][book_stats.title]["total_score"] += book_stats.score
-                self.books_stats[client_id][book_stats.title]["total_reviews"] += 1
-                self.books_stats[client_id][book_stats.title]["packet_id"] = book_stats.packet_id
+            if stats["packet_id"] != book_stats.packet_id:
+                stats["total_score"] += book_stats.score
+                stats["total_reviews"] += 1
+                stats["packet_id"] = book_stats.packet_id
 
-        key = f'{BOOK_STATS_PREFIX}{client_id}_{book_stats.title}'
+        key = f'{BOOK_STATS_PREFIX}{client_id}_{title_id}'
         self.persistence_manager.put(key, json.dumps(
-            self.books_stats[book_stats.client_id][book_stats.title]))
+            self.books_stats[client_id][title_id]))
         logging.debug("Received book stats: %s", book_stats)
 
     def _init_state(self):
         for (key, secondary_key) in self.persistence_manager.get_keys(BOOK_STATS_PREFIX):
-            [client_id, book_title] = key.removeprefix(BOOK_STATS_PREFIX).split('_', maxsplit=1)
+            [client_id, title_id] = key.removeprefix(BOOK_STATS_PREFIX).split('_', maxsplit=1)
             client_id = int(client_id)
             book_stats = json.loads(self.persistence_manager.get(key, secondary_key) or '{}')
             if client_id not in self.books_stats:
                 self.books_stats[client_id] = {}
-            self.books_stats[client_id][book_title] = book_stats
-        logging.info(f"Initialized with state: {self.books_stats}")
+            self.books_stats[client_id][int(title_id)] = book_stats
+
+        for (key, secondary_key) in self.persistence_manager.get_keys(BOOK_AVERAGES_PREFIX):
+            client_id = int(key.removeprefix(BOOK_AVERAGES_PREFIX))
+            for average in self.persistence_manager.get(key, secondary_key).splitlines():
+                [title, score, packet_id] = json.loads(average)
+                self._add_average(BookStats(title, score, client_id, packet_id))
+        logging.info("Initialized with state of %d clients", len(self.books_stats) + len(self.book_averages))
@@ -1,9 +1,31 @@
 import logging
-from textblob import TextBlob
+import multiprocessing
+import os
 from common.book_stats import BookStats
 from common.eof_packet import EOFPacket
 from common.middleware import Middleware
+from common.persistence_manager import PersistenceBackend, PersistenceManager
 from common.review_and_author import ReviewAndAuthor
+from .sentiment_cache import SentimentCache
+from .sentiment_engine import SENTIMENT_ENGINE, SentimentEngine
+
+SENTIMENT_WORKERS = int(os.getenv('SENTIMENT_WORKERS', '0'))
+SENTIMENT_BATCH_SIZE = int(os.getenv('SENTIMENT_BATCH_SIZE', '1000'))
+SENTIMENT_CACHE_SIZE = int(os.getenv('SENTIMENT_CACHE_SIZE', '100000'))
+SENTIMENT_CACHE_PERSIST = os.getenv('SENTIMENT_CACHE_PERSIST', '1') == '1'
+
+
+# Engine of each pool worker, built once when the worker starts
+worker_engine: SentimentEngine = None
+
+
+def init_worker(engine_type: str):
+    global worker_engine
+    worker_engine = SentimentEngine.from_type(engine_type)
+
+
+def score_batch(texts: list[str]) -> list[float]:
+    return worker_engine.score_batch(texts)
 
 
 class SentimentAnalyzer:
@@ -11,36 +33,124 @@ class SentimentAnalyzer:
                  input_queues: dict[str, str],
                  output_queues: list[str],
                  instance_id: int,
-                 cluster_size: int):
+                 cluster_size: int,
+                 workers: int = SENTIMENT_WORKERS,
+                 batch_size: int = SENTIMENT_BATCH_SIZE,
+                 cache_size: int = SENTIMENT_CACHE_SIZE,
+                 engine_type: str = SENTIMENT_ENGINE):
+        # Reviews are scored in batches across the pool, published in the order
+        # they arrived before their deliveries are committed
+        self.pool = None
+        self.engine = None
+        self.pending_reviews: list[ReviewAndAuthor] = []
+        self.workers = workers
+        self.batch_size = batch_size
+        if workers > 0:
+            # Forked before the connection is opened, so workers hold no sockets
+            self.pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(engine_type,))
+        else:
+            self.engine = SentimentEngine.from_type(engine_type)
+        self.cache = None
+        if cache_size > 0:
+            persistence_manager = None
+            if SENTIMENT_CACHE_PERSIST:
+                persistence_manager = PersistenceManager.from_backend(
+                    f'../storage/sentiment_analyzer_{instance_id}', PersistenceBackend.WAL)
+            self.cache = SentimentCache(cache_size, persistence_manager)
         self.middleware = Middleware(
             input_queues=input_queues,
             output_queues=output_queues,
-            callback=self._calculate_sentiment,
+            callback=self._calculate_sentiment if self.pool is None else self._add_review,
             eof_callback=self._handle_eof,
+            commit_callback=self._before_commit,
         )
         self.instance_id = instance_id
         self.cluster_size = cluster_size
 
     def start(self):
         self.middleware.start()
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
 
     def shutdown(self):
         logging.info("Graceful shutdown")
         self.middleware.shutdown()
 
     def _calculate_sentiment(self, review: ReviewAndAuthor):
-        sentiment = TextBlob(review.text).sentiment.polarity
+        if self.cache is None:
+            sentiment = self.engine.score(review.text)
+        else:
+            digest = SentimentCache.digest(review.text)
+            sentiment = self.cache.get(digest)
+            if sentiment is None:
+                sentiment = self.engine.score(review.text)
+                self.cache.put(digest, sentiment)
         stats = BookStats(
             review.book_title,
             sentiment,
             review.client_id,
-            review.packet_id
+            review.packet_id,
+            review.title_id
         )
         self.middleware.send(stats.encode())
         logging.debug("Review %s - Sentiment score: %f",
                       review.book_title, sentiment)
 
+    def _before_commit(self):
+        if self.pool:
+            self._score_pending_reviews()
+        if self.cache:
+            self.cache.flush()
+
+    def _add_review(self, review: ReviewAndAuthor):
+        self.pending_reviews.append(review)
+        if len(self.pending_reviews) >= self.batch_size:
+            self._score_pending_reviews()
+
+    def _score_pending_reviews(self):
+        if not self.pending_reviews:
+            return
+        reviews = self.pending_reviews
+        self.pending_reviews = []
+        digests = [SentimentCache.digest(review.text) for review in reviews]
+        # Only texts missing from the cache are scored, each one only once
+        scores = {}
+        missing = {}
+        for digest, review in zip(digests, reviews):
+            if digest in scores or digest in missing:
+                continue
+            sentiment = self.cache.get(digest) if self.cache else None
+            if sentiment is None:
+                missing[digest] = review.text
+            else:
+                scores[digest] = sentiment
+
+        if missing:
+            texts = list(missing.values())
+            chunksize = max(1, len(texts) // (4 * self.workers))
+            chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+            sentiments = [sentiment for chunk in self.pool.map(score_batch, chunks) for sentiment in chunk]
+            for digest, sentiment in zip(missing.keys(), sentiments):
+                scores[digest] = sentiment
+                if self.cache:
+                    self.cache.put(digest, sentiment)
+
+        for review, digest in zip(reviews, digests):
+            sentiment = scores[digest]
+            self.middleware.send(BookStats(
+                review.book_title,
+                sentiment,
+                review.client_id,
+                review.packet_id,
+                review.title_id
+            ).encode())
+        logging.debug("Scored batch of %d reviews, %d of them new", len(reviews), len(missing))
+
     def _handle_eof(self, eof_packet: EOFPacket):
+        if self.pool:
+            # Every score of the client must reach the next stage before its EOF
+            self._score_pending_reviews()
         if self.instance_id not in eof_packet.ack_instances:
             eof_packet.ack_instances.append(self.instance_id)
 
@@ -50,5 +160,7 @@ class SentimentAnalyzer:
                 eof_packet.packet_id,
             ).encode())
             logging.debug("Forwarded EOF")
+            if self.cache:
+                logging.info("Client %d done, %s", eof_packet.client_id, self.cache)
         else:
             self.middleware.return_eof(eof_packet)
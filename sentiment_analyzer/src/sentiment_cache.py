@@ -0,0 +1,76 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+from common.persistence_manager import PersistenceManager
+
+CACHE_KEY = 'sentiment_cache'
+
+
+class SentimentCache:
+    """
+    Bounded LRU cache of polarities keyed by a digest of the review text
+
+    Texts are normalized by collapsing whitespace, which does not change how
+    they are tokenized. When a PersistenceManager is given, every new entry
+    is appended to it and the cache is warmed with the latest entries on
+    startup, so redelivered reviews are not scored again after a restart.
+    """
+
+    def __init__(self, capacity: int, persistence_manager: PersistenceManager = None):
+        self.capacity = capacity
+        self.persistence_manager = persistence_manager
+        self.entries: OrderedDict[bytes, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.persistence_manager:
+            self.persistence_manager.register_compactor(CACHE_KEY, self._compact)
+            self._init_state()
+
+    @staticmethod
+    def digest(text: str) -> bytes:
+        return hashlib.blake2b(' '.join(text.split()).encode(), digest_size=16).digest()
+
+    def get(self, digest: bytes):
+        polarity = self.entries.get(digest)
+        if polarity is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        return polarity
+
+    def put(self, digest: bytes, polarity: float):
+        self._put(digest, polarity)
+        if self.persistence_manager:
+            self.persistence_manager.append(CACHE_KEY, f'{digest.hex()} {polarity!r}')
+
+    def flush(self):
+        if self.persistence_manager:
+            self.persistence_manager.flush()
+
+    def _put(self, digest: bytes, polarity: float):
+        self.entries[digest] = polarity
+        self.entries.move_to_end(digest)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def _compact(self, records: list[str]) -> list[str]:
+        # Only the latest entries would survive loading them back
+        latest = OrderedDict()
+        for record in records:
+            digest, _ = record.split(' ', maxsplit=1)
+            latest[digest] = record
+            latest.move_to_end(digest)
+        return list(latest.values())[-self.capacity:]
+
+    def _init_state(self):
+        for record in self.persistence_manager.get(CACHE_KEY).splitlines():
+            digest, polarity = record.split(' ', maxsplit=1)
+            self._put(bytes.fromhex(digest), float(polarity))
+        logging.info("Loaded %d cached sentiment scores", len(self.entries))
+
+    def __str__(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return f"SentimentCache(size={len(self.entries)}, hits={self.hits}, misses={self.misses}, hit_rate={hit_rate:.2%})"
@@ -0,0 +1,163 @@
+from abc import ABC, abstractmethod
+import os
+import re
+
+from textblob import TextBlob
+from textblob._text import (ABBREVIATIONS, EMOTICONS, PUNCTUATION, RE_ABBR1, RE_ABBR2, RE_ABBR3,
+                            RE_EMOTICONS, RE_SARCASM, replacements)
+from textblob.en import sentiment as pattern_sentiment
+
+SENTIMENT_ENGINE = os.getenv('SENTIMENT_ENGINE', 'textblob')
+
+NEGATIONS = frozenset(pattern_sentiment.negations)
+MODIFIER = 'RB'
+LEADING_PUNCTUATION = tuple(PUNCTUATION.replace('.', ''))
+TRAILING_PUNCTUATION = LEADING_PUNCTUATION + ('.',)
+PUNCTUATION_CHARS = frozenset(PUNCTUATION)
+# Same contractions and quotes TextBlob splits from words, in a single pass
+RE_CONTRACTIONS = re.compile('|'.join(re.escape(contraction) for contraction in replacements))
+RE_QUOTES = re.compile('[“”‘’\'"]')
+RE_LINE_BREAKS = re.compile(r'\n{2,}')
+EMOTICON_POLARITIES = {}
+for (_, emoticon_polarity), emoticons in EMOTICONS.items():
+    for emoticon in emoticons:
+        EMOTICON_POLARITIES.setdefault(emoticon.lower(), emoticon_polarity)
+
+
+class SentimentEngineType:
+    TEXTBLOB = "textblob"
+    LEXICON = "lexicon"
+
+
+class SentimentEngine(ABC):
+    @abstractmethod
+    def score_batch(self, texts: list[str]) -> list[float]:
+        pass
+
+    def score(self, text: str) -> float:
+        return self.score_batch([text])[0]
+
+    @staticmethod
+    def from_type(engine_type: str = SENTIMENT_ENGINE) -> 'SentimentEngine':
+        if engine_type == SentimentEngineType.TEXTBLOB:
+            return TextBlobEngine()
+        elif engine_type == SentimentEngineType.LEXICON:
+            return LexiconEngine()
+        raise ValueError(f"Unknown sentiment engine: {engine_type}")
+
+
+class TextBlobEngine(SentimentEngine):
+    def score_batch(self, texts: list[str]) -> list[float]:
+        return [TextBlob(text).sentiment.polarity for text in texts]
+
+
+class LexiconEngine(SentimentEngine):
+    """
+    Polarity scorer that follows the same rules as TextBlob's pattern analyzer
+
+    TextBlob's sentiment lexicon is flattened once into a plain dictionary of
+    (polarity, intensity, is_modifier) tuples. Texts are tokenized with the
+    same splitting rules, but only tokens that start or end with punctuation
+    take the slow path, and no sentence structure is built since polarity
+    does not depend on it.
+    """
+
+    def __init__(self):
+        pattern_sentiment.load()
+        self.lexicon = {}
+        for word, scores in dict.items(pattern_sentiment):
+            (polarity, _subjectivity, intensity) = scores[None]
+            self.lexicon[word] = (polarity, intensity, MODIFIER in scores)
+
+    def score_batch(self, texts: list[str]) -> list[float]:
+        return [self._polarity(self._tokenize(text)) for text in texts]
+
+    @staticmethod
+    def _tokenize(text: str) -> list[str]:
+        text = RE_CONTRACTIONS.sub(r' \g<0>', text)
+        text = RE_QUOTES.sub(r' \g<0> ', text)
+        text = RE_LINE_BREAKS.sub(' ', text.replace('\r\n', '\n'))
+        tokens = []
+        split = False
+        for token in text.split():
+            if token[0] in PUNCTUATION_CHARS or token[-1] in PUNCTUATION_CHARS:
+                split = True
+                LexiconEngine._split_punctuation(token, tokens)
+            else:
+                tokens.append(token)
+        if not split:
+            return text.lower().split()
+        text = ' '.join(tokens)
+        text = RE_SARCASM.sub('(!)', text)
+        text = RE_EMOTICONS.sub(lambda match: match.group(1).replace(' ', '') + match.group(2), text)
+        return text.lower().split()
+
+    @staticmethod
+    def _split_punctuation(token: str, tokens: list[str]):
+        tail = []
+        while token.startswith(LEADING_PUNCTUATION) and token not in replacements:
+            tokens.append(token[0])
+            token = token[1:]
+        while token.endswith(TRAILING_PUNCTUATION) and token not in replacements:
+            if token.endswith(LEADING_PUNCTUATION):
+                tail.append(token[-1])
+                token = token[:-1]
+            if token.endswith('...'):
+                tail.append('...')
+                token = token[:-3].rstrip('.')
+            if token.endswith('.'):
+                if token in ABBREVIATIONS or RE_ABBR1.match(token) \
+                        or RE_ABBR2.match(token) or RE_ABBR3.match(token):
+                    break
+                tail.append(token[-1])
+                token = token[:-1]
+        if token != '':
+            tokens.append(token)
+        tokens.extend(reversed(tail))
+
+    def _polarity(self, words: list[str]) -> float:
+        # Each assessment is [polarity, intensity, negated]
+        assessments = []
+        modifier = None
+        negation = None
+        for word in words:
+            scores = self.lexicon.get(word)
+            if scores is not None:
+                (polarity, intensity, is_modifier) = scores
+                if modifier is None:
+                    assessments.append([polarity, intensity, False])
+                else:
+                    last = assessments[-1]
+                    last[0] = max(-1.0, min(polarity * last[1], 1.0))
+                    last[1] = intensity
+                if negation is not None:
+                    last = assessments[-1]
+                    last[1] = 1.0 / last[1]
+                    last[2] = True
+                modifier = word if is_modifier else None
+                negation = word if word in NEGATIONS else None
+                continue
+
+            if word in NEGATIONS:
+                negation = word
+            elif negation and len(word.strip("'")) > 1:
+                negation = None
+            if negation is not None and modifier is not None and modifier.endswith('ly'):
+                assessments[-1][2] = True
+                negation = None
+            elif modifier and len(word) > 2:
+                modifier = None
+            if word == '!' and assessments:
+                assessments[-1][0] = max(-1.0, min(assessments[-1][0] * 1.25, 1.0))
+            if word == '(!)':
+                assessments.append([0.0, 1.0, False])
+            if not word.isalpha() and len(word) <= 5 and word not in PUNCTUATION:
+                polarity = EMOTICON_POLARITIES.get(word)
+                if polarity is not None:
+                    assessments.append([polarity, 1.0, False])
+
+        if not assessments:
+            return 0.0
+        # "not good" = slightly bad, "not bad" = slightly good
+        return sum(polarity * -0.5 if negated else polarity
+                   for (polarity, _, negated) in assessments) / len(assessments)
@@ -0,0 +1,113 @@
+import threading
+from collections import deque
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from common.confirming_publisher import ConfirmingPublisher
+
+
+class FakeChannel:
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange: str, routing_key: str, body):
+        self.published.append((routing_key, body))
+
+
+def confirming_publisher(window: int = 10, retries: int = 1) -> ConfirmingPublisher:
+    """
+    Publisher whose event loop runs every callback right away, over a
+    channel that only records what it publishes
+    """
+    publisher = ConfirmingPublisher.__new__(ConfirmingPublisher)
+    publisher.window = window
+    publisher.retries = retries
+    publisher.condition = threading.Condition()
+    publisher.outstanding = 0
+    publisher.error = None
+    publisher.channel = FakeChannel()
+    ioloop = SimpleNamespace(add_callback_threadsafe=lambda callback: callback())
+    publisher.connection = SimpleNamespace(ioloop=ioloop, close=lambda: None)
+    publisher._sequence = 0
+    publisher._delivery_tag = 0
+    publisher._unconfirmed = {}
+    publisher._waiters = deque()
+    publisher._ready = threading.Event()
+    return publisher
+
+
+def ack(delivery_tag: int, multiple: bool = False):
+    return SimpleNamespace(method=pika.spec.Basic.Ack(delivery_tag=delivery_tag, multiple=multiple))
+
+
+def nack(delivery_tag: int, multiple: bool = False):
+    return SimpleNamespace(method=pika.spec.Basic.Nack(delivery_tag=delivery_tag, multiple=multiple))
+
+
+def test_waiters_run_once_every_previous_publish_is_confirmed():
+    publisher = confirming_publisher()
+    released = []
+    publisher.publish('', 'q', b'0')
+    publisher.publish('', 'q', b'1')
+    publisher.after_confirmed(lambda: released.append('first'))
+    publisher.publish('', 'q', b'2')
+    publisher.after_confirmed(lambda: released.append('second'))
+
+    publisher._on_confirm(ack(1))
+    assert released == []
+    publisher._on_confirm(ack(2))
+    assert released == ['first']
+    publisher._on_confirm(ack(3))
+    assert released == ['first', 'second']
+    assert publisher.outstanding == 0
+
+
+def test_waiter_without_pending_publishes_runs_right_away():
+    publisher = confirming_publisher()
+    released = []
+    publisher.after_confirmed(lambda: released.append(True))
+    assert released == [True]
+
+
+def test_publishes_stay_in_flight_up_to_the_window():
+    publisher = confirming_publisher(window=2)
+    publisher.publish('', 'q', b'0')
+    publisher.publish('', 'q', b'1')
+    assert len(publisher.channel.published) == 2
+
+    third = threading.Thread(target=publisher.publish, args=('', 'q', b'2'))
+    third.start()
+    third.join(timeout=0.1)
+    assert third.is_alive()
+
+    publisher._on_confirm(ack(2, multiple=True))
+    third.join(timeout=1)
+    assert not third.is_alive()
+    assert [body for (_, body) in publisher.channel.published] == [b'0', b'1', b'2']
+
+
+def test_nacked_publish_is_sent_again_and_holds_back_its_waiters():
+    publisher = confirming_publisher()
+    released = []
+    publisher.publish('', 'q', b'0')
+    publisher.after_confirmed(lambda: released.append(True))
+    publisher.publish('', 'q', b'1')
+
+    publisher._on_confirm(nack(1))
+    assert [body for (_, body) in publisher.channel.published] == [b'0', b'1', b'0']
+    # The publish sent after the waiter is confirmed first, the waiter still
+    # needs the retried one
+    publisher._on_confirm(ack(2))
+    assert released == []
+    publisher._on_confirm(ack(3))
+    assert released == [True]
+
+
+def test_publish_fails_once_retries_are_exhausted():
+    publisher = confirming_publisher(retries=0)
+    publisher.publish('', 'q', b'0')
+    publisher._on_confirm(nack(1))
+    with pytest.raises(OSError):
+        publisher.publish('', 'q', b'1')
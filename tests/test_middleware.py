@@ -0,0 +1,66 @@
+from common.book_stats import BookStats
+from common.eof_packet import EOFPacket
+from common.middleware import Middleware
+from common.packet_batch import PacketBatch
+
+
+def batching_middleware(**attributes) -> Middleware:
+    """
+    Middleware that records what it publishes instead of connecting to a broker
+    """
+    middleware = Middleware.__new__(Middleware)
+    middleware.should_stop = False
+    middleware.output_queues = ['stats']
+    middleware.output_exchanges = []
+    middleware.input_queues = {}
+    middleware.instance_id = None
+    middleware.batch_size = 3
+    middleware.batch_max_bytes = 1024 * 1024
+    middleware.batch_timeout = 60
+    middleware._batches = {}
+    middleware._batches_bytes = {}
+    middleware._batch_started_at = None
+    middleware.published = []
+    middleware._basic_publish = lambda exchange, routing_key, body: middleware.published.append((routing_key, body))
+    for name, value in attributes.items():
+        setattr(middleware, name, value)
+    return middleware
+
+
+def stats(packet_id: int):
+    return BookStats('Dune', 4.5, 1, packet_id, 7).encode()
+
+
+def as_bytes(body) -> bytes:
+    return body.encode() if isinstance(body, str) else body
+
+
+def test_eof_is_published_after_every_batched_packet():
+    middleware = batching_middleware()
+    middleware.send(stats(0), instance_id=3)
+    middleware.send(stats(1), instance_id=0)
+    middleware.send(EOFPacket(1, 2).encode(), instance_id=0)
+
+    assert [queue for (queue, _) in middleware.published] == ['stats_3', 'stats_0', 'stats_0']
+    assert middleware.published[0][1] == stats(0)
+    assert middleware.published[2][1] == EOFPacket(1, 2).encode()
+    assert middleware._batches == {}
+
+
+def test_returned_eof_is_published_after_every_batched_packet():
+    middleware = batching_middleware(input_queues={'reviews_1': ''}, instance_id=1)
+    middleware.send(stats(0), instance_id=3)
+    middleware.send(stats(1), instance_id=3)
+    middleware.return_eof(EOFPacket(1, 2))
+
+    assert [queue for (queue, _) in middleware.published] == ['stats_3', 'reviews_2']
+    assert PacketBatch.decode(middleware.published[0][1]) == [as_bytes(stats(0)), as_bytes(stats(1))]
+
+
+def test_packets_are_batched_until_full():
+    middleware = batching_middleware()
+    for packet_id in range(4):
+        middleware.send(stats(packet_id), instance_id=3)
+
+    assert len(middleware.published) == 1
+    assert len(PacketBatch.decode(middleware.published[0][1])) == 3
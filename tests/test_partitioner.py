@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from common.partitioner import PartitionerType
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEYS = ['Pride and Prejudice', 'Dune', '', 'Ñandú', 42, 7, -1]
+N_PARTITIONS = [1, 2, 3, 7, 16]
+
+# Partitions every key in a fresh interpreter, as each replica would
+PARTITION_SCRIPT = """
+import json, sys
+from common.partitioner import Partitioner
+partitioner = Partitioner.from_type(sys.argv[1])
+keys = json.loads(sys.argv[2])
+print(json.dumps([[partitioner.partition(key, n) for n in {n_partitions}] for key in keys]))
+""".format(n_partitions=N_PARTITIONS)
+
+
+def partitions_with_seed(partitioner_type: str, seed: str) -> list:
+    env = {**os.environ, 'PYTHONHASHSEED': seed, 'PYTHONPATH': ROOT}
+    output = subprocess.run(
+        [sys.executable, '-c', PARTITION_SCRIPT, partitioner_type, json.dumps(KEYS)],
+        env=env, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+@pytest.mark.parametrize('partitioner_type', [PartitionerType.HASH, PartitionerType.JUMP])
+def test_partitions_do_not_depend_on_hash_seed(partitioner_type):
+    partitions = [partitions_with_seed(partitioner_type, seed) for seed in ['0', '1', '12345']]
+    assert partitions[0] == partitions[1] == partitions[2]
+    for key_partitions in partitions[0]:
+        assert all(0 <= partition < n for partition, n in zip(key_partitions, N_PARTITIONS))